@@ -2,64 +2,524 @@
 
 import os
 import sys
+import json
+import time
+import queue
+import argparse
 import threading
-from queue import Queue
-import xattr
+from collections import deque
 
-# Function to process each file and directory
-def process_file_or_directory(path, output_file, match_string):
-    if os.path.isfile(path):
+LAYOUT_POOL_XATTR = 'ceph.file.layout.pool'
+# paths are handed to the writer thread in batches of this size
+WRITE_BATCH = 1024
+PROGRESS_INTERVAL = 10
+CHECKPOINT_INTERVAL = 300
+
+
+class OutputWriter(threading.Thread):
+    # The only thread that touches the output files. Workers hand it lists of lines as bytes, so
+    # names that are not valid UTF-8 are written exactly as the filesystem has them, optionally
+    # for a named file other than the default one; files are opened on first use and kept open.
+    # When resuming, `sizes` holds the length of each file at the checkpoint and anything written
+    # after it is cut off before appending again; files the checkpoint never saw are emptied.
+    # If a write fails the error is kept in `error`, on_error is called to stop the crawl, and
+    # everything queued after it is dropped so workers never block on a full queue.
+    def __init__(self, output_file, mode='ab', sizes=None):
+        super().__init__(name='writer', daemon=True)
+        self.output_file = output_file
+        self.mode = mode
+        self.sizes = sizes
+        self.queue = queue.Queue(maxsize=1024)
+        self.files = {}
+        self.error = None
+        self.on_error = None
+
+    def _open(self, path):
+        mode = self.mode
+        if self.sizes is not None:
+            if os.path.exists(path):
+                os.truncate(path, self.sizes.get(path, 0))
+            mode = 'ab'
+        f = self.files[path] = open(path, mode, buffering=1024 * 1024)
+        return f
+
+    def _fail(self, path, e):
+        if self.error is None:
+            self.error = (path, e)
+            print(f"Failed to write {path}: {e}", file=sys.stderr)
+            if self.on_error is not None:
+                self.on_error()
+
+    def _fsync(self):
+        # a checkpoint records these sizes, so they must survive a power loss, and so must the
+        # directory entries of files created since the last one
+        for path, f in self.files.items():
+            try:
+                f.flush()
+                os.fsync(f.fileno())
+            except Exception as e:
+                self._fail(path, e)
+                return
+        for directory in {os.path.dirname(os.path.abspath(path)) for path in self.files}:
+            try:
+                fd = os.open(directory, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except OSError as e:
+                self._fail(directory, e)
+                return
+
+    def run(self):
+        files = self.files
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                path, lines = item
+                if path is None:
+                    # sync request from sync()
+                    if self.error is None:
+                        self._fsync()
+                    lines.set()
+                    continue
+                if self.error is not None:
+                    continue
+                try:
+                    f = files.get(path)
+                    if f is None:
+                        f = self._open(path)
+                    f.writelines(lines)
+                except Exception as e:
+                    self._fail(path, e)
+        finally:
+            for path, f in files.items():
+                try:
+                    f.close()
+                except Exception as e:
+                    self._fail(path, e)
+
+    def sync(self):
+        # wait until everything queued so far is flushed and fsynced, then return {path: size}
+        written = threading.Event()
+        self.queue.put((None, written))
+        written.wait()
+        if self.error is not None:
+            path, e = self.error
+            raise OSError(f"output {path} failed: {e}")
+        sizes = {path: f.tell() for path, f in self.files.items()}
+        # a match run appends to an existing file that may not have been opened yet
+        if self.output_file not in sizes and os.path.isfile(self.output_file):
+            sizes[self.output_file] = os.path.getsize(self.output_file)
+        return sizes
+
+    def write(self, lines, path=None):
+        if lines:
+            self.queue.put((path or self.output_file, lines))
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+
+
+class Crawler:
+    # Work-stealing directory walk. Each worker keeps its own deque and works depth first from the
+    # end it pushes to; an idle worker steals the oldest (shallowest, so usually largest) directory
+    # from the other end of someone else's deque. File type comes from the DirEntry, so the only
+    # per-file round trip is whatever on_file does.
+    def __init__(self, root, num_threads, on_file):
+        self.root = root
+        self.num_threads = num_threads
+        self.on_file = on_file
+        self.deques = [deque() for _ in range(num_threads)]
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.done = threading.Event()
+        self.dirs = 0
+        self.files = 0
+        self.errors = 0
+        self.started = None
+        # pause() stops every worker between two directories
+        self.cond = threading.Condition()
+        self.pausing = False
+        self.paused = 0
+        self.aborted = False
+
+    def _push(self, index, path):
+        with self.lock:
+            self.pending += 1
+        self.deques[index].append(path)
+
+    def restore(self, pending, counters):
+        # seed a resumed crawl with the directories that were still queued at the checkpoint,
+        # call before run()
+        self.dirs, self.files, self.errors = counters
+        for i, path in enumerate(pending):
+            self._push(i % self.num_threads, path)
+
+    def _next(self, index):
         try:
-            ext_attr = xattr.getxattr(path, 'ceph.file.layout.pool')
-            ext_attr_value = ext_attr.decode('utf-8')
-            if ext_attr_value == match_string:
-                with open(output_file, 'a') as f:
-                    f.write(f"{path}\n")
-        except (OSError, IOError):
+            return self.deques[index].pop()
+        except IndexError:
             pass
-    elif os.path.isdir(path):
-        queue.put(path)
-
-# Worker thread function
-def worker():
-    while True:
-        item = queue.get()
-        if item is None:
-            break
-        for entry in os.scandir(item):
-            process_file_or_directory(entry.path, output_file, match_string)
-        queue.task_done()
+        for offset in range(1, self.num_threads):
+            try:
+                return self.deques[(index + offset) % self.num_threads].popleft()
+            except IndexError:
+                continue
+        return None
 
-if __name__ == "__main__":
-    if len(sys.argv) != 5:
-        print("Usage: python script.py <directory_to_scan> <output_file> <num_worker_threads> <match_string>")
-        sys.exit(1)
+    def _scan(self, index, path):
+        files = 0
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    self._push(index, entry.path)
+                elif entry.is_file():
+                    files += 1
+                    self.on_file(entry)
+        return files
+
+    def _wait_if_paused(self):
+        if not self.pausing:
+            return
+        with self.cond:
+            self.paused += 1
+            self.cond.notify_all()
+            while self.pausing:
+                self.cond.wait()
+            self.paused -= 1
+
+    def pause(self):
+        # returns False if the crawl finished before every worker stopped
+        with self.cond:
+            self.pausing = True
+            while self.paused < self.num_threads:
+                if self.done.is_set():
+                    return False
+                self.cond.wait(0.1)
+        return True
+
+    def abort(self):
+        # stop every worker after the directory it is on, whatever is still queued is not scanned
+        self.aborted = True
+        self.done.set()
+
+    def resume(self):
+        with self.cond:
+            self.pausing = False
+            self.cond.notify_all()
+
+    def state(self):
+        # only consistent while paused: every directory is then either fully scanned, its files
+        # handed to on_file, or still queued, so the queued ones are all a resume needs
+        return {
+            'pending': [path for d in self.deques for path in d],
+            'counters': [self.dirs, self.files, self.errors],
+        }
 
-    root_directory = sys.argv[1]
-    output_file = sys.argv[2]
-    num_worker_threads = int(sys.argv[3])
-    match_string = sys.argv[4]
+    def _worker(self, index):
+        while not self.done.is_set():
+            self._wait_if_paused()
+            path = self._next(index)
+            if path is None:
+                self.done.wait(0.005)
+                continue
+            files = 0
+            try:
+                files = self._scan(index, path)
+            except OSError as e:
+                # unreadable or vanished directory, note it and keep going
+                print(f"Skipping {path}: {e}", file=sys.stderr)
+                with self.lock:
+                    self.errors += 1
+            finally:
+                with self.lock:
+                    self.dirs += 1
+                    self.files += files
+                    self.pending -= 1
+                    if self.pending == 0:
+                        self.done.set()
 
-    # Create a Queue to hold the directories to be processed
-    queue = Queue()
+    def _report(self):
+        while not self.done.wait(PROGRESS_INTERVAL):
+            if self.pausing:
+                continue
+            print(self.progress(), file=sys.stderr)
+
+    def progress(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return f"{self.dirs} dirs, {self.files} files in {elapsed:.0f}s ({self.files / elapsed:.0f} files/sec), {self.errors} errors"
+
+    def run(self):
+        self.started = time.monotonic()
+        if not self.pending:
+            self._push(0, self.root)
+        threads = [threading.Thread(target=self._worker, args=(i,), name=f"crawler-{i}") for i in range(self.num_threads)]
+        threads.append(threading.Thread(target=self._report, name='progress', daemon=True))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+
+class PoolMatcher:
+    # on_file callback: collects files whose layout pool is match_string and passes them to the
+    # writer in batches, one batch buffer per thread so no lock is needed on the hot path
+    def __init__(self, writer, match_string):
+        self.writer = writer
+        self.match = match_string.encode()
+        self.local = threading.local()
+        self.buffers = []
+        self.buffers_lock = threading.Lock()
+
+    def _buffer(self):
+        buf = getattr(self.local, 'buf', None)
+        if buf is None:
+            buf = self.local.buf = []
+            with self.buffers_lock:
+                self.buffers.append(buf)
+        return buf
+
+    def __call__(self, entry):
+        try:
+            pool = os.getxattr(entry.path, LAYOUT_POOL_XATTR)
+        except OSError:
+            return
+        if pool != self.match:
+            return
+        buf = self._buffer()
+        buf.append(os.fsencode(entry.path) + b'\n')
+        if len(buf) >= WRITE_BATCH:
+            self.writer.write(buf[:])
+            buf.clear()
 
-    # Create and start the worker threads
-    threads = []
-    for i in range(num_worker_threads):
-        t = threading.Thread(target=worker)
-        t.start()
-        threads.append(t)
+    def flush(self):
+        for buf in self.buffers:
+            self.writer.write(buf[:])
+            buf.clear()
+
+
+class PoolInventory:
+    # on_file callback for --inventory: reads the layout pool of every file once and sorts the
+    # paths into one list per pool, keeping file and byte totals per pool. Buffers and totals are
+    # per thread and merged at the end.
+    def __init__(self, writer, output_dir):
+        self.writer = writer
+        self.output_dir = output_dir
+        self.local = threading.local()
+        self.states = []
+        self.states_lock = threading.Lock()
+
+    def _state(self):
+        state = getattr(self.local, 'state', None)
+        if state is None:
+            # pool -> [pending lines], pool -> [files, bytes]
+            state = self.local.state = ({}, {})
+            with self.states_lock:
+                self.states.append(state)
+        return state
+
+    def list_path(self, pool):
+        return os.path.join(self.output_dir, pool.replace('/', '_') + '.list')
+
+    def __call__(self, entry):
+        try:
+            pool = os.getxattr(entry.path, LAYOUT_POOL_XATTR).decode('utf-8', errors='replace')
+            size = entry.stat().st_size
+        except OSError:
+            return
+        buffers, totals = self._state()
+        total = totals.get(pool)
+        if total is None:
+            total = totals[pool] = [0, 0]
+        total[0] += 1
+        total[1] += size
+        buf = buffers.get(pool)
+        if buf is None:
+            buf = buffers[pool] = []
+        buf.append(os.fsencode(entry.path) + b'\n')
+        if len(buf) >= WRITE_BATCH:
+            self.writer.write(buf[:], self.list_path(pool))
+            buf.clear()
+
+    def flush(self):
+        for buffers, _ in self.states:
+            for pool, buf in buffers.items():
+                self.writer.write(buf[:], self.list_path(pool))
+                buf.clear()
+
+    def totals(self):
+        merged = {}
+        for _, totals in self.states:
+            for pool, (files, size) in totals.items():
+                total = merged.setdefault(pool, [0, 0])
+                total[0] += files
+                total[1] += size
+        return merged
+
+    def state(self):
+        return self.totals()
+
+    def remove_stale(self, keep=()):
+        # per-pool lists and pools.tsv left by an earlier run would pass for results of this one,
+        # so they are removed before crawling. A resumed run keeps the lists its checkpoint saw.
+        for name in os.listdir(self.output_dir):
+            path = os.path.join(self.output_dir, name)
+            if name == 'pools.tsv' or name.endswith('.list') and path not in keep:
+                os.remove(path)
+
+    def restore(self, totals):
+        # totals from a checkpoint, kept as one more per-thread state so totals() adds them in
+        self.states.append(({}, {pool: list(total) for pool, total in totals.items()}))
+
+    def write_summary(self):
+        # pools.tsv: pool, files, bytes
+        totals = self.totals()
+        with open(os.path.join(self.output_dir, 'pools.tsv'), 'w') as f:
+            f.write("pool\tfiles\tbytes\n")
+            for pool in sorted(totals):
+                files, size = totals[pool]
+                f.write(f"{pool}\t{files}\t{size}\n")
+        return totals
+
+
+class Checkpointer(threading.Thread):
+    # Every `interval` seconds: stop the crawl between directories, get every collected path onto
+    # disk (fsynced), and record the queued directories together with the output file sizes.
+    # Resuming truncates the outputs back to those sizes and rescans just the queued directories,
+    # so a path is never listed twice or missed however the previous run was stopped. An output
+    # that is shorter than its checkpoint says was changed behind the crawl's back, and is refused.
+    def __init__(self, path, interval, crawler, on_file, writer, identity):
+        super().__init__(name='checkpoint', daemon=True)
+        self.path = path
+        self.interval = interval
+        self.crawler = crawler
+        self.on_file = on_file
+        self.writer = writer
+        self.identity = identity
+
+    def run(self):
+        while not self.crawler.done.wait(self.interval):
+            try:
+                self.save()
+            except OSError as e:
+                print(f"Failed to write checkpoint {self.path}: {e}", file=sys.stderr)
+
+    def save(self):
+        try:
+            if not self.crawler.pause():
+                return
+            self.on_file.flush()
+            state = dict(self.identity)
+            state.update(self.crawler.state())
+            state['outputs'] = self.writer.sync()
+            if isinstance(self.on_file, PoolInventory):
+                state['totals'] = self.on_file.state()
+        finally:
+            self.crawler.resume()
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def load_checkpoint(path, identity):
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except (OSError, ValueError) as e:
+        sys.exit(f"Cannot resume from checkpoint {path}: {e}")
+    for key, value in identity.items():
+        if state.get(key) != value:
+            sys.exit(f"Checkpoint {path} is for {key} {state.get(key)!r}, not {value!r}")
+    for output, size in state['outputs'].items():
+        # truncating up to the checkpoint size would pad the file with NUL bytes instead
+        current = os.path.getsize(output) if os.path.exists(output) else 0
+        if current < size:
+            sys.exit(f"Cannot resume from checkpoint {path}: {output} is {current} bytes, shorter than the {size} it recorded")
+    return state
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='List the files under a CephFS directory whose layout is in the given data pool.')
+    parser.add_argument('root_directory', help='Directory to scan')
+    parser.add_argument('output_file', help='File the matching paths are appended to, or the output directory with --inventory')
+    parser.add_argument('num_worker_threads', type=int, help='Number of crawler threads')
+    parser.add_argument('match_string', nargs='?', help='Pool name to match against ceph.file.layout.pool')
+    parser.add_argument('-I', '--inventory', action='store_true',
+                        help='Inventory every pool in one pass: write <pool>.list for each pool and pools.tsv with file and byte totals into output_file, which is a directory')
+    parser.add_argument('-c', '--checkpoint', metavar='FILE',
+                        help='Crawl state saved periodically for --resume (default: output_file.checkpoint, or checkpoint.json in the --inventory directory)')
+    parser.add_argument('--checkpoint-interval', type=float, default=CHECKPOINT_INTERVAL,
+                        help=f'Seconds between checkpoints, 0 to disable (default: {CHECKPOINT_INTERVAL})')
+    parser.add_argument('-r', '--resume', action='store_true', help='Continue an interrupted crawl from its checkpoint')
+    args = parser.parse_args()
+    if not args.inventory and args.match_string is None:
+        parser.error('match_string is required unless --inventory is given')
+    if args.checkpoint is None:
+        if args.inventory:
+            args.checkpoint = os.path.join(args.output_file, 'checkpoint.json')
+        else:
+            args.checkpoint = args.output_file + '.checkpoint'
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
 
-    # Add the root directory to the queue
-    queue.put(root_directory)
+    # a checkpoint is only resumed into the same crawl it was taken from
+    identity = {
+        'root': os.path.abspath(args.root_directory),
+        'inventory': args.inventory,
+        'match': args.match_string,
+    }
+    state = load_checkpoint(args.checkpoint, identity) if args.resume else None
 
-    # Wait for the queue to be empty
-    queue.join()
+    # the per-pool lists are rewritten on every inventory run, a match run appends as it always has
+    writer = OutputWriter(args.output_file, 'wb' if args.inventory else 'ab', state and state['outputs'])
+    writer.start()
+    if args.inventory:
+        os.makedirs(args.output_file, exist_ok=True)
+        on_file = PoolInventory(writer, args.output_file)
+        on_file.remove_stale(state['outputs'] if state else ())
+    else:
+        on_file = PoolMatcher(writer, args.match_string)
+    crawler = Crawler(args.root_directory, max(args.num_worker_threads, 1), on_file)
+    writer.on_error = crawler.abort
+    if state:
+        crawler.restore(state['pending'], state['counters'])
+        if args.inventory:
+            on_file.restore(state.get('totals', {}))
+        print(f"Resuming with {len(state['pending'])} queued dirs, {crawler.dirs} dirs and {crawler.files} files already scanned", file=sys.stderr)
 
-    # Stop the worker threads
-    for i in range(num_worker_threads):
-        queue.put(None)
-    for t in threads:
-        t.join()
+    checkpointer = Checkpointer(args.checkpoint, args.checkpoint_interval, crawler, on_file, writer, identity)
+    if args.checkpoint_interval > 0:
+        checkpointer.start()
+    crawler.run()
+    if checkpointer.is_alive():
+        checkpointer.join()
+    on_file.flush()
+    writer.close()
+    if writer.error is not None:
+        # the checkpoint is kept, it only covers what was written before the failure
+        path, e = writer.error
+        print(crawler.progress(), file=sys.stderr)
+        sys.exit(f"Stopped, failed to write {path}: {e}")
+    checkpointer.remove()
 
+    print(crawler.progress())
+    if args.inventory:
+        for pool, (files, size) in sorted(on_file.write_summary().items()):
+            print(f"{pool}: {files} files, {size} bytes")
     print("Finished processing.")
@@ -9,32 +9,49 @@ import argparse
 import subprocess
 import re
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
-# Find pinned directories
-def find_non_negative_ceph_dir_pin(starting_directory):
-    non_negative_dirs = []
+PIN_XATTR = 'ceph.dir.pin'
+SCAN_THREADS = 16
+
+# ceph.dir.pin of a directory, -1 if unpinned or unreadable
+def get_pin(directory):
+    try:
+        return int(os.getxattr(directory, PIN_XATTR))
+    except (OSError, ValueError):
+        return -1
 
-    def search_directory(directory):
-        try:
-            # Get ceph.dir.pin attribute value
-            output = subprocess.run(["getfattr", "-n", "ceph.dir.pin", directory], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
-            pin_value = output.stdout.strip().split("=")[-1]
-            if pin_value != '"-1"':
-                non_negative_dirs.append((directory, pin_value))
-            for sub_dir in os.listdir(directory):
-                sub_dir_path = os.path.join(directory, sub_dir)
-                if os.path.isdir(sub_dir_path):
-                    search_directory(sub_dir_path)
-        except subprocess.CalledProcessError as e:
-            pass  # Ignore errors for directories without ceph.dir.pin attribute
-
-    # Start the search from the subdirectories of the starting directory
-    for sub_dir in os.listdir(starting_directory):
-        sub_dir_path = os.path.join(starting_directory, sub_dir)
-        if os.path.isdir(sub_dir_path):
-            search_directory(sub_dir_path)
-
-    return non_negative_dirs
+# Subdirectories of one directory and the pins set on them
+def scan_pins(directory):
+    subdirs = []
+    pinned = []
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                    pin = get_pin(entry.path)
+                    if pin != -1:
+                        pinned.append((entry.path, pin))
+    except OSError as e:
+        print(f"Skipping {directory}: {e}", file=sys.stderr)
+    return subdirs, pinned
+
+# Find pinned directories. The tree is walked a level at a time with every directory of a level
+# scanned in parallel; max_depth stops the walk early, 1 being the subdirectories of starting_directory.
+def find_non_negative_ceph_dir_pin(starting_directory, max_depth=None, num_threads=SCAN_THREADS):
+    non_negative_dirs = []
+    level = [starting_directory]
+    depth = 0
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        while level and (max_depth is None or depth < max_depth):
+            depth += 1
+            next_level = []
+            for subdirs, pinned in executor.map(scan_pins, level):
+                next_level.extend(subdirs)
+                non_negative_dirs.extend(pinned)
+            level = next_level
+    return sorted(non_negative_dirs)
 
 # Removes pin on Dirs  
 def repin_directories(non_negative_directories):
@@ -50,8 +67,8 @@ def repin_directories(non_negative_directories):
             print("No changes made.")
 
 # List pinned Dirs
-def list_dir(starting_directory):
-    non_negative_directories = find_non_negative_ceph_dir_pin(starting_directory)
+def list_dir(starting_directory, max_depth=None, num_threads=SCAN_THREADS):
+    non_negative_directories = find_non_negative_ceph_dir_pin(starting_directory, max_depth, num_threads)
     if non_negative_directories:
         print("Directories that are already pinned:")
         for directory, pin_value in non_negative_directories:
@@ -61,28 +78,150 @@ def list_dir(starting_directory):
     return (non_negative_directories)
 
 
+# Size of each top-level directory from the recursive stats the MDS keeps, plus its current pin
+def dir_stats(top_directory, num_threads=SCAN_THREADS):
+    def stat_dir(name):
+        path = os.path.join(top_directory, name)
+        stats = {'name': name, 'rbytes': 0, 'rentries': 0, 'pin': get_pin(path)}
+        for key in ('rbytes', 'rentries'):
+            try:
+                stats[key] = int(os.getxattr(path, f'ceph.dir.{key}'))
+            except (OSError, ValueError):
+                pass
+        return stats
+    with os.scandir(top_directory) as it:
+        names = sorted(entry.name for entry in it if entry.is_dir(follow_symlinks=False))
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        return list(executor.map(stat_dir, names))
+
+# Load of each directory as a share of the total: rentries (metadata, what the MDS actually
+# serves), rbytes, or the mean of both shares
+def dir_loads(dirs, metric):
+    totals = {key: sum(d[key] for d in dirs) or 1 for key in ('rbytes', 'rentries')}
+    loads = {}
+    for d in dirs:
+        if metric == 'mixed':
+            loads[d['name']] = (d['rentries'] / totals['rentries'] + d['rbytes'] / totals['rbytes']) / 2
+        else:
+            loads[d['name']] = d[metric] / totals[metric]
+    return loads
+
+# Assign every directory to one of max_mds ranks so that no rank is more than `tolerance` over an
+# even share, changing as few existing pins as possible:
+#  1. directories already pinned to a valid rank keep it, unless force is set
+#  2. the rest go largest first to the least loaded rank
+#  3. while the busiest rank is over target, move the directory that best evens it out with the
+#     least loaded rank; stop when no move lowers the peak
+# Returns {name: rank} and the projected load per rank.
+def plan_pins(dirs, max_mds, metric='rentries', tolerance=0.05, force=False):
+    # force plans every directory from scratch instead of starting from the pins already set
+    loads = dir_loads(dirs, metric)
+    assignment = {}
+    rank_load = [0.0] * max_mds
+    for d in dirs:
+        if not force and 0 <= d['pin'] < max_mds:
+            assignment[d['name']] = d['pin']
+            rank_load[d['pin']] += loads[d['name']]
+    for d in sorted(dirs, key=lambda d: loads[d['name']], reverse=True):
+        if d['name'] not in assignment:
+            rank = min(range(max_mds), key=rank_load.__getitem__)
+            assignment[d['name']] = rank
+            rank_load[rank] += loads[d['name']]
+
+    target = (1.0 + tolerance) / max_mds
+    for _ in range(len(dirs) * max_mds):
+        busiest = max(range(max_mds), key=rank_load.__getitem__)
+        idlest = min(range(max_mds), key=rank_load.__getitem__)
+        gap = rank_load[busiest] - rank_load[idlest]
+        if rank_load[busiest] <= target:
+            break
+        # a move helps only if the directory is smaller than the gap, best when it is half of it
+        candidates = [name for name, rank in assignment.items() if rank == busiest and 0 < loads[name] < gap]
+        if not candidates:
+            break
+        name = min(candidates, key=lambda name: abs(gap / 2 - loads[name]))
+        assignment[name] = idlest
+        rank_load[busiest] -= loads[name]
+        rank_load[idlest] += loads[name]
+    return assignment, rank_load
+
+# Print the pin changes and the load per rank before and after them
+def print_plan(dirs, assignment, rank_load, max_mds, metric):
+    loads = dir_loads(dirs, metric)
+    current = [0.0] * max_mds
+    unpinned = 0.0
+    for d in dirs:
+        if 0 <= d['pin'] < max_mds:
+            current[d['pin']] += loads[d['name']]
+        else:
+            unpinned += loads[d['name']]
+    changes = [(d, assignment[d['name']]) for d in dirs if d['pin'] != assignment[d['name']]]
+    for d, rank in changes:
+        print(f"{d['name']}: {d['pin']} -> {rank} ({loads[d['name']] * 100:.1f}% of {metric}, {d['rentries']} entries, {d['rbytes']} bytes)")
+    print(f"{len(changes)} of {len(dirs)} directories change pin")
+    print(f"{'rank':>6} {'current':>9} {'projected':>9}  dirs")
+    for rank in range(max_mds):
+        count = sum(1 for r in assignment.values() if r == rank)
+        print(f"{rank:>6} {current[rank] * 100:>8.1f}% {rank_load[rank] * 100:>8.1f}%  {count}")
+    if unpinned:
+        print(f"{'none':>6} {unpinned * 100:>8.1f}%")
+    return changes
+
+# Apply the planned pin changes, waiting between them for the subtrees to migrate
+def apply_pins(top_directory, changes, interval):
+    for i, (d, rank) in enumerate(changes):
+        if i:
+            time.sleep(interval)
+        print(f"Pinning {d['name']} to MDS {rank}")
+        os.setxattr(os.path.join(top_directory, d['name']), PIN_XATTR, str(rank).encode())
+
+def balance(args, max_mds, dirs):
+    assignment, rank_load = plan_pins(dirs, max_mds, args.metric, args.tolerance / 100, args.force)
+    changes = print_plan(dirs, assignment, rank_load, max_mds, args.metric)
+    if args.stats_json:
+        if changes:
+            print(f"Planned from {args.stats_json} - no pins were changed")
+        return
+    if args.dry_run:
+        if changes:
+            print("Dry run - remove the dry run flag to apply")
+        return
+    apply_pins(args.dir, changes, args.pin_interval)
+
 # Main fuction to run
 def main():
     parser = argparse.ArgumentParser(description='Shard directories and pin each to a different MDS.')
     parser.add_argument('-d', '--dir', help='The top-level directory to shard.')
     parser.add_argument('-D', '--dry-run', action='store_true', help='Run the script in dry run mode. No actions will be performed.')
-    parser.add_argument('-F', '--force', action='store_true', help='Ignore existing pins')
+    parser.add_argument('-F', '--force', action='store_true', help='Ignore existing pins, with --balance plan every directory from scratch')
     parser.add_argument('-l', '--list', action='store_true', help='Lists pinned directories')
     parser.add_argument('-r', '--remove', action='store_true', help='Remove pin on pinned directories')
     parser.add_argument('-m', '--next_mds', help='Specify the next MDS to start with')
+    parser.add_argument('--max-depth', type=int, help='Only look for pins this many levels below the top-level directory when listing or removing (default: no limit)')
+    parser.add_argument('-t', '--threads', type=int, default=SCAN_THREADS, help=f'Directories scanned in parallel when listing or removing pins (default: {SCAN_THREADS})')
+    parser.add_argument('-b', '--balance', action='store_true', help='Pin by size instead of round robin: spread the top-level directories over the MDS ranks by ceph.dir.rentries/rbytes, keeping existing pins where possible')
+    parser.add_argument('--metric', choices=['rentries', 'rbytes', 'mixed'], default='rentries', help='Directory load used by --balance (default: rentries)')
+    parser.add_argument('--tolerance', type=float, default=5.0, help='Percent a rank may be over an even share before --balance moves pins (default: 5)')
+    parser.add_argument('--pin-interval', type=float, default=1.0, help='Seconds between pin changes with --balance (default: 1)')
+    parser.add_argument('--stats-json', metavar='FILE', help='Plan --balance from a JSON file of {"max_mds": N, "dirs": [{"name", "rbytes", "rentries", "pin"}]} instead of the cluster, nothing is changed')
+    parser.add_argument('--save-stats', metavar='FILE', help='With --balance, also write the directory stats read from the cluster to FILE in the --stats-json format')
     args = parser.parse_args()
 
-    if args.dir:
+    if args.stats_json:
+        with open(args.stats_json) as f:
+            stats = json.load(f)
+        balance(args, stats['max_mds'], stats['dirs'])
+    elif args.dir:
         # wait for health ok
         while not "HEALTH_OK" in subprocess.check_output("ceph health 2>/dev/null", shell=True).decode():
             print("Waiting 10s for HEALTH_OK...")
             time.sleep(10)
         # List Pinned Directories
         if args.list and not args.remove:
-            dirs_to_repin=list_dir(args.dir)
+            dirs_to_repin=list_dir(args.dir, args.max_depth, max(args.threads, 1))
         # Removed Pins from Dirs 
         if args.remove:
-            dirs_to_repin=list_dir(args.dir)
+            dirs_to_repin=list_dir(args.dir, args.max_depth, max(args.threads, 1))
             repin_directories(dirs_to_repin)
         # get max_mds info
         fs_dump = subprocess.check_output("ceph fs dump --format json 2>/dev/null", shell=True)
@@ -103,7 +242,13 @@ def main():
         else:
             next_mds = 0
 
-        if not (args.list or args.remove):
+        if args.balance and not (args.list or args.remove):
+            stats = dir_stats(args.dir, max(args.threads, 1))
+            if args.save_stats:
+                with open(args.save_stats, 'w') as f:
+                    json.dump({'max_mds': max_mds, 'dirs': stats}, f, indent=2)
+            balance(args, max_mds, stats)
+        elif not (args.list or args.remove):
             for dir in dirs:
                 full_dir_path = os.path.join(args.dir, dir)
 
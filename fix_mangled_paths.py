@@ -4,22 +4,32 @@
 
 import os
 import argparse
+import json
 import sys
+import time
+import queue
+import threading
+from itertools import chain, count
+from concurrent.futures import ThreadPoolExecutor
 
+PROGRESS_INTERVAL = 10
+# plan entries waiting between the subtree walkers and the consumer of a parallel plan
+PLAN_QUEUE = 10000
 
-def get_unique_name(root, name, taken_paths):
+
+def get_unique_name(name, taken_names):
+    # taken_names is every name in the directory, from its listing plus names handed out
+    # so far, so no candidate needs a stat call
     i = 0
     ext_ind = name.find('.')
     new_name = name
-    new_path = os.path.join(root, new_name)
-    while new_path in taken_paths or os.path.exists(new_path):
+    while new_name in taken_names:
         i += 1
         new_name = (
             name[0:ext_ind] + f"({i})" + name[ext_ind:]
             if ext_ind != -1 else name + f"({i})"
         )
-        new_path = os.path.join(root, new_name)
-    taken_paths.append(new_path)
+    taken_names.add(new_name)
     return new_name
 
 
@@ -32,62 +42,314 @@ def legalize_name(string: str):
     return "".join(map(lambda c: c if printable(c) and windows_allowed(c) else '_', string))
 
 
-def rename_mangled(paths, dry_run, recursive):
-    taken_paths = []
-    change_count = 0
-
-    def rename_entries(root, entries, rootfd):
-        changes = []
-        nonlocal change_count
-        for src in entries:
-            dst = legalize_name(src)
-            if dst != src:
-                dst = get_unique_name(root, dst, taken_paths)
-                print('in', f"'{root.encode('unicode_escape').decode('utf-8')}':")
-                print(f"'{src.encode('unicode_escape').decode('utf-8')}'", '->')
-                print(f"'{dst.encode('unicode_escape').decode('utf-8')}'")
-                print()
-                change_count += 1
-                if dry_run:
-                    continue
+def escaped(string):
+    return string.encode('unicode_escape').decode('utf-8')
+
+
+def print_change(entry):
+    print('in', f"'{escaped(entry['dir'])}':")
+    print(f"'{escaped(entry['src'])}'", '->')
+    print(f"'{escaped(entry['dst'])}'")
+    print()
+
+
+class Progress:
+    # counters shared by the walking and renaming threads, reported every PROGRESS_INTERVAL seconds
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.dirs = 0
+        self.entries = 0
+        self.renamed = 0
+        self.started = time.monotonic()
+        self.done = threading.Event()
+
+    def scanned(self, entries):
+        with self.lock:
+            self.dirs += 1
+            self.entries += entries
+
+    def rename_done(self):
+        with self.lock:
+            self.renamed += 1
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        if self.renamed:
+            return f"{self.renamed} renamed in {elapsed:.1f}s ({self.renamed / elapsed:.0f} renames/sec)"
+        return f"{self.dirs} dirs, {self.entries} entries scanned in {elapsed:.1f}s ({self.entries / elapsed:.0f} entries/sec)"
+
+    def _run(self):
+        while not self.done.wait(PROGRESS_INTERVAL):
+            print(self.report(), file=sys.stderr)
+
+    def start(self):
+        threading.Thread(target=self._run, name='progress', daemon=True).start()
+
+    def stop(self):
+        self.done.set()
+
+
+def plan_tree(path, planned_path, progress=None, subdirs=None):
+    # One walk of the tree under path, nothing renamed: yields a plan entry per rename, in the order
+    # they have to be applied. An entry names the directory as it will be by the time the entry is
+    # applied (after the renames of its parents, planned_path being path's own), and the directory's
+    # mtime when it was listed. With subdirs, only path itself is listed and its subdirectories are
+    # appended to subdirs as (walked path, planned path) instead of being walked.
+    # walked path -> its path once the renames planned above it are applied
+    planned = {path: planned_path}
+    for root, dirs, files, rootfd in os.fwalk(path, topdown=True):
+        planned_root = planned.pop(root, root)
+        mtime_ns = os.fstat(rootfd).st_mtime_ns
+        taken_names = set(dirs)
+        taken_names.update(files)
+        if progress:
+            progress.scanned(len(taken_names))
+        if '.zfs' in dirs:
+            dirs.remove('.zfs')
+        for names, is_dir in ((dirs, True), (files, False)):
+            for src in names:
+                dst = legalize_name(src)
+                if dst != src:
+                    dst = get_unique_name(dst, taken_names)
+                    yield {'dir': planned_root, 'mtime_ns': mtime_ns, 'src': src, 'dst': dst}
+                if is_dir and (dst != src or planned_root != root or subdirs is not None):
+                    planned[os.path.join(root, src)] = os.path.join(planned_root, dst)
+        if subdirs is not None:
+            subdirs.extend((os.path.join(root, d), planned.pop(os.path.join(root, d))) for d in dirs)
+            dirs.clear()
+
+
+def plan_top(path, taken=None):
+    # The rename of a path given on the command line itself. taken maps each parent directory to
+    # its names, listed once and shared by every path given in it, so two paths that legalize to
+    # the same name get distinct ones.
+    if taken is None:
+        taken = {}
+    root = os.path.dirname(path)
+    src = os.path.basename(path)
+    dst = legalize_name(src)
+    if dst != src:
+        taken_names = taken.get(root)
+        if taken_names is None:
+            taken_names = taken[root] = set(os.listdir(root))
+        dst = get_unique_name(dst, taken_names)
+        yield {'dir': root, 'mtime_ns': os.stat(root).st_mtime_ns, 'src': src, 'dst': dst}
+
+
+def plan_subtrees(subdirs, jobs, progress, subtree_ids):
+    # The entries of independent subtrees walked on jobs threads, yielded as the walkers produce
+    # them, each tagged with its subtree. The queue between them is bounded, so a slow consumer
+    # holds the walkers back instead of whole subtree plans piling up in memory.
+    results = queue.Queue(maxsize=PLAN_QUEUE)
+    stop = threading.Event()
+
+    def walk(subtree, subdir):
+        try:
+            for entry in plan_tree(subdir[0], subdir[1], progress):
+                if stop.is_set():
+                    break
+                entry['subtree'] = subtree
+                results.put(entry)
+        finally:
+            results.put(None)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(walk, next(subtree_ids), subdir) for subdir in subdirs]
+        try:
+            remaining = len(futures)
+            while remaining:
+                entry = results.get()
+                if entry is None:
+                    remaining -= 1
+                else:
+                    yield entry
+        finally:
+            # unblock walkers still waiting on a full queue if the consumer stopped early
+            stop.set()
+            while not all(future.done() for future in futures):
                 try:
-                    os.rename(src, dst, src_dir_fd=rootfd, dst_dir_fd=rootfd)
-                    changes.append((src, dst))
-                except OSError as e:
-                    print('failed to rename file:', e)
-        for src, dst in changes:
-            entries.remove(src)
-            entries.append(dst)
+                    results.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+        for future in futures:
+            future.result()
+
+
+def plan_mangled(paths, recursive, jobs=1, progress=None):
+    # With jobs > 1 the subdirectories of each path are walked in parallel. Every directory is
+    # still listed and legalized by exactly one thread, so collisions are resolved as before.
+    # Entries are then tagged with 'subtree': 0 for the entries of the path itself, which are
+    # applied first, a number per independent subtree, and -1 for the path's own rename, last.
+    subtree_ids = count(1)
+    taken = {}
     for path in paths:
+        path = os.path.abspath(path)
         if os.path.isdir(path) and recursive:
-            for root, dirs, files, rootfd in os.fwalk(path, topdown=True):
-                if '.zfs' in dirs:
-                    dirs.remove('.zfs')
-                rename_entries(root, dirs, rootfd)
-                rename_entries(root, files, rootfd)
-        if os.path.exists(path):
-            fullpath = os.path.realpath(path)
-            root = os.path.dirname(fullpath)
-            entries = [os.path.basename(fullpath)]
-            rootfd = os.open(root, os.O_RDONLY)
-            rename_entries(root, entries, rootfd)
-    return change_count
+            if jobs > 1:
+                subdirs = []
+                for entry in plan_tree(path, path, progress, subdirs):
+                    entry['subtree'] = 0
+                    yield entry
+                yield from plan_subtrees(subdirs, jobs, progress, subtree_ids)
+            else:
+                yield from plan_tree(path, path, progress)
+        if os.path.lexists(path):
+            for entry in plan_top(path, taken):
+                if jobs > 1:
+                    entry['subtree'] = -1
+                yield entry
+
+
+def apply_plan(entries, progress=None):
+    # Renames relative to an fd of each directory. A directory whose mtime no longer matches the
+    # plan was changed since it was listed, so its entries are skipped rather than trusted.
+    # Returns (renamed, skipped).
+    renamed = skipped = 0
+    checked = set()
+    stale = set()
+    current, dirfd = None, None
+    try:
+        for entry in entries:
+            directory = entry['dir']
+            if directory in stale:
+                skipped += 1
+                continue
+            if directory != current:
+                if dirfd is not None:
+                    os.close(dirfd)
+                    current, dirfd = None, None
+                try:
+                    dirfd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+                except OSError as e:
+                    print(f"skipping '{escaped(directory)}':", e)
+                    stale.add(directory)
+                    skipped += 1
+                    continue
+                current = directory
+                # only the first visit is checked, the plan's own renames change the mtime after that
+                if directory not in checked:
+                    checked.add(directory)
+                    if os.fstat(dirfd).st_mtime_ns != entry['mtime_ns']:
+                        print(f"skipping '{escaped(directory)}': changed since the plan was made")
+                        stale.add(directory)
+                        skipped += 1
+                        continue
+            src, dst = entry['src'], entry['dst']
+            try:
+                os.lstat(dst, dir_fd=dirfd)
+                print(f"skipping '{escaped(src)}' in '{escaped(directory)}': '{escaped(dst)}' already exists")
+                skipped += 1
+                continue
+            except FileNotFoundError:
+                pass
+            try:
+                os.rename(src, dst, src_dir_fd=dirfd, dst_dir_fd=dirfd)
+                renamed += 1
+                if progress:
+                    progress.rename_done()
+            except OSError as e:
+                print('failed to rename file:', e)
+                skipped += 1
+    finally:
+        if dirfd is not None:
+            os.close(dirfd)
+    return renamed, skipped
+
+
+def apply_plan_parallel(entries, jobs, progress=None):
+    # Entries of a plan made with jobs > 1: the top-level directories first, then the independent
+    # subtrees on a pool of jobs threads, each in plan order, then the renames of the paths given.
+    # With one job, or a plan made with one, the entries are streamed to apply_plan in order and
+    # the plan is never held in memory.
+    if jobs <= 1:
+        return apply_plan(entries, progress)
+    entries = iter(entries)
+    head = next(entries, None)
+    if head is None:
+        return 0, 0
+    if 'subtree' not in head:
+        return apply_plan(chain([head], entries), progress)
+    first, last = [], []
+    subtrees = {}
+    for entry in chain([head], entries):
+        if entry['subtree'] == 0:
+            first.append(entry)
+        elif entry['subtree'] < 0:
+            last.append(entry)
+        else:
+            subtrees.setdefault(entry['subtree'], []).append(entry)
+    renamed, skipped = apply_plan(first, progress)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for r, s in executor.map(lambda group: apply_plan(group, progress), subtrees.values()):
+            renamed += r
+            skipped += s
+    r, s = apply_plan(last, progress)
+    return renamed + r, skipped + s
+
+
+def write_plan(entries, plan_file):
+    count = 0
+    with open(plan_file, 'w') as f:
+        for entry in entries:
+            print_change(entry)
+            f.write(json.dumps(entry) + '\n')
+            count += 1
+    return count
+
+
+def read_plan(plan_file):
+    with open(plan_file) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
 
 
 def main():
     parser = argparse.ArgumentParser(
         description='Rename files and directories to play nice with Windows')
-    parser.add_argument('roots', type=str, nargs='+', metavar='PATH',
+    parser.add_argument('roots', type=str, nargs='*', metavar='PATH',
                         help='Path(s) to rename')
     parser.add_argument('-r', '--recursive', action='store_true', default=False, help='Recurse into directories')
+    parser.add_argument('-p', '--plan', metavar='FILE', help='Only write the renames to FILE as JSON lines, to be applied later with --apply')
+    parser.add_argument('-a', '--apply', metavar='FILE', help='Apply a plan written by --plan without walking the tree again')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Walk and rename the subdirectories of each PATH on this many threads, for shares where per-entry latency dominates (default: 1)')
     args = parser.parse_args()
-    mangled_count = rename_mangled(args.roots, True, args.recursive)  # dry run
-    print(f"Found {mangled_count} invalid paths")
-    if mangled_count == 0:
-        sys.exit()
-    response = input("Are the above changes okay? [y/N]: ")
-    if response.upper() in ['Y', 'YES']:
-        rename_mangled(args.roots, False, args.recursive)  # really rename
+    jobs = max(args.jobs, 1)
+    progress = Progress()
+    progress.start()
+
+    try:
+        if args.apply:
+            renamed, skipped = apply_plan_parallel(read_plan(args.apply), jobs, progress)
+            print(f"Renamed {renamed} paths, skipped {skipped}")
+            print(progress.report(), file=sys.stderr)
+            sys.exit(1 if skipped else 0)
+        if not args.roots:
+            parser.error('at least one PATH is required unless --apply is given')
+        if args.plan:
+            print(f"Wrote {write_plan(plan_mangled(args.roots, args.recursive, jobs, progress), args.plan)} renames to {args.plan}")
+            print(progress.report(), file=sys.stderr)
+            return
+
+        plan = []
+        for entry in plan_mangled(args.roots, args.recursive, jobs, progress):
+            print_change(entry)
+            plan.append(entry)
+        print(f"Found {len(plan)} invalid paths")
+        print(progress.report(), file=sys.stderr)
+        if not plan:
+            sys.exit()
+        response = input("Are the above changes okay? [y/N]: ")
+        if response.upper() in ['Y', 'YES']:
+            progress.stop()
+            progress = Progress()
+            progress.start()
+            renamed, skipped = apply_plan_parallel(plan, jobs, progress)
+            if skipped:
+                print(f"Renamed {renamed} paths, skipped {skipped}")
+            print(progress.report(), file=sys.stderr)
+    finally:
+        progress.stop()
 
 
 if __name__ == '__main__':
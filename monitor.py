@@ -1,109 +1,689 @@
 #2024 Mitch Hall 45Drives
-# Monitoring script. This script will run for 10 minutes and then kill itself. It is meant to be used
+# Monitoring script. This script will run for 10 minutes and then stop. It is meant to be used
 # in conjunction with crontab. Recommend running it at the top of every hour. It will run for 10 minutes and complete
 # The script will monitor CPU load average, numastats, memory usage, and disk IO stats over time
 # The script will spawn several log files in /var/log - load_average.log, disk_io.log, numa_stats.log
 # and memory_usage.log
+#
+# Everything is sampled by one process on a shared tick: the /proc and /sys files are kept open and
+# re-read in place, and the logs stay open with buffered writes flushed every few seconds, so the
+# monitor itself stays out of the numbers it is recording. monitor_bench.py compares its CPU time
+# with the old one-process-per-metric version.
+#
+# With --daemon it runs until stopped instead, keeping only the last few minutes of samples in
+# memory, and serves the latest values and rolling min/avg/max over them on an HTTP /metrics
+# endpoint (--listen) and/or in a node_exporter textfile (--textfile) like node_exporter_collectors.
 
-
-import psutil
-import subprocess
+import os
+import sys
+import re
+import glob
 import time
-from datetime import datetime
-import multiprocessing
+import mmap
+import struct
 import signal
-import sys
+import argparse
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime
+from itertools import chain
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+LOG_DIR = '/var/log'
+SECTOR_SIZE = 512
+# the column header is repeated every this many lines
+HEADER_EVERY = 60
+FLUSH_INTERVAL = 10
+TIMESTAMP_FORMAT = '%a %b %d %I:%M:%S %p %Z %Y'
+MIN_INTERVAL = 0.1
+# samples kept per metric by the ring format before the oldest are overwritten
+RING_SLOTS = 86400
+RING_MAGIC = b'45DRING1'
+# magic, version, columns, slots, records written, header size, record size, length of column names
+RING_HEADER = struct.Struct('<8sIIQQIII')
+RING_HEAD_OFFSET = 24
+# block devices left out of disk_rates.log unless --disks names them
+DISK_EXCLUDE = r'^(loop|ram|zram|sr|fd)\d'
+# daemon mode: seconds of samples summarised as min/avg/max, prefix of the exported metric names
+WINDOWS = [60, 300]
+METRIC_PREFIX = 'monitor'
+TEXTFILE = '/var/lib/node_exporter/monitor.prom'
+TEXTFILE_INTERVAL = 15
 
 # Convert bytes to GiB
 def bytes_to_gib(bytes):
     return bytes / (1024 ** 3)
 
-def log_numa_stats(stop_event):
-    while not stop_event.is_set():
-        with open('/var/log/numa_stats.log', 'a') as f:
-            f.write(subprocess.getoutput('numastat -v'))
-        time.sleep(1)
-
-def log_memory_usage(stop_event):
-    header = "timestamp,total_memory,available_memory,used_memory,free_memory\n"
-    line_count = 0
-    while not stop_event.is_set():
-        if line_count % 60 == 0:
-            with open('/var/log/memory_usage.log', 'a') as f:
-                f.write(header)
-        mem = psutil.virtual_memory()
-        timestamp = datetime.now().strftime('%a %b %d %I:%M:%S %p %Z %Y')
-        with open('/var/log/memory_usage.log', 'a') as f:
-            f.write(f"{timestamp},{mem.total},{mem.available},{mem.used},{mem.free}\n")
-        line_count += 1
-        time.sleep(1)
-
-def log_disk_io(stop_event):
-    header = "timestamp,read_count,write_count,read_gib,write_gib\n"
-    line_count = 0
-    while not stop_event.is_set():
-        if line_count % 60 == 0:
-            with open('/var/log/disk_io.log', 'a') as f:
-                f.write(header)
-        io = psutil.disk_io_counters()
-        read_gib = bytes_to_gib(io.read_bytes)
-        write_gib = bytes_to_gib(io.write_bytes)
-        timestamp = datetime.now().strftime('%a %b %d %I:%M:%S %p %Z %Y')
-        with open('/var/log/disk_io.log', 'a') as f:
-            f.write(f"{timestamp},{io.read_count},{io.write_count},{read_gib:.6f},{write_gib:.6f}\n")
-        line_count += 1
-        time.sleep(1)
-
-def log_load_average(stop_event):
-    header = "timestamp,load1,load5,load15\n"
-    line_count = 0
-    while not stop_event.is_set():
-        if line_count % 60 == 0:
-            with open('/var/log/load_average.log', 'a') as f:
-                f.write(header)
-        with open('/proc/loadavg', 'r') as f:
-            load_avg = f.read().strip().split()[:3]
-        timestamp = datetime.now().strftime('%a %b %d %I:%M:%S %p %Z %Y')
-        with open('/var/log/load_average.log', 'a') as f:
-            f.write(f"{timestamp},{load_avg[0]},{load_avg[1]},{load_avg[2]}\n")
-        line_count += 1
-        time.sleep(1)
-
-def terminate_after_timeout(timeout, stop_event):
-    time.sleep(timeout)
-    stop_event.set()
-
-def handle_interrupt(signum, frame, stop_event):
-    stop_event.set()
-    sys.exit(0)
+class ProcFile:
+    # A /proc or /sys file opened once and read again from offset 0 on every sample
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
 
-def start_logging():
-    stop_event = multiprocessing.Event()
+    def read(self):
+        data = os.pread(self.fd, 65536, 0)
+        if len(data) < 65536:
+            return data
+        chunks = [data]
+        while len(data) == 65536:
+            data = os.pread(self.fd, 65536, 65536 * len(chunks))
+            chunks.append(data)
+        return b''.join(chunks)
+
+    def close(self):
+        os.close(self.fd)
+
+class LoadAverage:
+    name = 'load_average'
+    columns = ['load1', 'load5', 'load15']
+    formats = ['{}', '{}', '{}']
+
+    def __init__(self):
+        self.file = ProcFile('/proc/loadavg')
+
+    def sample(self):
+        return [float(v) for v in self.file.read().split()[:3]]
+
+class MemoryUsage:
+    # used is computed the way psutil.virtual_memory() does it on Linux
+    name = 'memory_usage'
+    columns = ['total_memory', 'available_memory', 'used_memory', 'free_memory']
+    formats = ['{}', '{}', '{}', '{}']
+    FIELDS = (b'MemTotal:', b'MemFree:', b'MemAvailable:', b'Buffers:', b'Cached:', b'SReclaimable:')
+
+    def __init__(self):
+        self.file = ProcFile('/proc/meminfo')
+
+    def sample(self):
+        mem = {}
+        for line in self.file.read().splitlines():
+            key, value = line.split(None, 2)[:2]
+            if key in self.FIELDS:
+                mem[key] = int(value) * 1024
+        total = mem[b'MemTotal:']
+        free = mem[b'MemFree:']
+        used = total - free - mem.get(b'Buffers:', 0) - mem.get(b'Cached:', 0) - mem.get(b'SReclaimable:', 0)
+        if used < 0:
+            used = total - free
+        return [total, mem.get(b'MemAvailable:', free), used, free]
+
+class DiskIO:
+    # totals over whole disks (not partitions), like psutil.disk_io_counters()
+    name = 'disk_io'
+    columns = ['read_count', 'write_count', 'read_gib', 'write_gib']
+    formats = ['{}', '{}', '{:.6f}', '{:.6f}']
+
+    def __init__(self):
+        self.file = ProcFile('/proc/diskstats')
+        self.disks = set(os.listdir('/sys/block'))
+
+    def sample(self):
+        reads = writes = read_sectors = write_sectors = 0
+        for line in self.file.read().splitlines():
+            fields = line.split()
+            if fields[2].decode() not in self.disks:
+                continue
+            reads += int(fields[3])
+            read_sectors += int(fields[5])
+            writes += int(fields[7])
+            write_sectors += int(fields[9])
+        return [reads, writes, bytes_to_gib(read_sectors * SECTOR_SIZE), bytes_to_gib(write_sectors * SECTOR_SIZE)]
+
+class DiskRates:
+    # Per-device rates between two samples of /proc/diskstats: IOPS, MB/s, average read and write
+    # latency (time spent per completed IO), average queue size (weighted time in queue) and
+    # utilization (io_ticks). Counters and results live in arrays allocated once, laid out as
+    # STATS-sized groups per device, so a sample is one parse and one pass of subtractions however
+    # many drives there are. The returned list is reused by the next sample. The first sample only
+    # reads the baseline counters and returns None, so no row covers the few milliseconds between
+    # opening the metrics and the first tick.
+    name = 'disk_rates'
+    # reads, sectors read, ms reading, writes, sectors written, ms writing, io_ticks, weighted ms
+    FIELDS = (3, 5, 6, 7, 9, 10, 12, 13)
+    STATS = ['r_iops', 'w_iops', 'r_mbps', 'w_mbps', 'r_await_ms', 'w_await_ms', 'aqu_sz', 'util_pct']
+    STAT_FORMATS = ['{:.1f}', '{:.1f}', '{:.3f}', '{:.3f}', '{:.2f}', '{:.2f}', '{:.2f}', '{:.1f}']
+
+    def __init__(self, pattern=None):
+        self.file = ProcFile('/proc/diskstats')
+        if pattern:
+            include = re.compile(pattern)
+            disks = [d for d in os.listdir('/sys/block') if include.search(d)]
+        else:
+            exclude = re.compile(DISK_EXCLUDE)
+            disks = [d for d in os.listdir('/sys/block') if not exclude.match(d)]
+        if not disks:
+            raise OSError('no block devices to report')
+        disks.sort()
+        width = len(self.STATS)
+        self.disks = disks
+        self.index = {d.encode(): i * width for i, d in enumerate(disks)}
+        self.prev = [0] * (width * len(disks))
+        self.cur = [0] * (width * len(disks))
+        self.values = [0.0] * (width * len(disks))
+        self.columns = [f"{d}_{stat}" for d in disks for stat in self.STATS]
+        self.series = [(f"{self.name}_{stat}", (('device', d),)) for d in disks for stat in self.STATS]
+        self.formats = self.STAT_FORMATS * len(disks)
+        self.prev_time = None
+
+    def _read(self, counters):
+        index = self.index
+        fields_at = self.FIELDS
+        for line in self.file.read().splitlines():
+            fields = line.split()
+            base = index.get(fields[2])
+            if base is None:
+                continue
+            for i, field in enumerate(fields_at):
+                counters[base + i] = int(fields[field])
+
+    def sample(self):
+        now = time.monotonic()
+        if self.prev_time is None:
+            self._read(self.prev)
+            self.prev_time = now
+            return None
+        cur, prev, out = self.cur, self.prev, self.values
+        self._read(cur)
+        elapsed = max(now - self.prev_time, 1e-6)
+        elapsed_ms = elapsed * 1000
+        mb = SECTOR_SIZE / 1e6
+        for base in range(0, len(cur), len(self.STATS)):
+            # a counter that went backwards wrapped or was reset, count the interval as idle
+            reads = max(cur[base] - prev[base], 0)
+            writes = max(cur[base + 3] - prev[base + 3], 0)
+            out[base] = reads / elapsed
+            out[base + 1] = writes / elapsed
+            out[base + 2] = max(cur[base + 1] - prev[base + 1], 0) * mb / elapsed
+            out[base + 3] = max(cur[base + 4] - prev[base + 4], 0) * mb / elapsed
+            out[base + 4] = max(cur[base + 2] - prev[base + 2], 0) / reads if reads else 0.0
+            out[base + 5] = max(cur[base + 5] - prev[base + 5], 0) / writes if writes else 0.0
+            out[base + 6] = max(cur[base + 7] - prev[base + 7], 0) / elapsed_ms
+            out[base + 7] = min(max(cur[base + 6] - prev[base + 6], 0) / elapsed_ms, 1.0) * 100
+        self.prev, self.cur = cur, prev
+        self.prev_time = now
+        return out
+
+class NumaStats:
+    # the per-node counters numastat reports, in pages, read straight from sysfs
+    name = 'numa_stats'
+
+    def __init__(self):
+        self.files = []
+        self.columns = []
+        self.series = []
+        paths = glob.glob('/sys/devices/system/node/node*/numastat')
+        for path in sorted(paths, key=lambda p: int(os.path.basename(os.path.dirname(p))[4:])):
+            node = os.path.basename(os.path.dirname(path))
+            f = ProcFile(path)
+            self.files.append(f)
+            fields = [line.split()[0].decode() for line in f.read().splitlines()]
+            self.columns += [f"{node}_{field}" for field in fields]
+            self.series += [(f"{self.name}_{field}", (('node', node),)) for field in fields]
+        if not self.files:
+            raise OSError('no NUMA nodes in /sys/devices/system/node')
+        self.formats = ['{}'] * len(self.columns)
+
+    def sample(self):
+        values = []
+        for f in self.files:
+            values += [int(line.split()[1]) for line in f.read().splitlines()]
+        return values
+
+class Timestamps:
+    # The text timestamp of the CSV logs, strftime once per second at most. Below one sample a
+    # second the timestamps carry milliseconds.
+    def __init__(self, subsecond=False):
+        self.subsecond = subsecond
+        self._second = None
+        self._timestamp = None
+
+    def format(self, now):
+        second = int(now)
+        if second != self._second:
+            self._second = second
+            stamp = datetime.fromtimestamp(second).astimezone()
+            if self.subsecond:
+                self._timestamp = (stamp.strftime('%a %b %d %I:%M:%S') + '.{:03d}' + stamp.strftime(' %p %Z %Y'))
+            else:
+                self._timestamp = stamp.strftime(TIMESTAMP_FORMAT)
+        if self.subsecond:
+            return self._timestamp.format(int((now - second) * 1000))
+        return self._timestamp
+
+class CsvLog:
+    # One log file kept open for the whole run, written through a buffer and flushed by the monitor
+    text = True
+
+    def __init__(self, path, columns, formats):
+        self.file = open(path, 'a', buffering=64 * 1024)
+        self.header = 'timestamp,' + ','.join(columns) + '\n'
+        self.line = '{},' + ','.join(formats) + '\n'
+        self.line_count = 0
+
+    def write(self, timestamp_ns, timestamp, values):
+        if self.line_count % HEADER_EVERY == 0:
+            self.file.write(self.header)
+        self.file.write(self.line.format(timestamp, *values))
+        self.line_count += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class RingLog:
+    # Fixed-width binary time series in a memory-mapped file of `slots` records, the oldest
+    # overwritten once it is full. A record is the epoch-nanosecond timestamp as int64 followed by
+    # one float64 per column, little-endian. The header holds the column names and the count of
+    # records ever written, which is updated after each record so a reader never sees a record
+    # counted before it is complete. An existing file with the same columns and size is continued.
+    text = False
+
+    def __init__(self, path, columns, slots=RING_SLOTS):
+        names = '\n'.join(columns).encode()
+        self.record = struct.Struct(f'<q{len(columns)}d')
+        self.header_size = -(-(RING_HEADER.size + len(names)) // mmap.PAGESIZE) * mmap.PAGESIZE
+        self.slots = slots
+        size = self.header_size + slots * self.record.size
+        self.head = None
+        if os.path.exists(path):
+            try:
+                ring = read_ring_header(path)
+                if ring['columns'] == list(columns) and ring['slots'] == slots:
+                    self.head = ring['head']
+            except ValueError:
+                pass
+            if self.head is None:
+                print(f"{path} has a different layout, moved to {path}.old", file=sys.stderr)
+                os.replace(path, path + '.old')
+        if self.head is None:
+            with open(path, 'wb') as f:
+                f.truncate(size)
+                f.write(RING_HEADER.pack(RING_MAGIC, 1, len(columns), slots, 0, self.header_size, self.record.size, len(names)) + names)
+            self.head = 0
+        self.file = open(path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), size)
 
-    # Handle SIGINT to gracefully exit
-    signal.signal(signal.SIGINT, lambda s, f: handle_interrupt(s, f, stop_event))
+    def write(self, timestamp_ns, timestamp, values):
+        offset = self.header_size + (self.head % self.slots) * self.record.size
+        self.record.pack_into(self.map, offset, timestamp_ns, *values)
+        self.head += 1
+        struct.pack_into('<Q', self.map, RING_HEAD_OFFSET, self.head)
 
-    processes = [
-        multiprocessing.Process(target=log_numa_stats, args=(stop_event,)),
-        multiprocessing.Process(target=log_memory_usage, args=(stop_event,)),
-        multiprocessing.Process(target=log_disk_io, args=(stop_event,)),
-        multiprocessing.Process(target=log_load_average, args=(stop_event,)),
-        multiprocessing.Process(target=terminate_after_timeout, args=(600, stop_event))  # 10 minutes
-    ]
+    def flush(self):
+        self.map.flush()
 
-    for p in processes:
-        p.start()
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.file.close()
 
-    for p in processes:
+def read_ring_header(path):
+    with open(path, 'rb') as f:
+        raw = f.read(RING_HEADER.size)
+        if len(raw) < RING_HEADER.size:
+            raise ValueError(f"{path} is not a monitor ring file")
+        magic, version, ncols, slots, head, header_size, record_size, names_len = RING_HEADER.unpack(raw)
+        if magic != RING_MAGIC or version != 1:
+            raise ValueError(f"{path} is not a monitor ring file")
+        columns = f.read(names_len).decode().split('\n') if ncols else []
+    return {'columns': columns, 'slots': slots, 'head': head, 'header_size': header_size, 'record_size': record_size}
+
+def _ring_order(ring):
+    # slot numbers of the stored records, oldest first
+    head, slots = ring['head'], ring['slots']
+    if head <= slots:
+        return range(head)
+    start = head % slots
+    return list(range(start, slots)) + list(range(start))
+
+def iter_ring(path, start=None, end=None):
+    # (timestamp_ns, values) of the records with start <= timestamp_ns < end, oldest first,
+    # without numpy
+    ring = read_ring_header(path)
+    record = struct.Struct(f"<q{len(ring['columns'])}d")
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
         try:
-            p.join()
-        except KeyboardInterrupt:
-            stop_event.set()
-            for p in processes:
-                p.join()
-            print("\nScript terminated gracefully.")
-            break
+            for slot in _ring_order(ring):
+                fields = record.unpack_from(data, ring['header_size'] + slot * ring['record_size'])
+                if (start is None or fields[0] >= start) and (end is None or fields[0] < end):
+                    yield fields[0], fields[1:]
+        finally:
+            data.close()
+
+def load_ring(path, start=None, end=None):
+    # Reader API: (columns, timestamps, values) for start <= timestamp_ns < end, oldest first, as
+    # an int64 array of epoch nanoseconds and a float64 array with one column per metric. The
+    # records are viewed straight from the file, no text is parsed. Needs numpy.
+    if np is None:
+        raise RuntimeError('load_ring needs numpy, use iter_ring without it')
+    ring = read_ring_header(path)
+    columns = ring['columns']
+    dtype = np.dtype([('ts', '<i8'), ('values', '<f8', (len(columns),))])
+    records = np.memmap(path, dtype=dtype, mode='r', offset=ring['header_size'], shape=(ring['slots'],))
+    head, slots = ring['head'], ring['slots']
+    if head <= slots:
+        records = records[:head]
+    else:
+        split = head % slots
+        records = np.concatenate((records[split:], records[:split]))
+    keep = np.ones(len(records), dtype=bool)
+    if start is not None:
+        keep &= records['ts'] >= start
+    if end is not None:
+        keep &= records['ts'] < end
+    records = records[keep]
+    return columns, np.array(records['ts']), np.array(records['values'])
+
+def ring_to_csv(path, out, start=None, end=None):
+    # the CSV monitor.py would have written, header once, timestamps with milliseconds only if the
+    # samples are less than a second apart
+    ring = read_ring_header(path)
+    out.write('timestamp,' + ','.join(ring['columns']) + '\n')
+    rows = iter_ring(path, start, end)
+    first = next(rows, None)
+    if first is None:
+        return 0
+    second = next(rows, None)
+    timestamps = Timestamps(second is not None and second[0] - first[0] < 1e9)
+    count = 0
+    for ts, values in chain([first], [second] if second else [], rows):
+        out.write(timestamps.format(ts / 1e9) + ',' + ','.join(f"{v:.15g}" for v in values) + '\n')
+        count += 1
+    return count
+
+def open_metrics(disks=None):
+    metrics = []
+    for metric, args in ((NumaStats, ()), (MemoryUsage, ()), (DiskIO, ()), (DiskRates, (disks,)), (LoadAverage, ())):
+        try:
+            metrics.append(metric(*args))
+        except OSError as e:
+            print(f"Not logging {metric.__name__}: {e}", file=sys.stderr)
+    return metrics
+
+def metric_series(metric):
+    # (name, labels) of each column as a Prometheus series, the column name unless the metric
+    # splits its columns by device or node
+    return getattr(metric, 'series', None) or [(f"{metric.name}_{c}", ()) for c in metric.columns]
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + '}'
+
+class Rolling:
+    # The samples of the longest window for every metric, in deques sized once from the interval so
+    # a daemon that runs for months holds as much as one that just started. Each sample is copied,
+    # DiskRates reuses its list. render() writes the Prometheus text format: every column's latest
+    # value, then its min, avg and max over each window labelled window="<seconds>s".
+    def __init__(self, metrics, interval, windows=WINDOWS):
+        self.metrics = metrics
+        self.windows = [(w, max(int(round(w / interval)), 1)) for w in sorted(windows)]
+        size = self.windows[-1][1]
+        self.samples = [deque(maxlen=size) for _ in metrics]
+        self.lock = threading.Lock()
+        self.updated_ns = 0
+        self.families = []
+        for metric in metrics:
+            families = {}
+            for i, (name, labels) in enumerate(metric_series(metric)):
+                families.setdefault(re.sub(r'[^a-zA-Z0-9_]', '_', f"{METRIC_PREFIX}_{name}"), []).append((labels, i))
+            self.families.append(families)
+
+    def observe(self, now_ns, values):
+        with self.lock:
+            for samples, v in zip(self.samples, values):
+                if v is not None:
+                    samples.append(tuple(v))
+            self.updated_ns = now_ns
+
+    def render(self, monitor=None):
+        with self.lock:
+            snapshot = [list(s) for s in self.samples]
+            updated_ns = self.updated_ns
+        out = []
+        for metric, families, samples in zip(self.metrics, self.families, snapshot):
+            if not samples:
+                continue
+            latest = samples[-1]
+            # per window: (window label, mins, avgs, maxes) by column
+            stats = []
+            for window, n in self.windows:
+                columns = list(zip(*samples[-n:]))
+                stats.append((('window', f"{window:g}s"),
+                              [min(c) for c in columns], [sum(c) / len(c) for c in columns], [max(c) for c in columns]))
+            for name, series in families.items():
+                out.append(f"# HELP {name} Latest {metric.name} sample from monitor.py.")
+                out.append(f"# TYPE {name} gauge")
+                for labels, i in series:
+                    out.append(f"{name}{_labels(labels)} {latest[i]:.15g}")
+                for pos, stat in ((1, 'min'), (2, 'avg'), (3, 'max')):
+                    out.append(f"# HELP {name}_{stat} {stat.capitalize()} of the {metric.name} samples over the window.")
+                    out.append(f"# TYPE {name}_{stat} gauge")
+                    for window in stats:
+                        for labels, i in series:
+                            out.append(f"{name}_{stat}{_labels(labels + (window[0],))} {window[pos][i]:.15g}")
+        if updated_ns:
+            out.append(f"# HELP {METRIC_PREFIX}_last_sample_timestamp_seconds Time of the latest sample.")
+            out.append(f"# TYPE {METRIC_PREFIX}_last_sample_timestamp_seconds gauge")
+            out.append(f"{METRIC_PREFIX}_last_sample_timestamp_seconds {updated_ns / 1e9:.3f}")
+        if monitor is not None:
+            out.append(f"# HELP {METRIC_PREFIX}_samples_total Samples taken since monitor.py started.")
+            out.append(f"# TYPE {METRIC_PREFIX}_samples_total counter")
+            out.append(f"{METRIC_PREFIX}_samples_total {monitor.samples}")
+            out.append(f"# HELP {METRIC_PREFIX}_dropped_samples_total Ticks skipped because sampling took longer than the interval.")
+            out.append(f"# TYPE {METRIC_PREFIX}_dropped_samples_total counter")
+            out.append(f"{METRIC_PREFIX}_dropped_samples_total {monitor.dropped}")
+        return '\n'.join(out) + '\n'
+
+class Textfile(threading.Thread):
+    # Writes render() to a node_exporter textfile every `interval` seconds from its own thread, as
+    # /metrics does, so rendering long windows over many disks never delays a tick. The text goes
+    # to a temporary name in the same directory and is renamed over the file, so the collector
+    # never reads half of it. stop() writes it one last time.
+    def __init__(self, path, rolling, monitor, interval=TEXTFILE_INTERVAL):
+        super().__init__(name='monitor-textfile', daemon=True)
+        self.path = path
+        self.rolling = rolling
+        self.monitor = monitor
+        self.interval = interval
+        self.stopping = threading.Event()
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            self.write()
+
+    def stop(self):
+        self.stopping.set()
+        if self.is_alive():
+            self.join()
+        self.write()
+
+    def write(self):
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, 'w') as f:
+                f.write(self.rolling.render(self.monitor))
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"Failed to write {self.path}: {e}", file=sys.stderr)
+
+def serve_metrics(address, rolling, monitor):
+    # /metrics on a background thread, scrapes only read the Rolling snapshot
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = rolling.render(monitor).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(address, Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='monitor-metrics', daemon=True).start()
+    return server
+
+def parse_listen(value):
+    # [ADDR:]PORT
+    host, _, port = value.rpartition(':')
+    try:
+        return host.strip('[]'), int(port)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected [ADDR:]PORT, got {value!r}")
+
+class Monitor:
+    # Samples every metric on one tick. Tick n is due at start + n * interval, so the schedule
+    # does not drift with the time spent sampling; ticks that are already past are skipped and
+    # counted instead of being bunched up.
+    def __init__(self, metrics, logs, interval=1.0, flush_interval=FLUSH_INTERVAL, observers=()):
+        # observers get every sample of all metrics at once, after the logs
+        self.metrics = metrics
+        self.logs = logs
+        self.observers = list(observers)
+        self.interval = interval
+        self.flush_interval = flush_interval
+        self.stop_event = threading.Event()
+        self.samples = 0
+        self.dropped = 0
+        self.timestamps = Timestamps(interval < 1)
+        self.text = any(log.text for log in logs)
+
+    def sample(self):
+        now_ns = time.time_ns()
+        stamp = self.timestamps.format(now_ns / 1e9) if self.text else None
+        # a metric with nothing to report yet returns None and is left out of this tick
+        values = [metric.sample() for metric in self.metrics]
+        for log, v in zip(self.logs, values):
+            if v is not None:
+                log.write(now_ns, stamp, v)
+        for observer in self.observers:
+            observer.observe(now_ns, values)
+        self.samples += 1
+
+    def flush(self):
+        for log in self.logs:
+            log.flush()
+
+    def run(self, duration=None):
+        start = time.monotonic()
+        end = start + duration if duration else None
+        next_flush = start + self.flush_interval
+        tick = 0
+        try:
+            while not self.stop_event.is_set():
+                self.sample()
+                now = time.monotonic()
+                if now >= next_flush:
+                    self.flush()
+                    next_flush = now + self.flush_interval
+                tick += 1
+                due = start + tick * self.interval
+                if due < now:
+                    missed = int((now - due) / self.interval) + 1
+                    self.dropped += missed
+                    tick += missed
+                    due = start + tick * self.interval
+                if end is not None and due >= end:
+                    break
+                self.stop_event.wait(due - now)
+        finally:
+            self.flush()
+
+    def stop(self):
+        self.stop_event.set()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Log load average, memory usage, disk IO and NUMA stats over time.')
+    parser.add_argument('-t', '--duration', type=float, default=600, help='Seconds to run for, 0 to run until interrupted (default: 600)')
+    parser.add_argument('-i', '--interval', type=float, default=1.0, help=f'Seconds between samples, down to {MIN_INTERVAL} (default: 1)')
+    parser.add_argument('--disks', metavar='REGEX', help='Block devices to report in disk_rates.log (default: all but loop, ram, zram, sr and fd devices)')
+    parser.add_argument('-d', '--log-dir', default=LOG_DIR, help=f'Directory for the log files (default: {LOG_DIR})')
+    parser.add_argument('--flush-interval', type=float, default=FLUSH_INTERVAL, help=f'Seconds between flushes of the log files (default: {FLUSH_INTERVAL})')
+    parser.add_argument('-f', '--format', choices=['csv', 'ring', 'none'], help='csv: the <metric>.log text files, ring: fixed-size binary <metric>.ring files, none: no log files (default: csv, none with --daemon)')
+    parser.add_argument('--ring-slots', type=int, default=RING_SLOTS, help=f'Samples kept per metric in ring files before the oldest are overwritten (default: {RING_SLOTS})')
+    parser.add_argument('--to-csv', metavar='RING', help='Print a ring file as CSV and exit')
+    parser.add_argument('--start', help='With --to-csv, first time to include (epoch seconds or YYYY-MM-DDTHH:MM:SS)')
+    parser.add_argument('--end', help='With --to-csv, time to stop at')
+    parser.add_argument('--daemon', action='store_true', help='Run until stopped, exporting the samples through --listen and/or --textfile')
+    parser.add_argument('--listen', metavar='[ADDR:]PORT', type=parse_listen, help='Serve Prometheus metrics on http://ADDR:PORT/metrics')
+    parser.add_argument('--textfile', nargs='?', const=TEXTFILE, metavar='PATH', help=f'Write Prometheus metrics to a node_exporter textfile (default path: {TEXTFILE})')
+    parser.add_argument('--textfile-interval', type=float, default=TEXTFILE_INTERVAL, help=f'Seconds between textfile writes (default: {TEXTFILE_INTERVAL})')
+    parser.add_argument('-w', '--window', type=float, action='append', metavar='SECONDS', help=f"Rolling min/avg/max window, may be given several times (default: {', '.join(map(str, WINDOWS))})")
+    args = parser.parse_args()
+    if args.interval < MIN_INTERVAL:
+        parser.error(f'--interval must be at least {MIN_INTERVAL}')
+    if args.daemon:
+        args.duration = 0
+        if not args.listen and not args.textfile:
+            parser.error('--daemon needs --listen and/or --textfile')
+    if args.format is None:
+        args.format = 'none' if args.daemon else 'csv'
+    if args.window and min(args.window) <= 0:
+        parser.error('--window must be positive')
+    return args
+
+def parse_time(value):
+    # epoch seconds or a local ISO date/time, as epoch nanoseconds
+    if value is None:
+        return None
+    try:
+        return int(float(value) * 1e9)
+    except ValueError:
+        return int(datetime.fromisoformat(value).timestamp() * 1e9)
+
+def start_logging():
+    args = parse_args()
+    if args.to_csv:
+        ring_to_csv(args.to_csv, sys.stdout, parse_time(args.start), parse_time(args.end))
+        return
+    metrics = open_metrics(args.disks)
+    if args.format == 'ring':
+        logs = [RingLog(os.path.join(args.log_dir, f"{m.name}.ring"), m.columns, max(args.ring_slots, 1)) for m in metrics]
+    elif args.format == 'csv':
+        logs = [CsvLog(os.path.join(args.log_dir, f"{m.name}.log"), m.columns, m.formats) for m in metrics]
+    else:
+        logs = []
+    monitor = Monitor(metrics, logs, args.interval, args.flush_interval)
+    server = textfile = None
+    if args.listen or args.textfile:
+        rolling = Rolling(metrics, args.interval, args.window or WINDOWS)
+        monitor.observers.append(rolling)
+        if args.listen:
+            server = serve_metrics(args.listen, rolling, monitor)
+            print(f"Serving metrics on http://{args.listen[0] or '0.0.0.0'}:{args.listen[1]}/metrics", file=sys.stderr)
+        if args.textfile:
+            textfile = Textfile(args.textfile, rolling, monitor, args.textfile_interval)
+            textfile.start()
+
+    # Handle SIGINT and SIGTERM to gracefully exit
+    signal.signal(signal.SIGINT, lambda s, f: monitor.stop())
+    signal.signal(signal.SIGTERM, lambda s, f: monitor.stop())
+
+    try:
+        monitor.run(args.duration)
+    finally:
+        for log in logs:
+            log.close()
+        if textfile:
+            textfile.stop()
+        if server:
+            server.shutdown()
+    if monitor.dropped:
+        print(f"{monitor.dropped} samples dropped, sampling took longer than the interval", file=sys.stderr)
 
 if __name__ == "__main__":
     start_logging()
-
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# 45Drives
+# Self-overhead benchmark for monitor.py
+#
+# Runs the current single-process sampler and the original one-process-per-metric version (kept
+# below, with psutil and `numastat -v`) for the same time, each writing to a scratch directory,
+# and compares the CPU time they used, children included.
+#
+# Usage: python3 monitor_bench.py [-t SECONDS] [-i INTERVAL]
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import resource
+import subprocess
+import multiprocessing
+from datetime import datetime
+
+MONITOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'monitor.py')
+
+# The original monitor.py workers, unchanged apart from the log directory
+def legacy_numa_stats(stop_event, log_dir):
+    while not stop_event.is_set():
+        with open(os.path.join(log_dir, 'numa_stats.log'), 'a') as f:
+            f.write(subprocess.getoutput('numastat -v'))
+        time.sleep(1)
+
+def legacy_memory_usage(stop_event, log_dir):
+    import psutil
+    header = "timestamp,total_memory,available_memory,used_memory,free_memory\n"
+    line_count = 0
+    while not stop_event.is_set():
+        if line_count % 60 == 0:
+            with open(os.path.join(log_dir, 'memory_usage.log'), 'a') as f:
+                f.write(header)
+        mem = psutil.virtual_memory()
+        timestamp = datetime.now().strftime('%a %b %d %I:%M:%S %p %Z %Y')
+        with open(os.path.join(log_dir, 'memory_usage.log'), 'a') as f:
+            f.write(f"{timestamp},{mem.total},{mem.available},{mem.used},{mem.free}\n")
+        line_count += 1
+        time.sleep(1)
+
+def legacy_disk_io(stop_event, log_dir):
+    import psutil
+    header = "timestamp,read_count,write_count,read_gib,write_gib\n"
+    line_count = 0
+    while not stop_event.is_set():
+        if line_count % 60 == 0:
+            with open(os.path.join(log_dir, 'disk_io.log'), 'a') as f:
+                f.write(header)
+        io = psutil.disk_io_counters()
+        read_gib = io.read_bytes / (1024 ** 3)
+        write_gib = io.write_bytes / (1024 ** 3)
+        timestamp = datetime.now().strftime('%a %b %d %I:%M:%S %p %Z %Y')
+        with open(os.path.join(log_dir, 'disk_io.log'), 'a') as f:
+            f.write(f"{timestamp},{io.read_count},{io.write_count},{read_gib:.6f},{write_gib:.6f}\n")
+        line_count += 1
+        time.sleep(1)
+
+def legacy_load_average(stop_event, log_dir):
+    header = "timestamp,load1,load5,load15\n"
+    line_count = 0
+    while not stop_event.is_set():
+        if line_count % 60 == 0:
+            with open(os.path.join(log_dir, 'load_average.log'), 'a') as f:
+                f.write(header)
+        with open('/proc/loadavg', 'r') as f:
+            load_avg = f.read().strip().split()[:3]
+        timestamp = datetime.now().strftime('%a %b %d %I:%M:%S %p %Z %Y')
+        with open(os.path.join(log_dir, 'load_average.log'), 'a') as f:
+            f.write(f"{timestamp},{load_avg[0]},{load_avg[1]},{load_avg[2]}\n")
+        line_count += 1
+        time.sleep(1)
+
+def run_legacy(log_dir, duration):
+    stop_event = multiprocessing.Event()
+    processes = [multiprocessing.Process(target=target, args=(stop_event, log_dir))
+                 for target in (legacy_numa_stats, legacy_memory_usage, legacy_disk_io, legacy_load_average)]
+    for p in processes:
+        p.start()
+    time.sleep(duration)
+    stop_event.set()
+    for p in processes:
+        p.join()
+
+def measure(command):
+    # wall and CPU seconds of a child process and everything it waited for
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.monotonic()
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    wall = time.monotonic() - start
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    return result, wall, cpu
+
+def lines_written(log_dir):
+    total = 0
+    for name in os.listdir(log_dir):
+        with open(os.path.join(log_dir, name), 'rb') as f:
+            total += f.read().count(b'\n')
+    return total
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the CPU overhead of monitor.py with the original multi-process version.')
+    parser.add_argument('-t', '--duration', type=float, default=30, help='Seconds to run each version (default: 30)')
+    parser.add_argument('-i', '--interval', type=float, default=1.0, help='Sampling interval for the current version (default: 1)')
+    parser.add_argument('--legacy', metavar='LOG_DIR', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.legacy:
+        run_legacy(args.legacy, args.duration)
+        return
+
+    runs = [('monitor.py', [sys.executable, MONITOR, '-t', str(args.duration), '-i', str(args.interval)])]
+    try:
+        import psutil
+        runs.append(('original', [sys.executable, os.path.abspath(__file__), '-t', str(args.duration)]))
+    except ImportError:
+        print("psutil is not installed, only the current version is measured", file=sys.stderr)
+
+    for name, command in runs:
+        log_dir = tempfile.mkdtemp(prefix='monitor_bench_')
+        try:
+            if name == 'original':
+                command = command + ['--legacy', log_dir]
+            else:
+                command = command + ['-d', log_dir]
+            result, wall, cpu = measure(command)
+            if result.returncode != 0:
+                print(f"{name}: failed: {result.stderr.decode().strip()}", file=sys.stderr)
+                continue
+            print(f"{name}: {cpu:.3f} CPU seconds over {wall:.1f}s ({100 * cpu / wall:.2f}% of one core), {lines_written(log_dir)} lines logged")
+        finally:
+            shutil.rmtree(log_dir)
+
+if __name__ == '__main__':
+    main()
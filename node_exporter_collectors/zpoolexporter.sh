@@ -3,24 +3,33 @@
 #zpool health status text collector
 
 #Usage:
-#This script will output a prometheus valid string into a file, in order to do so
-#the state field of zpool status will be collected and formatted. A text-collector dir will need to be set
-#in node_exporters systemd service.
+#This script writes a prometheus textfile with the health of every pool and vdev and the
+#READ/WRITE/CKSUM error counters of every device, parsed from zpool status by parse_zpool.py.
+#zpool_status{state} is the same series as before: 0 when every pool is ONLINE, 1 otherwise.
+#A text-collector dir will need to be set in node_exporters systemd service. The file is
+#replaced atomically, so it can be run from cron or a systemd timer as often as needed.
+#
+#parse_zpool.py has to be installed with it, e.g.
+#   install -m 755 parse_zpool.py /usr/local/bin/parse_zpool.py
+#It is looked for at ParseZpool, then on PATH, then next to this script.
 
 #User defined variables
 NodeExporterDir="/var/lib/node_exporter"
+ParseZpool="/usr/local/bin/parse_zpool.py"
 
-#grab a relevant zpool status
-status=$(zpool status | grep -o -m 1 "state: DEGRADED\|OFFLINE\|UNAVAIL")
-poolstatus=$(echo $status | awk -F: '{print $NF}')
-if [ -z "$poolstatus" ]
+if [ ! -f "$ParseZpool" ]
 then
-        dvalue="0"
-        state="ONLINE"
-else
-        dvalue="1"
-        state=$(echo $poolstatus | awk '{ gsub(/ /,""); print }')
+        ParseZpool=$(command -v parse_zpool.py || command -v parse_zpool)
+fi
+if [ -z "$ParseZpool" ]
+then
+        ParseZpool="$(dirname "$(readlink -f "$0")")/parse_zpool.py"
+fi
+if [ ! -f "$ParseZpool" ]
+then
+        echo "zpoolexporter.sh: parse_zpool.py not found in /usr/local/bin, on PATH or next to this script, ${NodeExporterDir}/zpool_status.prom was not updated" >&2
+        logger -t zpoolexporter "parse_zpool.py not found, ${NodeExporterDir}/zpool_status.prom was not updated" 2>/dev/null
+        exit 1
 fi
 
-#echo into/create new prom file
-echo "zpool_status""{""state=""\"$state\"""}" "$dvalue" > "${NodeExporterDir}/zpool_status.prom"
+exec python3 "$ParseZpool" --textfile "${NodeExporterDir}/zpool_status.prom"
@@ -6,61 +6,405 @@ import sys
 import argparse
 import concurrent.futures
 import subprocess
+import struct
+import shutil
 import json
 import os
 import re
+import errno
+import queue
+from itertools import chain
+from collections import namedtuple, OrderedDict
 
-def process_inode(inode, pool_name):
-    if validate_inode(inode):
-        obj = inode + ".00000000"
-        command = f"rados -p {pool_name} getxattr {obj} parent | ceph-dencoder type inode_backtrace_t import - decode dump_json"
-        result = subprocess.run(command, shell=True, stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-        if result.returncode == 0:
-            inode_backtrace_json = json.loads(result.stdout)
-            file_path_json = inode_backtrace_json['ancestors']
-            num_elements = len(file_path_json)
-            path_elements = []
-            itr = num_elements - 1
-            while itr >= 0:
-                path_elements.append(file_path_json[itr]['dname'])
-                itr -= 1
-            file_path = os.path.join('/', *path_elements)
-            print(file_path)
+try:
+    import rados
+except ImportError:
+    rados = None
+
+CEPH_CONF = '/etc/ceph/ceph.conf'
+BACKTRACE_XATTR = 'parent'
+# getxattr requests kept in flight on the single librados connection
+DEFAULT_WINDOW = 256
+WRITE_BUFFER = 1024 * 1024
+# resolved directory paths kept by PathCache
+DEFAULT_CACHE_SIZE = 100000
+
+Backpointer = namedtuple('Backpointer', 'dirino dname version')
+Backtrace = namedtuple('Backtrace', 'ino ancestors pool old_pools')
+
+class BacktraceError(ValueError):
+    pass
+
+class _Decoder:
+    # little-endian reader over a ceph bufferlist encoding, every read is bounds checked
+    def __init__(self, blob):
+        self.blob = blob
+        self.pos = 0
+
+    def unpack(self, fmt):
+        try:
+            values = struct.unpack_from(fmt, self.blob, self.pos)
+        except struct.error:
+            raise BacktraceError(f"truncated at byte {self.pos}")
+        self.pos += struct.calcsize(fmt)
+        return values
+
+    def string(self):
+        length, = self.unpack('<I')
+        end = self.pos + length
+        if end > len(self.blob):
+            raise BacktraceError(f"string of {length} bytes at byte {self.pos} runs past the end")
+        value = self.blob[self.pos:end].decode('utf-8', errors='replace')
+        self.pos = end
+        return value
+
+    def start(self, compat_v, len_v, max_compat):
+        # DECODE_START_LEGACY_COMPAT_LEN: struct_v, then the compat version and payload length for
+        # encodings new enough to have them. Returns (struct_v, end of payload or None).
+        struct_v, = self.unpack('<B')
+        if struct_v >= compat_v:
+            compat, = self.unpack('<B')
+            if compat > max_compat:
+                raise BacktraceError(f"encoding needs decoder v{compat}, only v{max_compat} is understood")
+        end = None
+        if struct_v >= len_v:
+            length, = self.unpack('<I')
+            end = self.pos + length
+            if end > len(self.blob):
+                raise BacktraceError(f"payload of {length} bytes at byte {self.pos} runs past the end")
+        return struct_v, end
+
+    def finish(self, end):
+        # DECODE_FINISH: skip fields added by newer encoders
+        if end is not None:
+            if self.pos > end:
+                raise BacktraceError(f"decoded past the end of the payload at byte {end}")
+            self.pos = end
+
+def decode_backpointer(d, struct_v):
+    if struct_v < 4:
+        # inode_backpointer_t::decode_old, no header of its own
+        dirino, = d.unpack('<Q')
+        dname = d.string()
+        version, = d.unpack('<Q')
+        return Backpointer(dirino, dname, version)
+    _, end = d.start(2, 2, 2)
+    dirino, = d.unpack('<Q')
+    dname = d.string()
+    version, = d.unpack('<Q')
+    d.finish(end)
+    return Backpointer(dirino, dname, version)
+
+def decode_backtrace(blob):
+    # inode_backtrace_t as the MDS writes it to the 'parent' xattr of a file's first object
+    # (src/mds/inode_backtrace.cc), ancestors nearest parent first. Raises BacktraceError on
+    # anything malformed.
+    d = _Decoder(blob)
+    struct_v, end = d.start(4, 4, 5)
+    if struct_v < 3:
+        raise BacktraceError(f"backtrace encoding v{struct_v} is too old to decode")
+    ino, count = d.unpack('<QI')
+    if count > len(blob):
+        raise BacktraceError(f"ancestor count {count} is larger than the backtrace")
+    ancestors = [decode_backpointer(d, struct_v) for _ in range(count)]
+    pool, old_pools = -1, []
+    if struct_v >= 5:
+        pool, n = d.unpack('<qI')
+        if n > len(blob):
+            raise BacktraceError(f"old pool count {n} is larger than the backtrace")
+        old_pools = list(d.unpack(f'<{n}q'))
+    d.finish(end)
+    return Backtrace(ino, ancestors, pool, old_pools)
+
+def backtrace_path(ancestors):
+    return os.path.join('/', *[bp.dname for bp in reversed(ancestors)])
+
+class PathCache:
+    # LRU map of directory inode -> its resolved path. Objects from one damaged PG tend to share
+    # parent directories, so a backtrace is only joined from its nearest cached ancestor down,
+    # and every directory passed on the way is cached for the next one.
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.paths = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # ancestor names that did not have to be joined thanks to a hit
+        self.skipped = 0
+
+    def _put(self, dirino, path):
+        paths = self.paths
+        paths[dirino] = path
+        paths.move_to_end(dirino)
+        if len(paths) > self.maxsize:
+            paths.popitem(last=False)
+
+    def path(self, ancestors):
+        if not ancestors:
+            return '/'
+        paths = self.paths
+        for start, bp in enumerate(ancestors):
+            prefix = paths.get(bp.dirino)
+            if prefix is not None:
+                self.hits += 1
+                self.skipped += len(ancestors) - start - 1
+                break
         else:
-            print("Object " + "'"+ obj + "'" + " has no backtrace info present", file=sys.stderr)
-    else:
-        print("Inode " + "'"+ inode + "'" + " is not in valid format (11 digit hex), ignoring...", file=sys.stderr)
+            # the top ancestor's directory is the root
+            self.misses += 1
+            start, prefix = len(ancestors) - 1, '/'
+        top = len(ancestors) - 1
+        for j in range(start, -1, -1):
+            bp = ancestors[j]
+            # the root needs no caching, a hit on it would save nothing
+            if self.maxsize and j < top:
+                self._put(bp.dirino, prefix)
+            prefix = os.path.join(prefix, bp.dname)
+        return prefix
+
+    def report(self):
+        lookups = self.hits + self.misses
+        rate = 100.0 * self.hits / lookups if lookups else 0.0
+        return f"Ancestor cache: {self.hits} hits of {lookups} lookups ({rate:.1f}%), {self.skipped} path components reused, {len(self.paths)} dirs cached"
+
+def object_name(inode):
+    return inode + ".00000000"
+
+# getxattr results that mean the backtrace is not there, anything else is a failed lookup
+MISSING_ERRNOS = (errno.ENOENT, errno.ENODATA)
+
+class RadosLookup:
+    # Backtraces read over one librados connection and pool ioctx for the whole run. Lookups are
+    # issued with aio_getxattr as inodes stream in and at most `window` are in flight, so no process
+    # is spawned per inode and memory does not grow with the input. Anything with the
+    # aio_getxattr/get_xattr/Completion interface of rados.Ioctx can stand in for the ioctx.
+    #
+    # aio_getxattr reads into a fixed 4 KiB buffer, so a backtrace with a deep path or many
+    # old_pools fails with -ERANGE. Any failure other than a missing object or xattr is retried
+    # with the synchronous get_xattr, which grows its buffer, from the main thread.
+    def __init__(self, ioctx, window=DEFAULT_WINDOW):
+        self.ioctx = ioctx
+        self.window = window
+
+    def _get_xattr(self, inode):
+        try:
+            return self.ioctx.get_xattr(object_name(inode), BACKTRACE_XATTR)
+        except Exception as e:
+            code = abs(getattr(e, 'errno', None) or 0)
+            if code in MISSING_ERRNOS:
+                return None
+            return OSError(code or errno.EIO, str(e))
+
+    def fetch(self, inodes, ordered=False):
+        # yields (inode, raw backtrace, None if the object or its xattr is missing, or the OSError
+        # the lookup failed with), in input order if asked, otherwise as the cluster answers
+        finished = queue.SimpleQueue()
+        # id(slot) -> (slot, completion), in issue order
+        inflight = {}
+
+        def issue(inode):
+            # [inode, value, return value]
+            slot = [inode, None, 0]
+            def store(completion, value):
+                ret = completion.get_return_value()
+                slot[1] = value if ret >= 0 else None
+                slot[2] = ret
+                if not ordered:
+                    finished.put(slot)
+            inflight[id(slot)] = (slot, self.ioctx.aio_getxattr(object_name(inode), BACKTRACE_XATTR, store))
+
+        def reap():
+            if ordered:
+                slot, completion = inflight.pop(next(iter(inflight)))
+                completion.wait_for_complete_and_cb()
+            else:
+                slot = finished.get()
+                del inflight[id(slot)]
+            inode, value, ret = slot
+            if ret < 0 and -ret not in MISSING_ERRNOS:
+                value = self._get_xattr(inode)
+            return inode, value
+
+        for inode in inodes:
+            issue(inode)
+            if len(inflight) >= self.window:
+                yield reap()
+        while inflight:
+            yield reap()
+
+def shell_getxattr(inode, pool_name):
+    # the xattr, None if the object or xattr is missing, or an OSError if rados failed otherwise
+    result = subprocess.run(["rados", "-p", pool_name, "getxattr", object_name(inode), BACKTRACE_XATTR], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode == 0:
+        return result.stdout or None
+    error = result.stderr.decode(errors='replace').strip()
+    if any(os.strerror(code) in error for code in MISSING_ERRNOS):
+        return None
+    return OSError(errno.EIO, error or f"rados exited with {result.returncode}")
 
-def distribute_inodes(file_path, num_threads, pool_name):
-    with open(file_path, 'r') as file:
-        inodes = file.readlines()
-        inodes = [inode.strip() for inode in inodes]
+class ShellLookup:
+    # The rados CLI run from a thread pool, for hosts without python3-rados. Same streaming
+    # interface as RadosLookup, the window keeps every thread busy without queueing the whole input.
+    def __init__(self, pool_name, num_threads):
+        self.pool_name = pool_name
+        self.num_threads = num_threads
+        self.window = num_threads * 2
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
-        futures = [executor.submit(process_inode, inode, pool_name) for inode in inodes]
-        concurrent.futures.wait(futures)
+    def fetch(self, inodes, ordered=False):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            inflight = {}
+
+            def reap():
+                if ordered:
+                    future = next(iter(inflight))
+                else:
+                    done, _ = concurrent.futures.wait(inflight, return_when=concurrent.futures.FIRST_COMPLETED)
+                    future = next(iter(done))
+                return inflight.pop(future), future.result()
+
+            for inode in inodes:
+                inflight[executor.submit(shell_getxattr, inode, self.pool_name)] = inode
+                if len(inflight) >= self.window:
+                    yield reap()
+            while inflight:
+                yield reap()
+
+def open_ioctx(pool_name, conffile=CEPH_CONF):
+    cluster = rados.Rados(conffile=conffile)
+    cluster.connect()
+    return cluster, cluster.open_ioctx(pool_name)
+
+class ResultWriter:
+    # inode<TAB>path records. Only the main thread writes, in large blocks, so records never
+    # interleave however many lookups are running.
+    def __init__(self, output_file=None):
+        if output_file and output_file != '-':
+            self.file = open(output_file, 'w', buffering=WRITE_BUFFER)
+        else:
+            self.file = open(sys.stdout.fileno(), 'w', buffering=WRITE_BUFFER, closefd=False)
+        self.written = 0
+
+    def write(self, inode, file_path):
+        self.file.write(f"{inode}\t{file_path}\n")
+        self.written += 1
+
+    def close(self):
+        self.file.close()
+
+def valid_inodes(inodes):
+    for inode in inodes:
+        if validate_inode(inode):
+            yield inode
+        else:
+            print("Inode " + "'"+ inode + "'" + " is not in valid format (11 digit hex), ignoring...", file=sys.stderr)
+
+def map_inodes(inodes, lookup, writer, ordered=False, cache=None):
+    if cache is None:
+        cache = PathCache(0)
+    missing = 0
+    for inode, blob in lookup.fetch(valid_inodes(inodes), ordered):
+        if blob is None:
+            print("Object " + "'"+ object_name(inode) + "'" + " has no backtrace info present", file=sys.stderr)
+            missing += 1
+            continue
+        if isinstance(blob, OSError):
+            print("Failed to read the backtrace of object " + "'"+ object_name(inode) + "'" + ": " + str(blob), file=sys.stderr)
+            missing += 1
+            continue
+        try:
+            backtrace = decode_backtrace(blob)
+        except BacktraceError as e:
+            print("Object " + "'"+ object_name(inode) + "'" + " has an undecodable backtrace: " + str(e), file=sys.stderr)
+            missing += 1
+            continue
+        writer.write(inode, cache.path(backtrace.ancestors))
+    return missing
+
+def read_inodes(file_path):
+    # one inode per line, read as the lookups go so the input can be any size; '-' is stdin
+    file = sys.stdin if file_path == '-' else open(file_path, 'r')
+    try:
+        for line in file:
+            inode = line.strip()
+            if inode:
+                yield inode
+    finally:
+        if file is not sys.stdin:
+            file.close()
+
+def check_blobs(paths, compare):
+    # Decode backtraces captured with `rados -p <pool> getxattr <obj> parent > file`. With compare
+    # the result is checked field by field against ceph-dencoder's dump of the same blob.
+    failed = 0
+    for path in paths:
+        with open(path, 'rb') as f:
+            blob = f.read()
+        try:
+            backtrace = decode_backtrace(blob)
+        except BacktraceError as e:
+            print(f"{path}: {e}", file=sys.stderr)
+            failed += 1
+            continue
+        if compare:
+            result = subprocess.run(["ceph-dencoder", "type", "inode_backtrace_t", "import", path, "decode", "dump_json"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if result.returncode != 0:
+                print(f"{path}: ceph-dencoder failed: {result.stderr.decode().strip()}", file=sys.stderr)
+                failed += 1
+                continue
+            expected = json.loads(result.stdout)
+            ours = {
+                'ino': backtrace.ino,
+                'ancestors': [bp._asdict() for bp in backtrace.ancestors],
+                'pool': backtrace.pool,
+                'old_pools': backtrace.old_pools,
+            }
+            mismatched = [key for key in ours if key in expected and expected[key] != ours[key]]
+            if mismatched:
+                print(f"{path}: differs from ceph-dencoder in {', '.join(mismatched)}", file=sys.stderr)
+                failed += 1
+                continue
+        print(f"{path}\t{backtrace.ino:x}\t{backtrace_path(backtrace.ancestors)}")
+    return failed
 
 def validate_inode(inode):
     pattern = r"^[0-9A-Fa-f]{11}$"
     return re.match(pattern, inode)
 
 if __name__ == '__main__':
-    if os.geteuid() != 0:
-        print("This script requires root privileges", file=sys.stderr)
-        sys.exit(1)
-
-    parser = argparse.ArgumentParser(description='Distribute inodes across threads.')
-    parser.add_argument('-i', '--input_file', help='File path, Required if not using -o')
+    parser = argparse.ArgumentParser(description='Map CephFS data pool objects back to file paths from their backtraces.')
+    parser.add_argument('-i', '--input_file', help='File of inodes, one per line ("-" for stdin), Required if not using -o')
     parser.add_argument('-o', '--object_name', help='Object Name, Required if not using -i')
-    parser.add_argument('-n', '--num_threads', type=int, help='Number of threads, Optional defaults to 16')
+    parser.add_argument('-n', '--num_threads', type=int, help='Number of threads for the shell backend, Optional defaults to 16')
     parser.add_argument('-p', '--pool_name', help='Name of RADOS pool, Required')
+    parser.add_argument('-w', '--window', type=int, default=DEFAULT_WINDOW, help=f'Backtrace lookups in flight at once with the rados backend, Optional defaults to {DEFAULT_WINDOW}')
+    parser.add_argument('-O', '--output_file', help='Write inode<TAB>path records here instead of stdout')
+    parser.add_argument('-k', '--keep_order', action='store_true', help='Write records in input order instead of as lookups finish')
+    parser.add_argument('-C', '--cache_size', type=int, default=DEFAULT_CACHE_SIZE, help=f'Directory paths kept in the ancestor cache, 0 to disable, Optional defaults to {DEFAULT_CACHE_SIZE}')
+    parser.add_argument('--backend', choices=['rados', 'shell'], default='rados' if rados else 'shell',
+                        help='rados: one librados connection with async lookups (needs python3-rados), shell: a rados command per inode. Defaults to rados when available')
+    parser.add_argument('-c', '--conf', default=CEPH_CONF, help=f'Ceph config file for the rados backend, Optional defaults to {CEPH_CONF}')
+    parser.add_argument('--decode', nargs='+', metavar='BLOB', help='Decode backtraces captured with "rados getxattr <obj> parent > BLOB" and print their paths, no cluster access')
+    parser.add_argument('--compare', action='store_true', help='With --decode, check every blob against ceph-dencoder')
 
     args = parser.parse_args()
 
+    if args.decode:
+        if args.compare and not shutil.which("ceph-dencoder"):
+            print("--compare requires ceph-dencoder (ceph-common)", file=sys.stderr)
+            sys.exit(1)
+        sys.exit(1 if check_blobs(args.decode, args.compare) else 0)
+
+    if os.geteuid() != 0:
+        print("This script requires root privileges", file=sys.stderr)
+        sys.exit(1)
+
     if not args.input_file and not args.object_name or not args.pool_name:
         parser.print_help()
         sys.exit(1)
 
+    if args.backend == 'rados' and rados is None:
+        print("The rados backend requires the python3-rados package, use --backend shell without it", file=sys.stderr)
+        sys.exit(1)
+
     if not args.num_threads:
         num_threads = 16
     else:
@@ -72,12 +416,27 @@ if __name__ == '__main__':
         print("This script requires ceph admin.keyring be present", file=sys.stderr)
         sys.exit(1)
 
+    inodes = []
     if args.input_file:
-        file_path = args.input_file
-        distribute_inodes(file_path, num_threads, pool_name)
+        inodes = read_inodes(args.input_file)
     if args.object_name:
-        # If given a single object name, split into inode and chunk and process_inode directly bypass threading
-        object_name = args.object_name
-        inode = object_name.split('.')
-        process_inode(inode[0], pool_name)
+        # If given a single object name, split into inode and chunk
+        inodes = chain(inodes, [args.object_name.split('.')[0]])
 
+    writer = ResultWriter(args.output_file)
+    cache = PathCache(max(args.cache_size, 0))
+    cluster = None
+    try:
+        if args.backend == 'rados':
+            cluster, ioctx = open_ioctx(pool_name, args.conf)
+            lookup = RadosLookup(ioctx, max(args.window, 1))
+        else:
+            lookup = ShellLookup(pool_name, max(num_threads, 1))
+        missing = map_inodes(inodes, lookup, writer, args.keep_order, cache)
+    finally:
+        writer.close()
+        if cluster is not None:
+            ioctx.close()
+            cluster.shutdown()
+    print(f"Mapped {writer.written} objects, {missing} without a usable backtrace", file=sys.stderr)
+    print(cache.report(), file=sys.stderr)
@@ -1,62 +1,375 @@
-import subprocess
+#!/usr/bin/env python3
+# 45Drives
+# zpool status parser
+#
+# Reads `zpool status -j` where the installed OpenZFS has it (2.3 and later) and otherwise parses
+# `zpool status -p` by indentation, so a disk named "logsdisk" is still a disk and nested vdevs
+# (replacing, spare) keep their place in the tree. Either way the result is a list of Pool objects
+# holding a tree of Vdev objects with their state and READ/WRITE/CKSUM counters.
+#
+# Output formats:
+#   legacy      the JSON health-check.sh and single_server_validation.sh read (default)
+#   tree        the whole vdev tree as JSON
+#   prometheus  node_exporter textfile metrics, written atomically with --textfile
+#
+# Status captured earlier can be parsed with -i FILE (or -i - for stdin), text or -j JSON.
+#
+# Usage: python3 parse_zpool.py [-f legacy|tree|prometheus] [-i FILE] [--textfile PATH] [POOL ...]
+
+import os
+import re
+import sys
 import json
+import argparse
+import subprocess
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# keys of the vdev classes in `zpool status -j`, by the header text zpool prints for them
+JSON_CLASSES = {'logs': 'logs', 'l2cache': 'cache', 'cache': 'cache', 'special': 'special', 'dedup': 'dedup', 'spares': 'spares'}
+# vdev class a child of the root vdev carries in -j output when it is not a data vdev
+JSON_VDEV_CLASSES = {'log': 'logs', 'special': 'special', 'dedup': 'dedup'}
+# the " pool:" style lines before and after the config section, right aligned by zpool
+STATUS_KEYS = ('pool', 'id', 'state', 'status', 'action', 'see', 'scan', 'remove', 'checkpoint', 'config', 'errors')
+KEY_LINE = re.compile(r'^ {0,3}([a-z]+):(?:\s+(.*))?$')
+INTERIOR_VDEV = re.compile(r'^(mirror|raidz[123]?|draid[123]?(?::[^\s]*?)?|spare|replacing|indirect|hole)-\d+$')
+COUNT = re.compile(r'^(\d+(?:\.\d+)?)([KMGTPE]?)$')
+# states that are not a problem, spares are AVAIL or INUSE
+HEALTHY = ('ONLINE', 'AVAIL', 'INUSE')
+TEXTFILE = '/var/lib/node_exporter/zpool_status.prom'
+
+class ZpoolError(Exception):
+    pass
+
+class Vdev:
+    def __init__(self, name: str, type: str, state: str = '', read_errors: int = 0, write_errors: int = 0,
+                 checksum_errors: int = 0, note: str = ''):
+        self.name = name
+        # root, mirror, raidz1-3, draid1-3, spare, replacing, indirect, hole, disk or file
+        self.type = type
+        self.state = state
+        self.read_errors = read_errors
+        self.write_errors = write_errors
+        self.checksum_errors = checksum_errors
+        # what zpool printed after the counters, "(resilvering)", "was /dev/sdb1"
+        self.note = note
+        self.children: List[Vdev] = []
+
+    def leaves(self) -> Iterator['Vdev']:
+        if not self.children:
+            yield self
+        for child in self.children:
+            yield from child.leaves()
+
+    def walk(self, depth: int = 0) -> Iterator[Tuple[int, 'Vdev']]:
+        yield depth, self
+        for child in self.children:
+            yield from child.walk(depth + 1)
+
+    def to_dict(self) -> Dict:
+        return {'name': self.name, 'type': self.type, 'state': self.state, 'read_errors': self.read_errors,
+                'write_errors': self.write_errors, 'checksum_errors': self.checksum_errors, 'note': self.note,
+                'children': [child.to_dict() for child in self.children]}
 
-def parse_zpool_status():
-    result = subprocess.run(['zpool', 'status'], stdout=subprocess.PIPE)
-    output = result.stdout.decode('utf-8').splitlines()
-    
-    pools = {}
-    current_pool = None
-    current_section = None
-    current_vdev = None
-    current_helper_vdev = None
-
-    for line in output:
-        line = line.strip()
-        if line.startswith('pool:'):
-            current_pool = line.split()[1]
-            pools[current_pool] = {'data_vdevs': [], 'helper_vdevs': [], 'state': '', 'scan': ''}
-            current_section = 'data_vdevs'
-            current_vdev = None
-            current_helper_vdev = None
-        elif line.startswith('state:'):
-            pools[current_pool]['state'] = line.split()[1]
-        elif line.startswith('scan:'):
-            pools[current_pool]['scan'] = ' '.join(line.split()[1:])
-        elif line.startswith('config:'):
+class Pool:
+    def __init__(self, name: str):
+        self.name = name
+        self.state = ''
+        self.status = ''
+        self.action = ''
+        self.scan = ''
+        self.errors = ''
+        self.data_errors = 0
+        # the pool's own line in the config section, its children are the data vdevs
+        self.root = Vdev(name, 'root')
+        # logs, cache, special, dedup and spares, in the order zpool printed them
+        self.classes: Dict[str, List[Vdev]] = {}
+
+    def groups(self) -> Iterator[Tuple[str, List[Vdev]]]:
+        yield 'data', self.root.children
+        yield from self.classes.items()
+
+    def to_dict(self) -> Dict:
+        return {'name': self.name, 'state': self.state, 'status': self.status, 'action': self.action,
+                'scan': self.scan, 'errors': self.errors, 'data_errors': self.data_errors,
+                'root': self.root.to_dict(),
+                'classes': {name: [vdev.to_dict() for vdev in vdevs] for name, vdevs in self.classes.items()}}
+
+def vdev_type(name: str) -> str:
+    match = INTERIOR_VDEV.match(name)
+    if match is None:
+        return 'file' if name.startswith('/') and not name.startswith('/dev/') else 'disk'
+    kind = re.match(r'[a-z]+\d?', match.group(1)).group(0)
+    if kind in ('raidz', 'draid'):
+        kind += '1'
+    return kind
+
+def parse_count(value) -> Optional[int]:
+    # exact with -p or -j --json-int, otherwise zpool's 1.2K style
+    if isinstance(value, int):
+        return value
+    match = COUNT.match(str(value))
+    if match is None:
+        return None
+    return int(float(match.group(1)) * 1024 ** ' KMGTPE'.index(match.group(2) or ' '))
+
+def parse_data_errors(errors: str) -> int:
+    match = re.match(r'(\d+) data errors', errors)
+    return int(match.group(1)) if match else 0
+
+def _vdev_from_fields(fields: List[str]) -> Vdev:
+    vdev = Vdev(fields[0], vdev_type(fields[0]), fields[1] if len(fields) > 1 else '')
+    rest = fields[2:]
+    counts = [parse_count(v) for v in rest[:3]]
+    if len(counts) == 3 and None not in counts:
+        vdev.read_errors, vdev.write_errors, vdev.checksum_errors = counts
+        rest = rest[3:]
+    vdev.note = ' '.join(rest)
+    return vdev
+
+def parse_status_text(text: str) -> List[Pool]:
+    # The config section is a tree drawn with two spaces of indent per level under the NAME
+    # header. The pool's own line and the class headers (logs, cache, ...) sit at the header's
+    # indent, everything deeper hangs off the nearest shallower line.
+    pools = []
+    pool = None
+    key = None
+    header_indent = None
+    # stack[d] is the last vdev seen at depth d, None for a class header
+    stack: List[Optional[Vdev]] = []
+    group: List[Vdev] = []
+    for raw in text.splitlines():
+        line = raw.expandtabs(8).rstrip()
+        match = KEY_LINE.match(line)
+        if match and match.group(1) in STATUS_KEYS:
+            key, value = match.group(1), (match.group(2) or '').strip()
+            if key == 'pool':
+                pool = Pool(value)
+                pools.append(pool)
+                header_indent = None
+                stack = []
+            elif pool is not None and key in ('state', 'status', 'action', 'scan', 'errors'):
+                setattr(pool, key, value)
+            continue
+        if pool is None or not line.strip():
+            continue
+        if key != 'config':
+            # wrapped status/action/scan text
+            if key in ('status', 'action', 'scan'):
+                setattr(pool, key, (getattr(pool, key) + ' ' + line.strip()).strip())
             continue
-        elif line.startswith('errors:'):
-            current_section = None
-        elif line.startswith('NAME') or line.startswith('----') or line == '':
+        fields = line.split()
+        indent = len(line) - len(line.lstrip())
+        if header_indent is None:
+            if fields[0] == 'NAME':
+                header_indent = indent
             continue
-        elif 'raidz' in line or (current_section == 'data_vdevs' and 'mirror' in line):
-            current_vdev = {'type': line, 'disks': []}
-            pools[current_pool]['data_vdevs'].append(current_vdev)
-        elif 'special' in line or 'log' in line or 'cache' in line:
-            current_helper_vdev = {'type': line, 'vdevs': []}
-            pools[current_pool]['helper_vdevs'].append(current_helper_vdev)
-            current_section = 'helper_vdevs'
-        elif current_section == 'helper_vdevs' and 'mirror' in line:
-            current_vdev = {'type': line, 'disks': []}
-            current_helper_vdev['vdevs'].append(current_vdev)
+        depth = max((indent - header_indent) // 2, 0)
+        if depth == 0:
+            if fields[0] == pool.name and len(fields) > 1 and not pool.root.state:
+                pool.root = _vdev_from_fields(fields)
+                pool.root.type = 'root'
+                stack = [pool.root]
+            else:
+                group = pool.classes.setdefault(fields[0], [])
+                stack = [None]
+            continue
+        if not stack:
+            stack = [pool.root]
+        vdev = _vdev_from_fields(fields)
+        del stack[depth:]
+        parent = stack[-1]
+        if parent is None:
+            group.append(vdev)
         else:
-            parts = line.split()
-            if len(parts) < 2:
-                # Logging for debugging
-                print(f"Skipping line (unexpected format): {line}")
-                continue
-
-            name = parts[0]
-            if current_section == 'data_vdevs' and current_vdev:
-                current_vdev['disks'].append(name)
-            elif current_section == 'helper_vdevs' and current_helper_vdev:
-                if current_vdev and 'mirror' in current_vdev['type']:
-                    current_vdev['disks'].append(name)
-                else:
-                    current_helper_vdev['vdevs'].append({'type': 'disk', 'disks': [name]})
-
-    return json.dumps(pools, indent=4)
+            parent.children.append(vdev)
+        while len(stack) < depth:
+            stack.append(parent)
+        stack.append(vdev)
+    for pool in pools:
+        if not pool.root.state:
+            pool.root.state = pool.state
+        pool.data_errors = parse_data_errors(pool.errors)
+    return pools
 
-if __name__ == '__main__':
-    print(parse_zpool_status())
+def _vdev_from_json(data: Dict) -> Vdev:
+    name = data.get('name', '')
+    kind = data.get('vdev_type', '')
+    vdev = Vdev(name, vdev_type(name) if kind != 'root' else 'root', data.get('state', ''))
+    vdev.read_errors = parse_count(data.get('read_errors', 0)) or 0
+    vdev.write_errors = parse_count(data.get('write_errors', 0)) or 0
+    vdev.checksum_errors = parse_count(data.get('checksum_errors', 0)) or 0
+    if vdev.type == 'disk' and kind == 'file':
+        vdev.type = 'file'
+    vdev.children = [_vdev_from_json(child) for child in data.get('vdevs', {}).values()]
+    return vdev
+
+def parse_status_json(data) -> List[Pool]:
+    # `zpool status -j`, with or without --json-int
+    if isinstance(data, (str, bytes)):
+        data = json.loads(data)
+    pools = []
+    for name, info in data.get('pools', {}).items():
+        pool = Pool(info.get('name', name))
+        pool.state = info.get('state', '')
+        pool.status = info.get('status', '')
+        pool.action = info.get('action', '')
+        scan = info.get('scan_stats') or {}
+        pool.scan = ' '.join(str(scan[k]).lower() for k in ('function', 'state') if scan.get(k))
+        pool.data_errors = parse_count(info.get('error_count', 0)) or 0
+        pool.errors = f"{pool.data_errors} data errors" if pool.data_errors else 'No known data errors'
+        for root in info.get('vdevs', {}).values():
+            pool.root = _vdev_from_json(root)
+            pool.root.type = 'root'
+        # some versions list log, special and dedup vdevs under the root with their class
+        data_vdevs = []
+        for vdev, raw in zip(pool.root.children, info.get('vdevs', {}).get(pool.name, {}).get('vdevs', {}).values()):
+            group = JSON_VDEV_CLASSES.get(raw.get('class'))
+            if group:
+                pool.classes.setdefault(group, []).append(vdev)
+            else:
+                data_vdevs.append(vdev)
+        pool.root.children = data_vdevs
+        for key, group in JSON_CLASSES.items():
+            if key in info:
+                pool.classes.setdefault(group, []).extend(_vdev_from_json(v) for v in info[key].values())
+        pools.append(pool)
+    return pools
+
+def parse_status(text: str) -> List[Pool]:
+    if text.lstrip().startswith('{'):
+        return parse_status_json(text)
+    return parse_status_text(text)
+
+def zpool_status(pools: List[str] = (), use_json: bool = True) -> List[Pool]:
+    # -j --json-int first, then -p, then plain text for releases older than both
+    commands = [['zpool', 'status', '-p'], ['zpool', 'status']]
+    if use_json:
+        commands.insert(0, ['zpool', 'status', '-j', '--json-int', '-p'])
+    for command in commands:
+        try:
+            result = subprocess.run(command + list(pools), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except FileNotFoundError:
+            raise ZpoolError('zpool not found, is ZFS installed?')
+        if result.returncode == 0:
+            return parse_status(result.stdout.decode('utf-8', 'replace'))
+        error = result.stderr.decode('utf-8', 'replace').strip()
+        if 'invalid option' not in error and 'unrecognized option' not in error:
+            raise ZpoolError(error or f"{' '.join(command)} failed")
+    raise ZpoolError(error)
+
+def _legacy_line(vdev: Vdev) -> str:
+    return ' '.join([vdev.name, vdev.state, str(vdev.read_errors), str(vdev.write_errors), str(vdev.checksum_errors)])
+
+def _legacy_vdev(vdev: Vdev) -> Dict:
+    if not vdev.children:
+        return {'type': 'disk', 'disks': [vdev.name]}
+    return {'type': _legacy_line(vdev), 'disks': [leaf.name for leaf in vdev.leaves()]}
+
+def to_legacy(pools: List[Pool]) -> Dict:
+    # the layout the old parse_zpool.py printed, a stripe's disks now count as one-disk vdevs
+    legacy = {}
+    for pool in pools:
+        legacy[pool.name] = {
+            'data_vdevs': [_legacy_vdev(vdev) for vdev in pool.root.children],
+            'helper_vdevs': [{'type': name, 'vdevs': [_legacy_vdev(vdev) for vdev in vdevs]} for name, vdevs in pool.classes.items()],
+            'state': pool.state,
+            'scan': pool.scan,
+        }
+    return legacy
+
+def _labels(**labels) -> str:
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels.items()) + '}'
 
+def legacy_status(pools: List[Pool]) -> str:
+    # The one state the old zpoolexporter.sh reported: the first pool that is not ONLINE, else the
+    # first OFFLINE or UNAVAIL device (its grep matched those anywhere in the output), else ONLINE,
+    # also when there are no pools at all
+    for pool in pools:
+        if pool.state and pool.state != 'ONLINE':
+            return pool.state
+    for pool in pools:
+        for _, vdevs in pool.groups():
+            for vdev in vdevs:
+                for _, node in vdev.walk():
+                    if node.state in ('OFFLINE', 'UNAVAIL'):
+                        return node.state
+    return 'ONLINE'
+
+def to_prometheus(pools: List[Pool]) -> str:
+    # zpool_status is the single series zpoolexporter.sh always wrote, unchanged so existing alerts
+    # keep working; the per-pool and per-vdev detail is in the families after it. Every family is
+    # written even when there is nothing to put in it.
+    state = legacy_status(pools)
+    families = {
+        'zpool_status': ('gauge', 'Health of all pools, 0 when every pool is ONLINE and 1 otherwise, labelled with the first problem state.',
+                         [(_labels(state=state), int(state != 'ONLINE'))]),
+        'zpool_pool_status': ('gauge', 'Pool health, 0 when ONLINE and 1 otherwise.', []),
+        'zpool_data_errors': ('gauge', 'Files with permanent data errors in the pool.', []),
+        'zpool_vdev_status': ('gauge', 'Vdev health, 0 when ONLINE (AVAIL or INUSE for spares) and 1 otherwise.', []),
+        'zpool_vdev_read_errors': ('gauge', 'Read errors counted on the vdev since the pool was imported or cleared.', []),
+        'zpool_vdev_write_errors': ('gauge', 'Write errors counted on the vdev since the pool was imported or cleared.', []),
+        'zpool_vdev_checksum_errors': ('gauge', 'Checksum errors counted on the vdev since the pool was imported or cleared.', []),
+    }
+    for pool in pools:
+        families['zpool_pool_status'][2].append((_labels(pool=pool.name, state=pool.state), int(pool.state != 'ONLINE')))
+        families['zpool_data_errors'][2].append((_labels(pool=pool.name), pool.data_errors))
+        for group, vdevs in pool.groups():
+            for vdev in vdevs:
+                for _, node in vdev.walk():
+                    labels = dict(pool=pool.name, vdev=node.name, type=node.type, **{'class': group})
+                    families['zpool_vdev_status'][2].append((_labels(**labels, state=node.state), int(node.state not in HEALTHY)))
+                    families['zpool_vdev_read_errors'][2].append((_labels(**labels), node.read_errors))
+                    families['zpool_vdev_write_errors'][2].append((_labels(**labels), node.write_errors))
+                    families['zpool_vdev_checksum_errors'][2].append((_labels(**labels), node.checksum_errors))
+    out = []
+    for name, (kind, help, series) in families.items():
+        out.append(f"# HELP {name} {help}")
+        out.append(f"# TYPE {name} {kind}")
+        out += [f"{name}{labels} {value}" for labels, value in series]
+    return '\n'.join(out) + '\n'
+
+def write_textfile(path: str, text: str):
+    # node_exporter may read the directory at any moment, so the file is replaced in one rename
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+def parse_zpool_status(pools: List[str] = ()) -> str:
+    # kept for callers of the old script
+    return json.dumps(to_legacy(zpool_status(pools)), indent=4)
+
+def main():
+    parser = argparse.ArgumentParser(description='Parse zpool status into JSON or Prometheus metrics.')
+    parser.add_argument('-f', '--format', choices=['legacy', 'tree', 'prometheus'], default='legacy', help='Output format (default: legacy)')
+    parser.add_argument('-i', '--input', metavar='FILE', help='Parse zpool status text or -j JSON saved in FILE, - for stdin, instead of running zpool')
+    parser.add_argument('--textfile', nargs='?', const=TEXTFILE, metavar='PATH', help=f'Write Prometheus metrics to a node_exporter textfile instead of stdout (default path: {TEXTFILE})')
+    parser.add_argument('--text', action='store_true', help='Parse the text output even if zpool supports -j')
+    parser.add_argument('pools', metavar='POOL', nargs='*', help='Pools to report (default: all)')
+    args = parser.parse_args()
+
+    try:
+        if args.input == '-':
+            pools = parse_status(sys.stdin.read())
+        elif args.input:
+            with open(args.input) as f:
+                pools = parse_status(f.read())
+        else:
+            pools = zpool_status(args.pools, not args.text)
+    except (ZpoolError, OSError, ValueError) as e:
+        print(f"Failed to read zpool status: {e}", file=sys.stderr)
+        sys.exit(1)
+    if args.input and args.pools:
+        pools = [pool for pool in pools if pool.name in args.pools]
+
+    if args.textfile:
+        write_textfile(args.textfile, to_prometheus(pools))
+    elif args.format == 'prometheus':
+        sys.stdout.write(to_prometheus(pools))
+    elif args.format == 'tree':
+        print(json.dumps([pool.to_dict() for pool in pools], indent=4))
+    else:
+        print(json.dumps(to_legacy(pools), indent=4))
+
+if __name__ == '__main__':
+    main()
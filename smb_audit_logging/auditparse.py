@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+
+# Shared smb_audit log parsing engine used by logcounter.py, logparse2.py and exporter.py
+# 45Drives
+
+# Lines are expected in the format produced by share_config.txt:
+#   full_audit:prefix = ???%I???%u???%m???%S???%T???
+# i.e. <syslog header>???ip???user???machine???share???date???|action|status|...|/path
+#
+# Uncompressed logs are mmapped and sliced into large blocks of whole lines. Lines that contain
+# none of the match patterns are dropped on the raw bytes before anything is decoded, and the rest are counted straight into Counters keyed by
+# tuples of the raw byte fields. Equal fields hash to the same key so every distinct
+# ip/machine/user is stored once, and each distinct byte string is decoded to text only once when
+# results are read back out (see AuditParser.text).
+
+import os
+import glob
+import gzip
+import re
+import mmap
+import heapq
+from functools import lru_cache
+from collections import Counter
+from operator import itemgetter
+from concurrent.futures import ProcessPoolExecutor
+
+FIELD_SEP = b'???'
+OPENAT_WRITE = b'openat|ok|w'
+READ_SIZE = 4 * 1024 * 1024
+# uncompressed logs larger than this are split into byte ranges parsed in parallel
+SPLIT_SIZE = 64 * 1024 * 1024
+
+# default number of paths tracked per ip/machine/user when with_paths is set (logcounter.py --max-paths)
+DEFAULT_MAX_PATHS = 1000
+# decoded strings cached by AuditParser.text before the cache is emptied and refilled
+MAX_STRINGS = 100000
+
+# field positions after line.split(FIELD_SEP, 6)
+IP, USER, MACHINE, SHARE, DATE, ACTION = range(1, 7)
+
+_user_key = itemgetter(IP, MACHINE, USER)
+
+
+class TopPaths:
+    # Bounded per-path counter using the Space-Saving algorithm. At most `capacity` paths are
+    # tracked; when a new path arrives and the table is full, the path with the lowest count is
+    # evicted and the newcomer inherits that count. Any path seen more than total/capacity times is
+    # guaranteed to be present, and its count overestimates the true count by at most its error.
+
+    def __init__(self, capacity=DEFAULT_MAX_PATHS):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        # Once full, paths are also grouped by count (stream-summary) with a min-heap of the counts
+        # that have a group, so the least counted path is found without a scan. Heap entries whose
+        # group has since emptied are dropped lazily.
+        self.buckets = None
+        self.heap = []
+
+    def _build(self):
+        self.buckets = {}
+        for path, count in self.counts.items():
+            self.buckets.setdefault(count, {})[path] = None
+        self.heap = list(self.buckets)
+        heapq.heapify(self.heap)
+
+    def _place(self, path, count):
+        bucket = self.buckets.get(count)
+        if bucket is None:
+            bucket = self.buckets[count] = {}
+            heapq.heappush(self.heap, count)
+            if len(self.heap) > 4 * len(self.buckets) + 64:
+                self.heap = list(self.buckets)
+                heapq.heapify(self.heap)
+        bucket[path] = None
+
+    def _unplace(self, path, count):
+        bucket = self.buckets[count]
+        del bucket[path]
+        if not bucket:
+            del self.buckets[count]
+
+    def add(self, path, n=1):
+        counts = self.counts
+        count = counts.get(path)
+        if self.buckets is None:
+            # plain dictionary until the table first fills up
+            if count is not None:
+                counts[path] = count + n
+                return
+            if len(counts) < self.capacity:
+                counts[path] = n
+                self.errors[path] = 0
+                return
+            self._build()
+        if count is not None:
+            self._unplace(path, count)
+            count += n
+        elif len(counts) < self.capacity:
+            count = n
+            self.errors[path] = 0
+        else:
+            heap = self.heap
+            while heap[0] not in self.buckets:
+                heapq.heappop(heap)
+            floor = heap[0]
+            victim = next(iter(self.buckets[floor]))
+            self._unplace(victim, floor)
+            del counts[victim]
+            del self.errors[victim]
+            count = floor + n
+            self.errors[path] = floor
+        counts[path] = count
+        self._place(path, count)
+
+    def merge(self, other):
+        # fold in a summary built over a different part of the log, errors add up
+        for path, count in other.counts.items():
+            self.add(path, count)
+            self.errors[path] += other.errors[path]
+
+    def __contains__(self, path):
+        return path in self.counts
+
+    def __getitem__(self, path):
+        return self.counts[path]
+
+    def __iter__(self):
+        return iter(self.counts)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def items(self):
+        return self.counts.items()
+
+    def top(self, n=None):
+        # [(path, count, error)] highest count first
+        ranked = sorted(self.counts.items(), key=lambda item: item[1], reverse=True)
+        if n is not None:
+            ranked = ranked[:n]
+        return [(path, count, self.errors[path]) for path, count in ranked]
+
+
+def as_patterns(match):
+    # a single pattern or a list of them -> tuple of bytes
+    if isinstance(match, (bytes, str)):
+        match = [match]
+    return tuple(p.encode() if isinstance(p, str) else p for p in match)
+
+
+@lru_cache(maxsize=None)
+def _any_of(patterns):
+    return re.compile(b'|'.join(re.escape(p) for p in patterns)).search
+
+
+class Tally:
+    # Partial aggregate for one block of complete lines, produced without touching shared state
+    # so it can be built outside a lock (or in another process) and merged afterwards.
+    __slots__ = ('lines', 'counts', 'action_counts', 'paths', 'details', 'actions')
+
+    def __init__(self):
+        self.lines = 0
+        self.counts = Counter()
+        self.action_counts = {}
+        self.paths = Counter()
+        self.details = Counter()
+        self.actions = Counter()
+
+
+# (op, status, mode) -> (action, result), e.g. (b'openat', b'ok', b'w') -> (b'openat_write', b'ok')
+_action_labels = {}
+
+
+def classify_action(action):
+    # the action and result labels of an action field, whatever the match patterns are. full_audit
+    # puts a '|' between the prefix and the operation, so the field starts with one.
+    parts = tuple(action.lstrip(b'|').split(b'|', 3)[:3])
+    labels = _action_labels.get(parts)
+    if labels is None:
+        op = parts[0].strip() or b'unknown'
+        status = parts[1] if len(parts) > 1 else b''
+        result = b'ok' if status == b'ok' else b'fail' if status.startswith(b'fail') else b'unknown'
+        if op == b'openat' and len(parts) > 2:
+            op = {b'r': b'openat_read', b'w': b'openat_write'}.get(parts[2], op)
+        labels = (op, result)
+        if len(_action_labels) > 10000:
+            _action_labels.clear()
+        _action_labels[parts] = labels
+    return labels
+
+
+def tally_lines(data, match=OPENAT_WRITE, with_paths=False, with_details=False, with_actions=False):
+    # data must end on a line boundary. counts holds lines containing any of the patterns,
+    # action_counts the lines containing each one. with_actions also classifies every audit line,
+    # matched or not, into actions keyed by (ip, machine, user, share, action, result).
+    patterns = as_patterns(match)
+    tally = Tally()
+    # the file paths of a line are the fields of its action that start with '/',
+    # e.g. b'|openat|ok|w|/tank/share/file' -> b'/tank/share/file'
+    lines = data.split(b'\n')
+    if lines and not lines[-1]:
+        lines.pop()
+    tally.lines = len(lines)
+    if len(patterns) == 1:
+        pattern = patterns[0]
+        matches = lambda line: pattern in line
+    else:
+        matches = _any_of(patterns)
+    if with_actions:
+        # every audit line is split once, the matched ones are picked out of the same lists
+        audit = [line for line in lines if FIELD_SEP in line]
+        every = [line.split(FIELD_SEP, 6) for line in audit]
+        matched = [(line, f) for line, f in zip(audit, every) if matches(line)]
+    else:
+        matched = [(line, line.split(FIELD_SEP, 6)) for line in lines if matches(line)]
+    if any(len(f) <= ACTION for _, f in matched):
+        matched = [(line, f) for line, f in matched if len(f) > ACTION]
+    fields = [f for _, f in matched]
+    tally.counts.update(map(_user_key, fields))
+    if len(patterns) == 1:
+        tally.action_counts[patterns[0]] = tally.counts
+    else:
+        # a pattern matches anywhere in the line, the same as when it is the only one
+        for pattern in patterns:
+            tally.action_counts[pattern] = Counter(_user_key(f) for line, f in matched if pattern in line)
+    if with_paths:
+        tally.paths.update((f[IP], f[MACHINE], f[USER], path) for f in fields for path in f[ACTION].split(b'|') if path.startswith(b'/'))
+    if with_details:
+        tally.details.update((f[IP], f[MACHINE], f[USER], f[DATE], path) for f in fields for path in f[ACTION].split(b'|') if path.startswith(b'/'))
+    if with_actions:
+        tally.actions.update((f[IP], f[MACHINE], f[USER], f[SHARE]) + classify_action(f[ACTION]) for f in every if len(f) > ACTION)
+    return tally
+
+
+class AuditParser:
+    # Streaming aggregator. feed() accepts arbitrary blocks of bytes and keeps any trailing partial
+    # line for the next call; tally()/merge() are the same work split in two for callers that want
+    # to parse outside a lock.
+
+    def __init__(self, match=OPENAT_WRITE, max_paths=DEFAULT_MAX_PATHS, with_paths=False, with_details=False, with_actions=False):
+        self.match = as_patterns(match)
+        self.max_paths = max_paths
+        self.with_paths = with_paths
+        self.with_details = with_details
+        self.with_actions = with_actions
+        self.lines = 0
+        # (ip, machine, user) -> count of lines matching any pattern
+        self.counts = Counter()
+        # pattern -> (ip, machine, user) -> count
+        self.action_counts = {pattern: Counter() for pattern in self.match}
+        # (ip, machine, user) -> TopPaths
+        self.paths = {}
+        # (ip, machine, user, date, path) -> count
+        self.details = Counter()
+        # (ip, machine, user, share, action, result) -> count, see classify_action
+        self.actions = Counter()
+        if len(self.match) == 1:
+            self.action_counts[self.match[0]] = self.counts
+        self.strings = {}
+        self.tail = b''
+
+    def tally(self, data):
+        return tally_lines(data, self.match, self.with_paths, self.with_details, self.with_actions)
+
+    def merge(self, tally):
+        self.lines += tally.lines
+        self.counts.update(tally.counts)
+        self._merge_actions(tally.action_counts)
+        self.details.update(tally.details)
+        self.actions.update(tally.actions)
+        paths = self.paths
+        for (ip, machine, user, path), n in tally.paths.items():
+            key = (ip, machine, user)
+            top = paths.get(key)
+            if top is None:
+                top = paths[key] = TopPaths(self.max_paths)
+            top.add(path, n)
+
+    def _merge_actions(self, action_counts):
+        if len(self.match) == 1:
+            # the same Counter as self.counts, nothing more to add
+            return
+        for pattern, counts in action_counts.items():
+            self.action_counts[pattern].update(counts)
+
+    def feed(self, data):
+        data = self.tail + data
+        end = data.rfind(b'\n') + 1
+        self.tail = data[end:]
+        if end:
+            self.merge(self.tally(data[:end]))
+
+    def flush(self):
+        # count a final line that has no trailing newline
+        if self.tail:
+            tail, self.tail = self.tail, b''
+            self.merge(self.tally(tail + b'\n'))
+
+    def update(self, other):
+        # merge the results of another AuditParser, e.g. one that parsed a different file
+        self.lines += other.lines
+        self.counts.update(other.counts)
+        self._merge_actions(other.action_counts)
+        self.details.update(other.details)
+        self.actions.update(other.actions)
+        for key, other_top in other.paths.items():
+            top = self.paths.get(key)
+            if top is None:
+                top = self.paths[key] = TopPaths(self.max_paths)
+            top.merge(other_top)
+
+    def parse_file(self, path, start=0, end=None, read_size=READ_SIZE):
+        # parse the lines that begin inside [start, end) of an uncompressed file, or all of a .gz
+        if path.endswith('.gz'):
+            with open_log(path) as f:
+                for block in read_range(f, start, end, read_size):
+                    self.feed(block)
+        else:
+            for block in mmap_range(path, start, end, read_size):
+                self.feed(block)
+        self.flush()
+        return self
+
+    def text(self, raw):
+        # decode each distinct byte string once, the cache is emptied when it reaches MAX_STRINGS
+        # so a long-running exporter does not keep every path it has ever seen
+        s = self.strings.get(raw)
+        if s is None:
+            if len(self.strings) >= MAX_STRINGS:
+                self.strings.clear()
+            s = self.strings[raw] = raw.decode('utf-8', errors='replace')
+        return s
+
+    def entries(self, pattern=None):
+        # [(ip, machine, user, count)] as text, for lines matching `pattern` or any pattern
+        text = self.text
+        counts = self.counts if pattern is None else self.action_counts[as_patterns(pattern)[0]]
+        return [(text(ip), text(machine), text(user), n) for (ip, machine, user), n in counts.items()]
+
+    def top_paths(self, ip, machine, user, n=None):
+        text = self.text
+        key = (ip.encode(), machine.encode(), user.encode())
+        top = self.paths.get(key)
+        if top is None:
+            return []
+        return [(text(path), count, error) for path, count, error in top.top(n)]
+
+    def detail_entries(self):
+        # [(ip, machine, user, date, path, count)] as text, grouped by ip/machine/user in the order
+        # each combination first appeared
+        text = self.text
+        order = {key: i for i, key in enumerate(self.counts)}
+        keys = sorted(self.details, key=lambda key: order[key[:3]])
+        return [tuple(map(text, key)) + (self.details[key],) for key in keys]
+
+
+def open_log(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def mmap_range(path, start=0, end=None, block_size=READ_SIZE):
+    # Same contract as read_range, but slices whole-line blocks straight out of an mmap of the file
+    # instead of going through read() and a partial-line carry-over.
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            end = size if end is None else min(end, size)
+            if start:
+                nl = mm.find(b'\n', start - 1)
+                start = size if nl == -1 else nl + 1
+            pos = start
+            while pos < end:
+                # finish the line holding the last byte of this block
+                cut = mm.find(b'\n', min(pos + block_size, end) - 1)
+                cut = size if cut == -1 else cut + 1
+                yield mm[pos:cut]
+                pos = cut
+
+
+def read_range(f, start=0, end=None, read_size=READ_SIZE):
+    # Yield blocks holding every line that begins inside [start, end). A line cut by `start`
+    # belongs to the previous range and is skipped, a line cut by `end` is read to its end.
+    if start:
+        f.seek(start - 1)
+        f.readline()
+    pos = f.tell()
+    if end is not None and pos >= end:
+        return
+    last = b'\n'
+    while end is None or pos < end:
+        block = f.read(read_size if end is None else min(read_size, end - pos))
+        if not block:
+            return
+        pos += len(block)
+        last = block[-1:]
+        yield block
+    if last != b'\n':
+        yield f.readline()
+
+
+def expand_logs(patterns):
+    # glob patterns -> existing files, oldest first so rotated logs are read in the order written
+    paths = set()
+    for pattern in patterns:
+        paths.update(p for p in glob.glob(pattern) if os.path.isfile(p))
+    return sorted(paths, key=lambda p: (os.path.getmtime(p), p))
+
+
+def split_work(paths, split_size=SPLIT_SIZE):
+    # [(path, start, end)] with large uncompressed files cut into byte ranges, gzip files whole
+    units = []
+    for path in paths:
+        size = os.path.getsize(path)
+        if path.endswith('.gz') or size <= split_size:
+            units.append((path, 0, None))
+            continue
+        for start in range(0, size, split_size):
+            units.append((path, start, min(start + split_size, size)))
+    return units
+
+
+def _parse_unit(unit, options):
+    path, start, end = unit
+    return AuditParser(**options).parse_file(path, start, end)
+
+
+def parse_files(paths, jobs=None, split_size=SPLIT_SIZE, **options):
+    # Parse several (rotated, optionally gzipped) logs with a process pool and return the merged
+    # AuditParser. options are passed through to AuditParser. jobs=None uses every CPU.
+    units = split_work(paths, split_size)
+    result = AuditParser(**options)
+    if jobs == 1 or len(units) <= 1:
+        for unit in units:
+            result.update(_parse_unit(unit, options))
+        return result
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        # map keeps submission order, so first-seen ordering survives the merge
+        for partial in executor.map(_parse_unit, units, [options] * len(units)):
+            result.update(partial)
+    return result
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+# Persistent SQLite store of smb_audit aggregates
+# 45Drives
+
+# Parsed counts are kept per day and share so that questions like "top paths for user X last
+# week" are answered with an index lookup instead of rescanning every rotated log.
+#
+#   auditstore.py ingest "/var/log/samba/smb_audit.log*"
+#   auditstore.py top-paths -u user --days 7
+#   auditstore.py top-users --share projects --since 2022-12-01
+#
+# Ingest is incremental and idempotent: each log is identified by a hash of its first line (which
+# survives logrotate renames and compression) and the byte offset reached is committed in the same
+# transaction as the counts, so re-running ingest only adds lines that were not counted before.
+
+import os
+import sys
+import sqlite3
+import hashlib
+import argparse
+from collections import Counter
+from datetime import date, timedelta
+from auditparse import FIELD_SEP, OPENAT_WRITE, IP, USER, MACHINE, SHARE, DATE, ACTION, SPLIT_SIZE, open_log, expand_logs
+
+AUDIT_LOG = '/var/log/samba/smb_audit.log'
+DEFAULT_DB = '/var/lib/smb_audit/audit.db'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    fingerprint TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    offset INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS user_counts (
+    day TEXT NOT NULL,
+    share TEXT NOT NULL,
+    ip TEXT NOT NULL,
+    machine TEXT NOT NULL,
+    user TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (day, share, ip, machine, user)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS path_counts (
+    day TEXT NOT NULL,
+    share TEXT NOT NULL,
+    user TEXT NOT NULL,
+    path TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (day, share, user, path)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS path_counts_user ON path_counts (user, day);
+'''
+
+
+def connect(db_path):
+    if os.path.dirname(db_path):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    db = sqlite3.connect(db_path)
+    db.executescript(SCHEMA)
+    return db
+
+
+def fingerprint(path):
+    # hash of the first complete line, None until the file has one
+    with open_log(path) as f:
+        line = f.readline()
+    if not line.endswith(b'\n'):
+        return None
+    return hashlib.sha1(line).hexdigest()
+
+
+def _text(raw):
+    return raw.decode('utf-8', errors='replace')
+
+
+def _day(raw_date):
+    # %T is "YYYY/MM/DD HH:MM:SS", stored as an ISO date so it sorts and compares as text
+    return _text(raw_date[:10]).replace('/', '-')
+
+
+def tally_days(data, match=OPENAT_WRITE):
+    # counts for one block of complete lines, keyed by raw bytes with the date cut down to the day
+    users = Counter()
+    paths = Counter()
+    lines = data.split(b'\n')
+    fields = [line.split(FIELD_SEP, 6) for line in lines if match in line]
+    fields = [f for f in fields if len(f) > ACTION]
+    users.update((f[DATE][:10], f[SHARE], f[IP], f[MACHINE], f[USER]) for f in fields)
+    paths.update((f[DATE][:10], f[SHARE], f[USER], path) for f in fields for path in f[ACTION].split(b'|') if path.startswith(b'/'))
+    return users, paths
+
+
+def _commit(db, fp, path, offset, users, paths):
+    # counts and the new offset go in together, a crash leaves neither
+    with db:
+        db.executemany(
+            'INSERT INTO user_counts (day, share, ip, machine, user, count) VALUES (?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (day, share, ip, machine, user) DO UPDATE SET count = count + excluded.count',
+            [(_day(d), _text(s), _text(i), _text(m), _text(u), n) for (d, s, i, m, u), n in users.items()])
+        db.executemany(
+            'INSERT INTO path_counts (day, share, user, path, count) VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT (day, share, user, path) DO UPDATE SET count = count + excluded.count',
+            [(_day(d), _text(s), _text(u), _text(p), n) for (d, s, u, p), n in paths.items()])
+        db.execute(
+            'INSERT INTO files (fingerprint, path, offset) VALUES (?, ?, ?) '
+            'ON CONFLICT (fingerprint) DO UPDATE SET path = excluded.path, offset = excluded.offset',
+            (fp, path, offset))
+
+
+def ingest_file(db, path, match=OPENAT_WRITE, batch_size=SPLIT_SIZE):
+    # returns the number of new bytes counted
+    fp = fingerprint(path)
+    if fp is None:
+        return 0
+    row = db.execute('SELECT offset FROM files WHERE fingerprint = ?', (fp,)).fetchone()
+    start = offset = row[0] if row else 0
+    with open_log(path) as f:
+        f.seek(offset)
+        tail = b''
+        while True:
+            block = f.read(batch_size)
+            if not block:
+                break
+            block = tail + block
+            end = block.rfind(b'\n') + 1
+            tail = block[end:]
+            if not end:
+                continue
+            users, paths = tally_days(block[:end], match)
+            offset += end
+            _commit(db, fp, path, offset, users, paths)
+    # a trailing partial line is left for the next run
+    return offset - start
+
+
+def ingest(db, paths, match=OPENAT_WRITE):
+    total = 0
+    for path in paths:
+        total += ingest_file(db, path, match)
+    return total
+
+
+def top_paths(db, user, since=None, until=None, share=None, limit=20):
+    query = 'SELECT path, SUM(count) AS total FROM path_counts WHERE user = ?'
+    params = [user]
+    query, params = _range(query, params, since, until, share)
+    query += ' GROUP BY path ORDER BY total DESC LIMIT ?'
+    return db.execute(query, params + [limit]).fetchall()
+
+
+def top_users(db, since=None, until=None, share=None, limit=20):
+    query = 'SELECT ip, machine, user, SUM(count) AS total FROM user_counts WHERE 1'
+    query, params = _range(query, [], since, until, share)
+    query += ' GROUP BY ip, machine, user ORDER BY total DESC LIMIT ?'
+    return db.execute(query, params + [limit]).fetchall()
+
+
+def _range(query, params, since, until, share):
+    if since:
+        query += ' AND day >= ?'
+        params.append(since)
+    if until:
+        query += ' AND day <= ?'
+        params.append(until)
+    if share:
+        query += ' AND share = ?'
+        params.append(share)
+    return query, params
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Persistent store of smb audit log counts per day and share.')
+    parser.add_argument('-d', '--db', default=DEFAULT_DB, help=f'SQLite database (default: {DEFAULT_DB})')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('ingest', help='Add new lines from the logs to the store')
+    p.add_argument('logs', nargs='*', default=[AUDIT_LOG + '*'], metavar='LOG',
+                   help=f'Log files or quoted glob patterns, rotated and .gz logs included (default: "{AUDIT_LOG}*")')
+
+    for name, help in [('top-paths', 'Most edited paths for a user'), ('top-users', 'Most active ip/machine/user combinations')]:
+        p = sub.add_parser(name, help=help)
+        if name == 'top-paths':
+            p.add_argument('-u', '--user', required=True, help='Username')
+        p.add_argument('-s', '--share', help='Only this share')
+        p.add_argument('--since', help='First day, YYYY-MM-DD')
+        p.add_argument('--until', help='Last day, YYYY-MM-DD')
+        p.add_argument('--days', type=int, help='Only the last N days, instead of --since')
+        p.add_argument('-n', '--limit', type=int, default=20, help='Number of rows (default: 20)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    db = connect(args.db)
+
+    if args.command == 'ingest':
+        paths = expand_logs(args.logs)
+        if not paths:
+            print('No logs found', file=sys.stderr)
+            sys.exit(1)
+        print(f"Ingested {ingest(db, paths)} new bytes from {len(paths)} file(s)")
+        return
+
+    since = args.since
+    if args.days:
+        since = (date.today() - timedelta(days=args.days - 1)).isoformat()
+    if args.command == 'top-paths':
+        for path, count in top_paths(db, args.user, since, args.until, args.share, args.limit):
+            print(f"{count}\t{path}")
+    else:
+        for ip, machine, user, count in top_users(db, since, args.until, args.share, args.limit):
+            print(f"{count}\t{ip}\t{machine}\t{user}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+# Benchmark for the smb_audit parsing engine in auditparse.py
+# 45Drives
+
+# Writes a synthetic smb_audit log in the full_audit:prefix format from share_config.txt
+# (???%I???%u???%m???%S???%T??? followed by full_audit's own |op|status|args) and reports
+# lines/sec for AuditParser, and for the old split-into-a-dict + processLog2 path on a sample of
+# the same file for comparison.
+#
+# Usage: python3 bench_auditparse.py [-n LINES] [-f FILE] [--keep]
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+from itertools import islice, accumulate
+from auditparse import AuditParser
+from logcounter import processLog2
+
+ACTIONS = [
+    (60, 'openat|ok|w|{path}'),
+    (25, 'openat|ok|r|{path}'),
+    (5, 'connect|ok|{share}'),
+    (5, 'disconnect|ok|{share}'),
+    (5, 'openat|fail (No such file or directory)|r|{path}'),
+]
+
+
+def write_synthetic_log(path, lines, seed=45):
+    rng = random.Random(seed)
+    clients = [(f"192.168.{rng.randint(0, 3)}.{rng.randint(2, 254)}", f"user{i}", f"45dr-ws{i:03d}") for i in range(200)]
+    shares = ['share', 'projects', 'home', 'archive']
+    files = [f"dir{rng.randint(0, 99)}/file{i}.{rng.choice(['docx', 'xlsx', 'pdf', 'tmp'])}" for i in range(5000)]
+    # file popularity on a share is heavily skewed, a few files get most of the opens
+    popularity = list(accumulate(1.0 / (rank + 1) for rank in range(len(files))))
+    weights = [w for w, _ in ACTIONS]
+    templates = [t for _, t in ACTIONS]
+    batch = 100000
+    with open(path, 'w') as f:
+        written = 0
+        while written < lines:
+            out = []
+            for _ in range(min(batch, lines - written)):
+                ip, user, machine = rng.choice(clients)
+                share = rng.choice(shares)
+                action = rng.choices(templates, weights)[0].format(share=share, path=f"/tank/samba/{share}/{rng.choices(files, cum_weights=popularity)[0]}")
+                out.append(f"Dec 14 10:11:12 fileserver smbd_audit[4242]: ???{ip}???{user}???{machine}???{share}???2022/12/14 10:11:12???|{action}\n")
+            f.write(''.join(out))
+            written += len(out)
+
+
+def bench_engine(path, **kwargs):
+    start = time.perf_counter()
+    parser = AuditParser(**kwargs).parse_file(path)
+    elapsed = time.perf_counter() - start
+    return parser.lines, elapsed
+
+
+def bench_legacy(path, lines):
+    connectionActions = {}
+    start = time.perf_counter()
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in islice(f, lines):
+            if 'openat|ok|w' not in line:
+                continue
+            line = line.split('???')
+            entry = {"ipaddress": line[1], "username": line[2], "localmachine": line[3], "sharename": line[4], "date": line[5], "action": line[6]}
+            processLog2(entry, connectionActions)
+    return lines, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the smb_audit log parser.')
+    parser.add_argument('-n', '--lines', type=int, default=10000000, help='Number of synthetic lines (default: 10000000)')
+    parser.add_argument('-f', '--file', help='Log file to use, generated if it does not exist (default: a temporary file)')
+    parser.add_argument('--legacy-lines', type=int, default=1000000, help='Lines to run through the old dict + processLog2 path (default: 1000000, 0 to skip)')
+    parser.add_argument('--keep', action='store_true', help='Keep the generated log file')
+    args = parser.parse_args()
+
+    path = args.file or os.path.join(tempfile.gettempdir(), f"smb_audit_bench_{args.lines}.log")
+    generated = False
+    if not os.path.exists(path):
+        print(f"Generating {args.lines} lines in {path} ...", file=sys.stderr)
+        write_synthetic_log(path, args.lines)
+        generated = True
+    size = os.path.getsize(path)
+
+    try:
+        print(f"{path}: {size / 1024 ** 2:.1f} MiB")
+        for name, kwargs in [('counts only', {'with_paths': False}), ('counts + top paths', {'with_paths': True})]:
+            lines, elapsed = bench_engine(path, **kwargs)
+            print(f"auditparse, {name}: {lines} lines in {elapsed:.2f}s = {lines / elapsed:,.0f} lines/sec")
+        if args.legacy_lines:
+            lines, elapsed = bench_legacy(path, min(args.legacy_lines, lines))
+            print(f"dict + processLog2: {lines} lines in {elapsed:.2f}s = {lines / elapsed:,.0f} lines/sec")
+    finally:
+        if generated and not args.keep:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
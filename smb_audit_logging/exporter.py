@@ -3,79 +3,213 @@
 import time
 import json
 import argparse
-import subprocess
 import sys
 import os
+import threading
 from prometheus_client import start_http_server
-from prometheus_client.core import CollectorRegistry, CounterMetricFamily, REGISTRY
-from logcounter import processLog2
+from prometheus_client.core import CollectorRegistry, CounterMetricFamily, GaugeMetricFamily, REGISTRY
+from auditparse import AuditParser, OPENAT_WRITE
+
+AUDIT_LOG = '/var/log/samba/smb_audit.log'
+READ_SIZE = 1024 * 1024
+
+class LogTailer(object):
+	# Follows a log file between scrapes. The inode and the byte offset just past the last
+	# complete line are remembered so each call only reads what was appended since the last one.
+	def __init__(self, path):
+		self.path = path
+		self.file = None
+		self.inode = None
+		self.offset = 0
+
+	def _open(self):
+		try:
+			self.file = open(self.path, 'rb')
+		except FileNotFoundError:
+			self.file = None
+			return False
+		self.inode = os.fstat(self.file.fileno()).st_ino
+		self.offset = 0
+		return True
+
+	def _read_complete_lines(self):
+		# yield blocks of whole lines, a trailing partial line is left for the next call.
+		# Plain reads rather than mmap: the live log may be truncated under us, and touching
+		# a mapped page past the new end of file kills the process with SIGBUS.
+		self.file.seek(self.offset)
+		tail = b''
+		while True:
+			block = self.file.read(READ_SIZE)
+			if not block:
+				break
+			block = tail + block
+			end = block.rfind(b'\n') + 1
+			tail = block[end:]
+			if end:
+				self.offset += end
+				yield block[:end]
+
+	def read_chunks(self):
+		if self.file is None and not self._open():
+			return
+		try:
+			st = os.stat(self.path)
+		except FileNotFoundError:
+			st = None
+
+		if st is not None and st.st_ino != self.inode:
+			# logrotate moved the file away, finish what was written to the old one first
+			yield from self._read_complete_lines()
+			self.file.close()
+			if not self._open():
+				return
+		elif os.fstat(self.file.fileno()).st_size < self.offset:
+			# truncated in place (copytruncate), start over from the beginning
+			self.offset = 0
+
+		yield from self._read_complete_lines()
+
+	def pending_bytes(self):
+		if self.file is None:
+			return 0
+		try:
+			return max(os.stat(self.path).st_size - self.offset, 0)
+		except FileNotFoundError:
+			return 0
+
+OTHER = 'other'
+DEFAULT_MAX_SERIES = 1000
+
+class LabelCap(object):
+	# Counter family with a bound on the number of label sets. The first `limit` label sets seen are
+	# kept; any new one after that has its first `fold` labels replaced by 'other'. Admission is
+	# permanent, so a series never moves in or out of 'other' and every exported counter stays monotonic.
+	def __init__(self, limit, fold):
+		self.limit = limit
+		self.fold = fold
+		self.counts = {}
+
+	def add(self, labels, n):
+		counts = self.counts
+		if labels not in counts and len(counts) >= self.limit:
+			labels = (OTHER,) * self.fold + labels[self.fold:]
+		counts[labels] = counts.get(labels, 0) + n
+
+	def items(self):
+		return list(self.counts.items())
+
+class IngestWorker(threading.Thread):
+	# Consumes newly appended audit lines in the background and folds them into the counters.
+	# Scrapes never parse anything, they only copy the counters out under the lock.
+	def __init__(self, log_path=AUDIT_LOG, interval=1.0, match=OPENAT_WRITE, max_series=DEFAULT_MAX_SERIES):
+		super().__init__(name='smb-audit-ingest', daemon=True)
+		self.tailer = LogTailer(log_path)
+		self.interval = interval
+		# one pass gives the matched-line counts and a per-action breakdown of every line
+		self.parser = AuditParser(match=match, with_paths=False, with_actions=True)
+		self.lock = threading.Lock()
+		# (ip, machine, user)
+		self.entries = LabelCap(max_series, 3)
+		# (ip, machine, user, action, result)
+		self.actions = LabelCap(max_series, 3)
+		# (share, action, result)
+		self.share_actions = LabelCap(max_series, 1)
+		self.stop_event = threading.Event()
+		self.lines_total = 0
+		self.lines_per_second = 0.0
+		self.lag_bytes = 0
+		self.caught_up_at = time.monotonic()
+		self._rate_time = self.caught_up_at
+		self._rate_total = 0
+
+	def _update_rate(self, now, min_elapsed):
+		# called with the lock held, the rate is refreshed mid-backlog too so it is never stale for long
+		elapsed = now - self._rate_time
+		if elapsed < min_elapsed or elapsed <= 0:
+			return
+		self.lines_per_second = (self.lines_total - self._rate_total) / elapsed
+		self._rate_time = now
+		self._rate_total = self.lines_total
+
+	def poll(self):
+		text = self.parser.text
+		for chunk in self.tailer.read_chunks():
+			# parse and decode outside the lock, only merging the counts blocks a scrape
+			tally = self.parser.tally(chunk)
+			entries = [((text(ip), text(machine), text(user)), n) for (ip, machine, user), n in tally.counts.items()]
+			actions = [(tuple(map(text, key)), n) for key, n in tally.actions.items()]
+			with self.lock:
+				for labels, n in entries:
+					self.entries.add(labels, n)
+				for (ip, machine, user, share, action, result), n in actions:
+					self.actions.add((ip, machine, user, action, result), n)
+					self.share_actions.add((share, action, result), n)
+				self.lines_total += tally.lines
+				self._update_rate(time.monotonic(), 1.0)
+		now = time.monotonic()
+		with self.lock:
+			self.lag_bytes = self.tailer.pending_bytes()
+			self.caught_up_at = now
+			self._update_rate(now, self.interval)
+
+	def run(self):
+		while not self.stop_event.is_set():
+			try:
+				self.poll()
+			except OSError as e:
+				print('Failed to read {}: {}'.format(self.tailer.path, e), file=sys.stderr)
+			self.stop_event.wait(self.interval)
+
+	def stop(self):
+		self.stop_event.set()
+
+	def snapshot(self):
+		with self.lock:
+			return {
+				'entries': self.entries.items(),
+				'actions': self.actions.items(),
+				'share_actions': self.share_actions.items(),
+				'lines_total': self.lines_total,
+				'lines_per_second': self.lines_per_second,
+				'lag_bytes': self.lag_bytes,
+				'lag_seconds': time.monotonic() - self.caught_up_at,
+			}
 
 class SMBAuditCollector(object):
-	def __init__(self):
-		pass
+	def __init__(self, worker):
+		self.worker = worker
 	
 	def collect(self):
+		snapshot = self.worker.snapshot()
+
 		smb_audit_entry = CounterMetricFamily('smb_audit_entry', 'Number of times each username/machine/ip combination appears in the smb audit log.', labels=['ip', 'machine', 'user'])
 		# smb_audit_entry.add_metric(['1.1.1.1', '45dr-mmcphee', 'user'], 6)
+		for labels, count in snapshot['entries']:
+			smb_audit_entry.add_metric(labels, count)
+		yield smb_audit_entry
 
-		linelist = []
-		connectionActions = {}
-
-		process = subprocess.Popen("cat /var/log/samba/smb_audit.log | grep 'openat|ok|w'", stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf-8', shell=True)
-		#process = subprocess.Popen("cat /var/log/samba/smb_audit.log | awk '{$1print $6, $8, $10, $12, $14, $16}'", stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf-8', shell=True)
-
-		line = process.stdout.readline()
-		#if line is not null, process it into a dict object
-		while line:
-			#print(line)        
-			#example output: IP:192.168.209.99 USER:user MACHINE:45dr-mmcphee SHARENAME:share DATE:2022/12/14 ACTION:|create_file|ok|0x80|file|open|/tank/samba/share
-			    
-			line = line.split('???')
-			entry = {"ipaddress":None, "username": None, "localmachine": None, "sharename": None, "date": None, "action": None}
-			
-			entry["ipaddress"]=line[1]
-			entry["username"]=line[2]
-			entry["localmachine"]=line[3]         
-			entry["sharename"]=line[4]               
-			entry["date"]=line[5]      
-			entry["action"]=line[6]
-			
-
-			linelist.append(entry)
-			#linelist.append(filepaths)#
-
-			line = process.stdout.readline()
-
-
-
-		for line in linelist:
-			#print("processing log\n")
-
-			processLog2(line, connectionActions)
-			
-		#print("\n",json.dumps(connectionActions, indent=4))
-		#print("#HELP smb_audit_log_count Number of times each username/machine/ip combination appears in the smb audit log")
-		#print("#TYPE smb_audit_log_count counter\n")
-		for ip in connectionActions:
-			machines = connectionActions[ip]
-			#print("\n",json.dumps(key, indent=4))
-			#print("\n",ip )
-			for machine in machines:
-				users = machines[machine]
-				for user in users:
-					data = users[user]
-					
-					#print(f"smb_audit_log_count{{IP={ip},MACHINE={machine},USER={user}}} {data['count']}")
-					smb_audit_entry.add_metric([ip, machine, user], data['count'])
-					# for key in data["paths"]:
-					#    print(f"\t{key} {data['paths'][key]}")
+		smb_audit_action = CounterMetricFamily('smb_audit_action', 'Number of smb audit log lines per ip/machine/user, action and result.', labels=['ip', 'machine', 'user', 'action', 'result'])
+		for labels, count in snapshot['actions']:
+			smb_audit_action.add_metric(labels, count)
+		yield smb_audit_action
 
+		smb_audit_share_action = CounterMetricFamily('smb_audit_share_action', 'Number of smb audit log lines per share, action and result.', labels=['share', 'action', 'result'])
+		for labels, count in snapshot['share_actions']:
+			smb_audit_share_action.add_metric(labels, count)
+		yield smb_audit_share_action
 
-		yield smb_audit_entry
+		yield CounterMetricFamily('smb_audit_ingest_lines', 'Number of smb audit log lines read by the exporter.', value=snapshot['lines_total'])
+		yield GaugeMetricFamily('smb_audit_ingest_lines_per_second', 'Rate at which the exporter is reading smb audit log lines.', value=snapshot['lines_per_second'])
+		yield GaugeMetricFamily('smb_audit_ingest_lag_bytes', 'Bytes of the smb audit log not yet read by the exporter.', value=snapshot['lag_bytes'])
+		yield GaugeMetricFamily('smb_audit_ingest_lag_seconds', 'Seconds since the exporter last caught up with the end of the smb audit log.', value=snapshot['lag_seconds'])
 
 def parse_args():
 	parser = argparse.ArgumentParser(description = 'Prometheus metrics exporter for smb_audit.')
 	parser.add_argument('-p', '--port', required = True, help = 'Port for server')
+	parser.add_argument('-l', '--log', default = AUDIT_LOG, help = 'Path to the smb audit log (default: {})'.format(AUDIT_LOG))
+	parser.add_argument('-i', '--interval', type = float, default = 1.0, help = 'Seconds between checks for new log lines (default: 1)')
+	parser.add_argument('-m', '--match', action = 'append', metavar = 'PATTERN', help = 'Count lines containing PATTERN, may be given several times (default: {})'.format(OPENAT_WRITE.decode()))
+	parser.add_argument('-s', '--max-series', type = int, default = DEFAULT_MAX_SERIES, help = 'Label sets kept per metric before new ip/machine/user or share labels are folded into "other" (default: {})'.format(DEFAULT_MAX_SERIES))
 	return parser.parse_args()
 
 def main():
@@ -93,7 +227,9 @@ def main():
 		print('Serving smb_audit metrics to :{}'.format(port))
 		registry = CollectorRegistry()
 		start_http_server(port, registry=registry)
-		registry.register(SMBAuditCollector())
+		worker = IngestWorker(args.log, args.interval, [p.encode() for p in args.match] if args.match else OPENAT_WRITE, args.max_series)
+		worker.start()
+		registry.register(SMBAuditCollector(worker))
 
 		while True:
 			time.sleep(45 * 24 * 60 * 60)
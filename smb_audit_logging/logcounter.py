@@ -7,10 +7,16 @@ import re
 import os
 import sys
 import json
+import argparse
 import syslog
-import subprocess
+from auditparse import OPENAT_WRITE, DEFAULT_MAX_PATHS, expand_logs, parse_files
+
+AUDIT_LOG = '/var/log/samba/smb_audit.log'
 
 def processLog2(userdict: dict, connectionActions: dict):
+    # The original per-line dict parser, no longer used by main(). It is kept as the reference
+    # bench_auditparse.py measures AuditParser against; its per-path counting now lives in
+    # AuditParser's bounded TopPaths (logcounter.py --top-paths).
 
     #obj = {}
     username = userdict["username"]
@@ -58,61 +64,49 @@ def processLog2(userdict: dict, connectionActions: dict):
     
 
 
-def main():
-
-    linelist = []
-    connectionActions = {}
-
-    process = subprocess.Popen("cat /var/log/samba/smb_audit.log | grep 'openat|ok|w'", stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf-8', shell=True)
-    #process = subprocess.Popen("cat /var/log/samba/smb_audit.log | awk '{$1print $6, $8, $10, $12, $14, $16}'", stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf-8', shell=True)
-
-    line = process.stdout.readline()
-    #if line is not null, process it into a dict object
-    while line:
-        #print(line)
-        #example output: IP:192.168.209.99 USER:user MACHINE:45dr-mmcphee SHARENAME:share DATE:2022/12/14 ACTION:|create_file|ok|0x80|file|open|/tank/samba/share
-        
-        line = line.split('???')
-        entry = {"ipaddress":None, "username": None, "localmachine": None, "sharename": None, "date": None, "action": None}
-        
-        entry["ipaddress"]=line[1]
-        entry["username"]=line[2]
-        entry["localmachine"]=line[3]
-        entry["sharename"]=line[4]
-        entry["date"]=line[5]
-        entry["action"]=line[6]
-        
-
-        linelist.append(entry)
-        #linelist.append(filepaths)#
-
-        line = process.stdout.readline()
+def parse_args(description, paths=False):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('logs', nargs='*', default=[AUDIT_LOG], metavar='LOG',
+                        help=f'Log files or quoted glob patterns, rotated and .gz logs included, e.g. "{AUDIT_LOG}*" (default: {AUDIT_LOG})')
+    parser.add_argument('-j', '--jobs', type=int, default=0, help='Worker processes, 0 for one per CPU (default: 0)')
+    parser.add_argument('-m', '--match', action='append', metavar='PATTERN',
+                        help=f"Count lines containing PATTERN, may be given several times to count several actions in one pass (default: {OPENAT_WRITE.decode()})")
+    if paths:
+        parser.add_argument('-p', '--top-paths', type=int, default=0, metavar='N',
+                            help='Also print the N most counted paths of each ip/machine/user (default: 0, none)')
+        parser.add_argument('--max-paths', type=int, default=DEFAULT_MAX_PATHS, metavar='N',
+                            help=f'Paths tracked per ip/machine/user for --top-paths, bounds memory; counts of paths beyond the first N are approximate (default: {DEFAULT_MAX_PATHS})')
+    args = parser.parse_args()
+    if paths and args.max_paths < 1:
+        parser.error('--max-paths must be at least 1')
+    args.match = [p.encode() for p in args.match] if args.match else [OPENAT_WRITE]
+    return args
 
 
+def main():
 
-    for line in linelist:
-        #print("processing log\n")
+    args = parse_args('Count smb audit log entries per ip/machine/user.', paths=True)
+    # paths are only counted when they are printed, each ip/machine/user keeps at most --max-paths
+    parser = parse_files(expand_logs(args.logs), jobs=args.jobs or None, match=args.match,
+                         with_paths=args.top_paths > 0, max_paths=args.max_paths)
 
-        processLog2(line, connectionActions)
-        
-    #print("\n",json.dumps(connectionActions, indent=4))
     print("#HELP smb_audit_log_count Number of times each username/machine/ip combination appears in the smb audit log")
     print("#TYPE smb_audit_log_count counter\n")
-    for ip in connectionActions:
-        machines = connectionActions[ip]
-        #print("\n",json.dumps(key, indent=4))
-        #print("\n",ip )
-        for machine in machines:
-            users = machines[machine]
-            for user in users:
-                data = users[user]
-                
-                print(f"smb_audit_log_count{{IP={ip},MACHINE={machine},USER={user}}} {data['count']}")
-                # for key in data["paths"]:
-                #    print(f"\t{key} {data['paths'][key]}")
-                
+    if len(args.match) == 1:
+        for ip, machine, user, count in parser.entries():
+            print(f"smb_audit_log_count{{IP={ip},MACHINE={machine},USER={user}}} {count}")
+    else:
+        for pattern in args.match:
+            action = pattern.decode()
+            for ip, machine, user, count in parser.entries(pattern):
+                print(f"smb_audit_log_count{{IP={ip},MACHINE={machine},USER={user},ACTION={action}}} {count}")
+    if args.top_paths > 0:
+        print("\n#HELP smb_audit_path_count Most counted paths of each username/machine/ip combination, may overcount by up to ERROR")
+        print("#TYPE smb_audit_path_count counter\n")
+        for ip, machine, user, _ in parser.entries():
+            for path, count, error in parser.top_paths(ip, machine, user, args.top_paths):
+                print(f"smb_audit_path_count{{IP={ip},MACHINE={machine},USER={user},PATH=\"{path}\",ERROR={error}}} {count}")
 
-    
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
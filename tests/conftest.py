@@ -0,0 +1,34 @@
+# The scripts under test are standalone files, several with dashes in their names, so they are
+# loaded by path rather than imported.
+
+import os
+import sys
+import importlib.util
+import importlib.machinery
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(REPO, 'tests', 'fixtures')
+
+# the smb_audit_logging scripts import each other by module name
+sys.path.insert(0, os.path.join(REPO, 'smb_audit_logging'))
+
+def load_script(filename):
+    name = os.path.splitext(filename)[0].replace('-', '_')
+    if name in sys.modules:
+        return sys.modules[name]
+    # the loader is given explicitly for scripts without a .py extension
+    path = os.path.join(REPO, filename)
+    spec = importlib.util.spec_from_file_location(name, path, loader=importlib.machinery.SourceFileLoader(name, path))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def fixture_path(*parts):
+    return os.path.join(FIXTURES, *parts)
+
+def audit_line(ip, user, machine, share, action, date=b'2022/12/14 10:11:12'):
+    # a line as smbd writes it with full_audit:prefix = ???%I???%u???%m???%S???%T???, full_audit
+    # itself then adds |op|status|args
+    header = b'Dec 14 10:11:12 fileserver smbd_audit[4242]: '
+    return header + b'???'.join([b'', ip, user, machine, share, date, b'|' + action]) + b'\n'
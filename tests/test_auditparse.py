@@ -0,0 +1,100 @@
+import gzip
+
+import auditparse
+
+from conftest import audit_line as line
+
+LINES = [
+    line(b'192.168.0.5', b'alice', b'ws01', b'share', b'openat|ok|w|/tank/share/f.txt'),
+    line(b'192.168.0.5', b'alice', b'ws01', b'share', b'openat|ok|w|/tank/share/g.txt'),
+    line(b'192.168.0.5', b'alice', b'ws01', b'share', b'openat|ok|r|/tank/share/f.txt'),
+    line(b'192.168.0.6', b'bob', b'ws02', b'home', b'connect|ok|home'),
+    line(b'192.168.0.6', b'bob', b'ws02', b'home', b'openat|fail (No such file or directory)|r|/tank/home/x'),
+    b'Dec 14 10:11:13 fileserver smbd[4242]: not an audit line\n',
+]
+
+def test_classify_action():
+    assert auditparse.classify_action(b'|openat|ok|w|/tank/share/f.txt') == (b'openat_write', b'ok')
+    assert auditparse.classify_action(b'|openat|ok|r|/tank/share/f.txt') == (b'openat_read', b'ok')
+    assert auditparse.classify_action(b'|connect|ok|share') == (b'connect', b'ok')
+    assert auditparse.classify_action(b'|openat|fail (Permission denied)|w|/x') == (b'openat_write', b'fail')
+
+def test_tally_lines_with_actions():
+    tally = auditparse.tally_lines(b''.join(LINES), with_paths=True, with_actions=True)
+    assert tally.lines == 6
+    alice = (b'192.168.0.5', b'ws01', b'alice')
+    assert tally.counts == {alice: 2}
+    assert tally.paths == {alice + (b'/tank/share/f.txt',): 1, alice + (b'/tank/share/g.txt',): 1}
+    assert tally.actions == {
+        (b'192.168.0.5', b'ws01', b'alice', b'share', b'openat_write', b'ok'): 2,
+        (b'192.168.0.5', b'ws01', b'alice', b'share', b'openat_read', b'ok'): 1,
+        (b'192.168.0.6', b'ws02', b'bob', b'home', b'connect', b'ok'): 1,
+        (b'192.168.0.6', b'ws02', b'bob', b'home', b'openat_read', b'fail'): 1,
+    }
+
+def test_pattern_counts_do_not_depend_on_other_patterns():
+    # 'alice' is only in the user field, it counts the same alone or next to another pattern
+    data = b''.join(LINES)
+    alone = auditparse.tally_lines(data, match=[b'alice'])
+    together = auditparse.tally_lines(data, match=[b'alice', b'connect'])
+    assert alone.action_counts[b'alice'] == together.action_counts[b'alice'] == {(b'192.168.0.5', b'ws01', b'alice'): 3}
+    assert together.action_counts[b'connect'] == {(b'192.168.0.6', b'ws02', b'bob'): 1}
+    assert sum(together.counts.values()) == 4
+
+def test_paths_are_opt_in_and_bounded():
+    data = b''.join(LINES)
+    assert auditparse.AuditParser().with_paths is False
+    lines = [line(b'192.168.0.5', b'alice', b'ws01', b'share', b'openat|ok|w|/tank/share/%d' % (i % 10)) for i in range(100)]
+    parser = auditparse.AuditParser(with_paths=True, max_paths=4)
+    parser.feed(data + b''.join(lines))
+    assert len(parser.paths[(b'192.168.0.5', b'ws01', b'alice')]) == 4
+    top = parser.top_paths('192.168.0.5', 'ws01', 'alice', 2)
+    assert len(top) == 2 and all(count - error <= 11 for _, count, error in top)
+
+def varied_lines(n):
+    # lengths vary so range boundaries land at every position within a line
+    return [line(b'10.0.%d.%d' % (i % 3, i % 7), b'user%d' % (i % 11), b'ws%d' % (i % 4), b'share',
+                 b'openat|ok|%s|/tank/share/%s' % (b'w' if i % 4 else b'r', b'x' * (i % 37)))
+            for i in range(n)]
+
+def test_ranges_cover_every_line_once(tmp_path):
+    log = tmp_path / 'smb_audit.log'
+    data = b''.join(varied_lines(300))
+    log.write_bytes(data)
+    for split_size in (7, 97, 1000, 4096, len(data) - 1, len(data), len(data) * 2):
+        units = auditparse.split_work([str(log)], split_size)
+        for block_size in (1, 64, auditparse.READ_SIZE):
+            got = b''.join(block for _, start, end in units for block in auditparse.mmap_range(str(log), start, end, block_size))
+            assert got == data, (split_size, block_size)
+        # read_range is the same contract over plain reads
+        with open(log, 'rb') as f:
+            got = b''
+            for _, start, end in units:
+                got += b''.join(auditparse.read_range(f, start, end, 64))
+        assert got == data, split_size
+
+def test_range_without_trailing_newline(tmp_path):
+    log = tmp_path / 'smb_audit.log'
+    data = b''.join(varied_lines(20)).rstrip(b'\n')
+    log.write_bytes(data)
+    units = auditparse.split_work([str(log)], 333)
+    assert b''.join(b for _, s, e in units for b in auditparse.mmap_range(str(log), s, e, 50)) == data
+    assert auditparse.AuditParser().parse_file(str(log)).lines == 20
+
+def test_split_and_gzip_give_the_same_counts(tmp_path):
+    lines = varied_lines(500)
+    plain = tmp_path / 'smb_audit.log'
+    rotated = tmp_path / 'smb_audit.log.1.gz'
+    plain.write_bytes(b''.join(lines[200:]))
+    with gzip.open(rotated, 'wb') as f:
+        f.write(b''.join(lines[:200]))
+    whole = auditparse.AuditParser(with_actions=True)
+    whole.feed(b''.join(lines))
+    for jobs in (1, 2):
+        split = auditparse.parse_files([str(rotated), str(plain)], jobs=jobs, split_size=211, with_actions=True)
+        assert split.lines == 500
+        assert split.counts == whole.counts
+        assert split.actions == whole.actions
+        # first-seen order survives the merge
+        assert list(split.counts) == list(whole.counts)
+    assert len(auditparse.split_work([str(rotated), str(plain)], 211)) == 1 + -(-plain.stat().st_size // 211)
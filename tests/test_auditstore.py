@@ -0,0 +1,69 @@
+import os
+import gzip
+
+import auditstore
+
+from conftest import audit_line
+
+def lines(n, start=0, day=b'2022/12/14'):
+    return [audit_line(b'10.0.0.1', b'user%d' % (i % 3), b'ws', b'share', b'openat|ok|w|/tank/share/f%d' % (i % 4),
+                       date=day + b' 10:11:12') for i in range(start, start + n)]
+
+def totals(db):
+    users = db.execute('SELECT day, user, SUM(count) FROM user_counts GROUP BY day, user ORDER BY day, user').fetchall()
+    paths = db.execute('SELECT SUM(count) FROM path_counts').fetchone()[0] or 0
+    return users, paths
+
+def test_reingest_counts_nothing_twice(tmp_path):
+    log = tmp_path / 'smb_audit.log'
+    data = b''.join(lines(30))
+    log.write_bytes(data)
+    db = auditstore.connect(str(tmp_path / 'audit.db'))
+    assert auditstore.ingest_file(db, str(log)) == len(data)
+    first = totals(db)
+    assert first == ([('2022-12-14', 'user0', 10), ('2022-12-14', 'user1', 10), ('2022-12-14', 'user2', 10)], 30)
+    assert auditstore.ingest_file(db, str(log)) == 0
+    assert totals(db) == first
+
+def test_partial_line_waits_for_the_next_run(tmp_path):
+    log = tmp_path / 'smb_audit.log'
+    head, last = lines(5), lines(1, 5)[0]
+    log.write_bytes(b''.join(head) + last[:17])
+    db = auditstore.connect(str(tmp_path / 'audit.db'))
+    assert auditstore.ingest_file(db, str(log)) == len(b''.join(head))
+    assert totals(db)[1] == 5
+    with open(log, 'ab') as f:
+        f.write(last[17:])
+    assert auditstore.ingest_file(db, str(log)) == len(last)
+    assert totals(db)[1] == 6
+
+def test_odd_batch_sizes_give_the_same_counts(tmp_path):
+    log = tmp_path / 'smb_audit.log'
+    log.write_bytes(b''.join(lines(40) + lines(40, 40, day=b'2022/12/15')))
+    expected = None
+    for batch_size in (1, 37, 250, 1 << 20):
+        db = auditstore.connect(str(tmp_path / f"audit{batch_size}.db"))
+        auditstore.ingest_file(db, str(log), batch_size=batch_size)
+        if expected is None:
+            expected = totals(db)
+        assert totals(db) == expected
+    assert expected[1] == 80
+
+def test_rotated_and_compressed_log_is_recognised(tmp_path):
+    log = tmp_path / 'smb_audit.log'
+    old, late, new = lines(10), lines(4, 10), lines(6, 14, day=b'2022/12/15')
+    log.write_bytes(b''.join(old))
+    db = auditstore.connect(str(tmp_path / 'audit.db'))
+    assert auditstore.ingest(db, [str(log)]) > 0
+    # more lines, then logrotate renames and compresses the file and smbd starts a new one
+    with open(log, 'ab') as f:
+        f.write(b''.join(late))
+    with open(log, 'rb') as src, gzip.open(tmp_path / 'smb_audit.log.1.gz', 'wb') as dst:
+        dst.write(src.read())
+    os.remove(log)
+    log.write_bytes(b''.join(new))
+    paths = auditstore.expand_logs([str(tmp_path / 'smb_audit.log*')])
+    assert auditstore.ingest(db, paths) == len(b''.join(late + new))
+    assert auditstore.ingest(db, paths) == 0
+    assert totals(db)[1] == 20
+    assert db.execute('SELECT COUNT(*) FROM files').fetchone()[0] == 2
@@ -0,0 +1,131 @@
+import os
+import sys
+import json
+import time
+import signal
+import subprocess
+
+import pytest
+
+from conftest import REPO
+
+# There is no CephFS here, so the script is run with os.getxattr answering ceph.file.layout.pool
+# itself: files whose name starts with 'a' are in pool 'fast', everything else in 'data'.
+FAKE_XATTR = """
+import os, sys, time, runpy
+delay = float(os.environ.get('FAKE_DELAY', '0'))
+real = os.getxattr
+def getxattr(path, name, *args, **kwargs):
+    if name != 'ceph.file.layout.pool':
+        return real(path, name, *args, **kwargs)
+    if delay:
+        time.sleep(delay)
+    return b'fast' if os.path.basename(os.fsencode(path)).startswith(b'a') else b'data'
+os.getxattr = getxattr
+sys.argv = ['cephfs-find-files.py'] + sys.argv[1:]
+runpy.run_path(os.path.join({repo!r}, 'cephfs-find-files.py'), run_name='__main__')
+"""
+
+def run(tmp_path, *args, delay=0, wait=True):
+    script = tmp_path / 'run.py'
+    script.write_text(FAKE_XATTR.format(repo=REPO))
+    env = dict(os.environ, FAKE_DELAY=str(delay))
+    command = [sys.executable, str(script)] + [str(a) for a in args]
+    if not wait:
+        return subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    return subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, timeout=60)
+
+def test_names_that_are_not_utf8(tmp_path):
+    tree = tmp_path / 'tree'
+    (tree / 'd').mkdir(parents=True)
+    for name in (b'ok', b'\xff\xfe', 'café'.encode()):
+        open(os.path.join(os.fsencode(tree / 'd'), name), 'w').close()
+    result = run(tmp_path, tree, tmp_path / 'out.txt', 2, 'data')
+    assert result.returncode == 0, result.stderr
+    prefix = os.fsencode(tree / 'd') + b'/'
+    assert sorted((tmp_path / 'out.txt').read_bytes().splitlines()) == sorted(prefix + n for n in (b'ok', b'\xff\xfe', 'café'.encode()))
+
+def test_write_failure_stops_the_crawl(tmp_path):
+    tree = tmp_path / 'tree'
+    tree.mkdir()
+    (tree / 'f').touch()
+    # the output "file" is a directory, so the first write fails
+    (tmp_path / 'out').mkdir()
+    result = run(tmp_path, tree, tmp_path / 'out', 2, 'data')
+    assert result.returncode != 0
+    assert b'Stopped, failed to write' in result.stderr
+    assert b'Finished processing.' not in result.stdout
+
+def make_tree(root, dirs=20, files=60):
+    for d in range(dirs):
+        sub = root / f"d{d}" / 'sub'
+        sub.mkdir(parents=True)
+        for f in range(files):
+            (sub.parent if f % 2 else sub).joinpath(f"{'a' if f % 3 == 0 else 'b'}{f}").touch()
+
+def interrupt(tmp_path, checkpoint, *args):
+    # start a slow crawl and kill it once a checkpoint with written output and queued dirs exists
+    proc = run(tmp_path, *args, '--checkpoint-interval', 0.05, delay=0.002, wait=False)
+    try:
+        while proc.poll() is None:
+            try:
+                with open(checkpoint) as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                state = None
+            if state and state['pending'] and any(state['outputs'].values()):
+                proc.send_signal(signal.SIGKILL)
+                proc.wait()
+                return state
+            time.sleep(0.01)
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        proc.communicate()
+    raise AssertionError('the crawl finished before a usable checkpoint was taken')
+
+def read_outputs(paths):
+    return [sorted(open(p, 'rb').read().splitlines()) for p in paths]
+
+@pytest.mark.parametrize('inventory', [False, True])
+def test_resume_after_kill_matches_full_run(tmp_path, inventory):
+    tree = tmp_path / 'tree'
+    make_tree(tree)
+    if inventory:
+        full, resumed = tmp_path / 'full', tmp_path / 'resumed'
+        args = ['-I']
+        checkpoint = resumed / 'checkpoint.json'
+        outputs = lambda d: [d / 'fast.list', d / 'data.list', d / 'pools.tsv']
+    else:
+        full, resumed = tmp_path / 'full.txt', tmp_path / 'resumed.txt'
+        args = []
+        checkpoint = tmp_path / 'resumed.txt.checkpoint'
+        outputs = lambda f: [f]
+    match = [] if inventory else ['data']
+    result = run(tmp_path, *args, tree, full, 4, *match)
+    assert result.returncode == 0, result.stderr
+    state = interrupt(tmp_path, checkpoint, *args, tree, resumed, 4, *match)
+    # what a run killed later would have written after the checkpoint, rescanned on resume and
+    # so cut back off first
+    for output in state['outputs']:
+        with open(output, 'ab') as f:
+            f.write(os.fsencode(tree / 'd0' / 'b1') + b'\n')
+    result = run(tmp_path, *args, '--resume', tree, resumed, 4, *match)
+    assert result.returncode == 0, result.stderr
+    assert read_outputs(outputs(resumed)) == read_outputs(outputs(full))
+    assert not checkpoint.exists()
+
+def test_resume_refuses_short_output(tmp_path):
+    tree = tmp_path / 'tree'
+    make_tree(tree)
+    out = tmp_path / 'out.txt'
+    checkpoint = tmp_path / 'out.txt.checkpoint'
+    interrupt(tmp_path, checkpoint, tree, out, 4, 'data')
+    # as if the tail of the file was lost, e.g. by a power cut before it reached the disk
+    with open(checkpoint) as f:
+        size = json.load(f)['outputs'][str(out)]
+    os.truncate(out, size - 1)
+    result = run(tmp_path, '--resume', tree, out, 4, 'data')
+    assert result.returncode != 0
+    assert b'shorter than' in result.stderr
+    assert os.path.getsize(out) == size - 1
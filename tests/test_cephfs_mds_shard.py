@@ -0,0 +1,33 @@
+import json
+import argparse
+
+from conftest import load_script, fixture_path
+
+shard = load_script('cephfs-mds-shard.py')
+
+def load(name):
+    with open(fixture_path('mds_balance', name)) as f:
+        return json.load(f)
+
+def test_plan_pins_keeps_existing_pins():
+    stats = load('stats.json')
+    assignment, rank_load = shard.plan_pins(stats['dirs'], stats['max_mds'], 'rentries', 0.05)
+    assert assignment == load('expected.json')['keep']
+    # a and c stay where they were pinned, the overloaded rank 0 gives up b
+    assert max(rank_load) <= 1.05 / stats['max_mds']
+
+def test_plan_pins_force_replans_everything():
+    stats = load('stats.json')
+    assignment, rank_load = shard.plan_pins(stats['dirs'], stats['max_mds'], 'rentries', 0.05, force=True)
+    assert assignment == load('expected.json')['force']
+    assert max(rank_load) <= 1.05 / stats['max_mds']
+
+def test_balance_from_stats_json_changes_nothing(capsys):
+    stats = load('stats.json')
+    args = argparse.Namespace(metric='rentries', tolerance=5.0, force=False, dry_run=False, pin_interval=0,
+                              stats_json=fixture_path('mds_balance', 'stats.json'), dir=None)
+    shard.balance(args, stats['max_mds'], stats['dirs'])
+    out = capsys.readouterr().out
+    assert '4 of 6 directories change pin' in out
+    assert 'no pins were changed' in out
+    assert 'Dry run' not in out
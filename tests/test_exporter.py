@@ -0,0 +1,93 @@
+import os
+
+import pytest
+
+from conftest import audit_line
+
+pytest.importorskip('prometheus_client')
+import exporter
+
+def lines(n, start=0):
+    return [audit_line(b'10.0.0.%d' % (i % 5), b'user%d' % i, b'ws', b'share', b'openat|ok|w|/tank/share/%d' % i)
+            for i in range(start, start + n)]
+
+def poll(tailer):
+    data = b''.join(tailer.read_chunks())
+    # only whole lines are ever handed out
+    assert not data or data.endswith(b'\n')
+    return data
+
+def test_missing_log_then_appends(tmp_path):
+    log = tmp_path / 'smb_audit.log'
+    tailer = exporter.LogTailer(str(log))
+    assert poll(tailer) == b''
+    first = lines(3)
+    log.write_bytes(b''.join(first))
+    assert poll(tailer) == b''.join(first)
+    assert poll(tailer) == b''
+    more = lines(2, 3)
+    with open(log, 'ab') as f:
+        f.write(b''.join(more))
+    assert poll(tailer) == b''.join(more)
+    assert tailer.pending_bytes() == 0
+
+def test_partial_lines_at_odd_offsets(tmp_path):
+    log = tmp_path / 'smb_audit.log'
+    data = b''.join(lines(40))
+    log.write_bytes(b'')
+    tailer = exporter.LogTailer(str(log))
+    seen = b''
+    # appended 7, 13 or 1 bytes at a time, so lines are cut everywhere including right at '\n'
+    pos, steps = 0, [7, 13, 1]
+    while pos < len(data):
+        step = steps[pos % 3]
+        with open(log, 'ab') as f:
+            f.write(data[pos:pos + step])
+        pos = min(pos + step, len(data))
+        seen += poll(tailer)
+        assert data.startswith(seen)
+        assert tailer.pending_bytes() == pos - len(seen)
+    assert seen == data
+    assert seen.count(b'\n') == 40
+
+def test_rotation_by_rename(tmp_path):
+    log = tmp_path / 'smb_audit.log'
+    old, late, new = lines(5), lines(2, 5), lines(4, 7)
+    log.write_bytes(b''.join(old))
+    tailer = exporter.LogTailer(str(log))
+    assert poll(tailer) == b''.join(old)
+    # written to the old file after the last poll, then logrotate moves it and smbd reopens
+    with open(log, 'ab') as f:
+        f.write(b''.join(late))
+    os.rename(log, tmp_path / 'smb_audit.log.1')
+    log.write_bytes(b''.join(new))
+    assert poll(tailer) == b''.join(late + new)
+    assert poll(tailer) == b''
+
+def test_rotation_with_partial_line_in_the_old_file(tmp_path):
+    log = tmp_path / 'smb_audit.log'
+    old, new = lines(3), lines(2, 3)
+    log.write_bytes(b''.join(old) + b'Dec 14 10:11:12 cut')
+    tailer = exporter.LogTailer(str(log))
+    assert poll(tailer) == b''.join(old)
+    os.rename(log, tmp_path / 'smb_audit.log.1')
+    log.write_bytes(b''.join(new))
+    # the unfinished line of the old file is never completed and not counted
+    assert poll(tailer) == b''.join(new)
+
+def test_copytruncate(tmp_path):
+    log = tmp_path / 'smb_audit.log'
+    old, new = lines(10), lines(3, 10)
+    log.write_bytes(b''.join(old))
+    tailer = exporter.LogTailer(str(log))
+    assert poll(tailer) == b''.join(old)
+    # copied away and truncated in place, then a few shorter lines written to the same inode
+    with open(log, 'r+b') as f:
+        f.truncate(0)
+    with open(log, 'ab') as f:
+        f.write(b''.join(new))
+    assert poll(tailer) == b''.join(new)
+    more = lines(1, 13)
+    with open(log, 'ab') as f:
+        f.write(b''.join(more))
+    assert poll(tailer) == b''.join(more)
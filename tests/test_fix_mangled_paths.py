@@ -0,0 +1,62 @@
+import os
+
+from conftest import load_script
+
+fmp = load_script('fix_mangled_paths.py')
+
+def tree(root):
+    return sorted(os.path.relpath(os.path.join(d, n), root) for d, dirs, files in os.walk(root) for n in dirs + files)
+
+def make_tree(root, depth=2):
+    for name in ('a:b', 'a?b', 'a_b.txt', 'c*d.txt', 'ok'):
+        open(os.path.join(root, name), 'w').close()
+    if depth:
+        for name in ('s:1', 's?1', 'plain'):
+            os.mkdir(os.path.join(root, name))
+            make_tree(os.path.join(root, name), depth - 1)
+
+def test_top_level_paths_in_one_directory(tmp_path):
+    for name in ('a:b', 'a?b'):
+        (tmp_path / name).write_text('')
+    plan = list(fmp.plan_mangled([str(tmp_path / 'a:b'), str(tmp_path / 'a?b')], False))
+    assert [entry['dst'] for entry in plan] == ['a_b', 'a_b(1)']
+    assert fmp.apply_plan(plan) == (2, 0)
+    assert tree(tmp_path) == ['a_b', 'a_b(1)']
+
+def test_parallel_plan_matches_serial(tmp_path):
+    results = []
+    for jobs in (1, 4):
+        root = tmp_path / f"jobs{jobs}" / 'r|oot'
+        root.mkdir(parents=True)
+        make_tree(str(root))
+        plan = list(fmp.plan_mangled([str(root)], True, jobs))
+        renamed, skipped = fmp.apply_plan_parallel(plan, jobs)
+        assert skipped == 0
+        results.append((renamed, tree(str(root.parent))))
+    assert results[0] == results[1]
+
+def test_parallel_plan_stops_early(tmp_path):
+    root = tmp_path / 'root'
+    root.mkdir()
+    make_tree(str(root), 3)
+    plan = fmp.plan_mangled([str(root)], True, 4)
+    first = [next(plan) for _ in range(3)]
+    plan.close()
+    assert len(first) == 3
+
+def test_apply_with_one_job_streams_the_plan(tmp_path):
+    root = tmp_path / 'root'
+    root.mkdir()
+    make_tree(str(root))
+    plan = list(fmp.plan_mangled([str(root)], True, 4))
+    consumed = []
+
+    def entries():
+        # every entry must be applied before the next one is read
+        for entry in plan:
+            if consumed:
+                assert not os.path.lexists(os.path.join(consumed[-1]['dir'], consumed[-1]['src']))
+            consumed.append(entry)
+            yield entry
+
+    assert fmp.apply_plan_parallel(entries(), 1) == (len(plan), 0)
@@ -0,0 +1,30 @@
+import time
+import threading
+
+from conftest import load_script
+
+monitor = load_script('monitor.py')
+
+class SlowRolling:
+    # render() as slow as a long window over many disks, noting the thread it ran on
+    def __init__(self):
+        self.threads = set()
+        self.renders = 0
+
+    def render(self, monitor=None):
+        self.threads.add(threading.current_thread().name)
+        time.sleep(0.05)
+        self.renders += 1
+        return f"monitor_renders {self.renders}\n"
+
+def test_textfile_is_written_off_the_sampling_thread(tmp_path):
+    path = tmp_path / 'monitor.prom'
+    rolling = SlowRolling()
+    textfile = monitor.Textfile(str(path), rolling, None, interval=0.01)
+    textfile.start()
+    time.sleep(0.3)
+    textfile.stop()
+    assert rolling.threads == {'monitor-textfile', threading.current_thread().name}
+    # stop() writes the final state once the thread has finished
+    assert path.read_text() == f"monitor_renders {rolling.renders}\n"
+    assert not list(tmp_path.glob('*.tmp'))
@@ -0,0 +1,136 @@
+import errno
+import shutil
+import struct
+import threading
+
+import pytest
+
+from conftest import load_script, fixture_path
+
+o2f = load_script('object2file-map.py')
+
+def encode_backtrace(ino, ancestors, pool=2, old_pools=()):
+    # inode_backtrace_t v5 as the MDS encodes it, ancestors as (dirino, dname) nearest first
+    def backpointer(dirino, dname):
+        body = struct.pack('<QI', dirino, len(dname)) + dname.encode() + struct.pack('<Q', 1)
+        return struct.pack('<BBI', 2, 2, len(body)) + body
+    body = struct.pack('<QI', ino, len(ancestors)) + b''.join(backpointer(*a) for a in ancestors)
+    body += struct.pack('<qI', pool, len(old_pools)) + b''.join(struct.pack('<q', p) for p in old_pools)
+    return struct.pack('<BBI', 5, 4, len(body)) + body
+
+class Completion:
+    # runs the callback on its own thread, like a librados completion
+    def __init__(self, oncomplete, ret, value):
+        self.ret = ret
+        self.thread = threading.Thread(target=oncomplete, args=(self, value))
+        self.thread.start()
+
+    def get_return_value(self):
+        return self.ret
+
+    def wait_for_complete_and_cb(self):
+        self.thread.join()
+
+class StubError(Exception):
+    def __init__(self, message, errno):
+        super().__init__(message)
+        self.errno = errno
+
+class StubIoctx:
+    # object name -> xattr bytes, or a negative errno the lookup fails with. Values over 4 KiB
+    # fail the async read with -ERANGE the way rados.Ioctx.aio_getxattr does.
+    def __init__(self, xattrs):
+        self.xattrs = xattrs
+        self.sync_calls = []
+
+    def aio_getxattr(self, obj, name, oncomplete):
+        value = self.xattrs.get(obj, -errno.ENOENT)
+        if isinstance(value, int):
+            return Completion(oncomplete, value, None)
+        if len(value) > 4096:
+            return Completion(oncomplete, -errno.ERANGE, None)
+        return Completion(oncomplete, len(value), value)
+
+    def get_xattr(self, obj, name):
+        self.sync_calls.append(obj)
+        value = self.xattrs.get(obj, -errno.ENOENT)
+        if isinstance(value, int):
+            raise StubError(f"getxattr {obj}", -value)
+        return value
+
+def test_rados_lookup_results():
+    big = b'x' * 10000
+    ioctx = StubIoctx({
+        '10000000001.00000000': b'small',
+        '10000000002.00000000': big,
+        '10000000003.00000000': -errno.ENODATA,
+        '10000000005.00000000': -errno.EIO,
+    })
+    inodes = ['10000000001', '10000000002', '10000000003', '10000000004', '10000000005']
+    for ordered in (True, False):
+        ioctx.sync_calls.clear()
+        results = list(o2f.RadosLookup(ioctx, window=2).fetch(inodes, ordered))
+        if ordered:
+            assert [inode for inode, _ in results] == inodes
+        results = dict(results)
+        assert results['10000000001'] == b'small'
+        # -ERANGE from the 4 KiB async read falls back to the synchronous read
+        assert results['10000000002'] == big
+        assert results['10000000003'] is None
+        assert results['10000000004'] is None
+        # any other error is an error, not a missing backtrace
+        assert isinstance(results['10000000005'], OSError)
+        assert sorted(ioctx.sync_calls) == ['10000000002.00000000', '10000000005.00000000']
+
+class MemoryWriter:
+    def __init__(self):
+        self.records = []
+
+    def write(self, inode, path):
+        self.records.append((inode, path))
+
+def test_map_inodes_deep_backtrace_and_errors(capsys):
+    # 60 levels of 80 character names is well over the 4 KiB the async read can return
+    names = [f"{i:02d}" + 'd' * 78 for i in range(60)]
+    ancestors = [(0x20000000000 + i, name) for i, name in enumerate(reversed(names))]
+    deep = encode_backtrace(0x10000000001, ancestors)
+    assert len(deep) > 4096
+    ioctx = StubIoctx({'10000000001.00000000': deep, '10000000002.00000000': -errno.EIO})
+    writer = MemoryWriter()
+    missing = o2f.map_inodes(['10000000001', '10000000002', '10000000003'], o2f.RadosLookup(ioctx), writer, ordered=True)
+    assert writer.records == [('10000000001', '/' + '/'.join(names))]
+    assert missing == 2
+    err = capsys.readouterr().err
+    assert "Failed to read the backtrace of object '10000000002.00000000'" in err
+    assert "'10000000003.00000000' has no backtrace info present" in err
+
+def expected_backtraces():
+    with open(fixture_path('backtraces', 'expected.tsv')) as f:
+        for line in f:
+            if line.startswith('#') or not line.strip():
+                continue
+            blob, ino, path, pool, old_pools = line.rstrip('\n').split('\t')
+            yield fixture_path('backtraces', blob), int(ino, 16), path, int(pool), [int(p) for p in old_pools.split(',') if p]
+
+def test_decode_backtrace_fixtures():
+    for blob, ino, path, pool, old_pools in expected_backtraces():
+        with open(blob, 'rb') as f:
+            backtrace = o2f.decode_backtrace(f.read())
+        assert (backtrace.ino, o2f.backtrace_path(backtrace.ancestors), backtrace.pool, backtrace.old_pools) == (ino, path, pool, old_pools), blob
+
+def test_check_blobs_fixtures(capsys):
+    expected = list(expected_backtraces())
+    assert o2f.check_blobs([blob for blob, *_ in expected], False) == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert lines == [f"{blob}\t{ino:x}\t{path}" for blob, ino, path, _, _ in expected]
+
+@pytest.mark.skipif(not shutil.which('ceph-dencoder'), reason='needs ceph-dencoder (ceph-common)')
+def test_check_blobs_against_ceph_dencoder():
+    assert o2f.check_blobs([blob for blob, *_ in expected_backtraces()], True) == 0
+
+def test_decode_backtrace_truncated():
+    with open(fixture_path('backtraces', 'v5_old_pools.bin'), 'rb') as f:
+        blob = f.read()
+    for cut in (3, 20, len(blob) - 4):
+        with pytest.raises(o2f.BacktraceError):
+            o2f.decode_backtrace(blob[:cut])
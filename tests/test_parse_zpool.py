@@ -0,0 +1,68 @@
+import os
+import json
+import subprocess
+
+from conftest import load_script, fixture_path, REPO
+
+pz = load_script('parse_zpool.py')
+
+def read(name):
+    with open(fixture_path('zpool', name)) as f:
+        return f.read()
+
+def test_text_to_legacy():
+    pools = pz.parse_status(read('status.txt'))
+    assert pz.to_legacy(pools) == json.loads(read('status.legacy.json'))
+
+def test_text_to_prometheus():
+    pools = pz.parse_status(read('status.txt'))
+    text = pz.to_prometheus(pools)
+    assert text == read('status.prom')
+    # the series zpoolexporter.sh wrote before is still there, once
+    assert [line for line in text.splitlines() if line.startswith('zpool_status{')] == ['zpool_status{state="DEGRADED"} 1']
+
+def test_json_to_legacy():
+    pools = pz.parse_status(read('status.json'))
+    assert pz.to_legacy(pools) == json.loads(read('status_json.legacy.json'))
+    # string counters from releases without --json-int are still numbers
+    sda = next(leaf for leaf in pools[0].root.leaves() if leaf.name == 'sda')
+    assert (sda.read_errors, sda.checksum_errors) == (1, 4)
+
+def test_no_pools_still_writes_every_family():
+    text = pz.to_prometheus(pz.parse_status('no pools available\n'))
+    assert 'zpool_status{state="ONLINE"} 0' in text.splitlines()
+    for family in ('zpool_status', 'zpool_pool_status', 'zpool_vdev_status', 'zpool_vdev_checksum_errors'):
+        assert f"# TYPE {family} gauge" in text
+
+def fake_zpool(tmp_path, monkeypatch, json_ok):
+    # a zpool that logs its arguments and prints the fixture, rejecting -j like releases before 2.3
+    log = tmp_path / 'args'
+    script = tmp_path / 'zpool'
+    reject = '' if json_ok else 'case "$*" in *-j*) echo "invalid option \'j\'" >&2; exit 2;; esac\n'
+    output = fixture_path('zpool', 'status.json' if json_ok else 'status.txt')
+    script.write_text(f'#!/bin/sh\necho "$*" >> {log}\n{reject}cat {output}\n')
+    script.chmod(0o755)
+    monkeypatch.setenv('PATH', f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+    return log
+
+def test_zpool_status_uses_json(tmp_path, monkeypatch):
+    log = fake_zpool(tmp_path, monkeypatch, json_ok=True)
+    pools = pz.zpool_status()
+    assert log.read_text().splitlines() == ['status -j --json-int -p']
+    assert pz.to_legacy(pools) == json.loads(read('status_json.legacy.json'))
+
+def test_zpool_status_falls_back_to_text(tmp_path, monkeypatch):
+    log = fake_zpool(tmp_path, monkeypatch, json_ok=False)
+    pools = pz.zpool_status(['tank'])
+    assert log.read_text().splitlines() == ['status -j --json-int -p tank', 'status -p tank']
+    assert pz.to_legacy(pools) == json.loads(read('status.legacy.json'))
+
+def test_exporter_fails_without_parser(tmp_path):
+    # installed on its own the collector must say so rather than leave a stale textfile behind
+    script = tmp_path / 'zpoolexporter.sh'
+    with open(os.path.join(REPO, 'node_exporter_collectors', 'zpoolexporter.sh')) as f:
+        script.write_text(f.read().replace('/usr/local/bin/parse_zpool.py', str(tmp_path / 'missing.py')))
+    result = subprocess.run(['bash', str(script)], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            env={'PATH': '/usr/bin:/bin'})
+    assert result.returncode == 1
+    assert b'parse_zpool.py not found' in result.stderr
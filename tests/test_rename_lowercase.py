@@ -0,0 +1,24 @@
+import os
+
+from conftest import load_script
+
+rl = load_script('rename_lowercase')
+
+def test_paths_in_one_directory_get_distinct_names(tmp_path):
+    for name in ('Foo', 'FOO', 'Bar'):
+        (tmp_path / name).write_text(name)
+    plan = list(rl.plan_rename_all([tmp_path / 'Foo', tmp_path / 'FOO', tmp_path / 'Bar']))
+    assert [entry['dst'] for entry in plan] == ['foo', 'foo(1)', 'bar']
+    assert rl.apply_plan(plan) == (3, 0)
+    assert sorted(os.listdir(tmp_path)) == ['bar', 'foo', 'foo(1)']
+    assert (tmp_path / 'foo(1)').read_text() == 'FOO'
+
+def test_children_are_renamed_before_their_directory(tmp_path):
+    (tmp_path / 'Dir' / 'Sub').mkdir(parents=True)
+    (tmp_path / 'Dir' / 'Sub' / 'A.txt').write_text('')
+    (tmp_path / 'Dir' / 'a.txt').write_text('')
+    (tmp_path / 'Dir' / 'A.TXT').write_text('')
+    plan = list(rl.plan_rename_all([tmp_path / 'Dir']))
+    assert rl.apply_plan(plan) == (4, 0)
+    found = sorted(os.path.relpath(os.path.join(d, n), tmp_path) for d, dirs, files in os.walk(tmp_path) for n in dirs + files)
+    assert found == ['dir', 'dir/a(1).txt', 'dir/a.txt', 'dir/sub', 'dir/sub/a.txt']